@@ -1,7 +1,8 @@
 # app/main.py
 from fastapi import FastAPI, HTTPException, Request, Body
-from fastapi.responses import JSONResponse
-import base64, os, time, logging, sys, traceback, json
+from fastapi.responses import JSONResponse, StreamingResponse, Response
+import hashlib
+import base64, os, time, logging, sys, traceback, json, threading
 from fastapi.middleware.cors import CORSMiddleware
 
 # 降低 httpx/httpcore 的日志噪音
@@ -35,29 +36,104 @@ class AccessLogMiddleware(BaseHTTPMiddleware):
             log.error(f"[res] {request.method} {request.url.path} -> 500 {dt}ms\n{traceback.format_exc()}")
             raise
 
-from app.services.orchestrator import analyze_pipeline
-from app.models.api_models import AnalyzeB64In, EnqueueResponse, JobPollResponse, JobStatus
+from contextlib import asynccontextmanager
+import asyncio
+
+from app.models.api_models import AnalyzeB64In, EnqueueResponse, JobPollResponse, JobStatus, BatchEnqueueIn, BatchEnqueueResponse
 from app.services.job_store import (
-    enqueue_job, pop_jobs, set_status, save_result, save_error, get_job
+    enqueue_job, enqueue_jobs, pop_jobs, pick_lane, queued_hint, BQKEY, claim_job, reap_expired, get_job_status, get_job_result_raw, job_events,
+    get_partial_findings_raw, is_partial_event
 )
+from app.services import worker as worker_svc
+from app.services.worker import BLOB_HELPER_BASE, run_jobs, WorkerEngine
+from app.services.llm_client_existing import pool_stats, aclose_async_client
+from app.services import metrics
+from app.services import batch_mode
+
+import httpx   # fire-and-forget self trigger (see _schedule_wake)
+
+# WORKER_ENGINE=1：在 API 进程里常驻一个 asyncio worker（否则仍靠 /worker/tick 触发）
+WORKER_ENGINE = os.environ.get("WORKER_ENGINE", "0") in ("1", "true", "True")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global _loop, _wake_http
+    _loop = asyncio.get_running_loop()
+    task = None
+    if WORKER_ENGINE:
+        worker_svc.engine = WorkerEngine()
+        task = asyncio.create_task(worker_svc.engine.run())
+    try:
+        yield
+    finally:
+        if task is not None:
+            worker_svc.engine.stop()
+            await task
+            worker_svc.engine = None
+        _loop = None
+        if _wake_http is not None:
+            await _wake_http.aclose()
+            _wake_http = None
+        await aclose_async_client()
+
+# 批量入队单次最多多少份
+BATCH_ENQUEUE_MAX = int(os.environ.get("BATCH_ENQUEUE_MAX", "100"))
+# 一次 /worker/tick 最多处理多少个任务（批量入队时 n 可能很大）；处理完队列里还有任务就再唤醒一次 tick
+TICK_MAX_JOBS = int(os.environ.get("WORKER_TICK_MAX_JOBS", "10"))
+
+# 唤醒方式：http = 入队后在后台请求一次 /worker/tick；none = 不唤醒（由常驻 worker / cron 处理）
+WORKER_WAKE = os.environ.get("WORKER_WAKE", "http")
+WAKE_TIMEOUT = float(os.environ.get("WORKER_WAKE_TIMEOUT_SECONDS", "0.8"))
+_wake_http: httpx.AsyncClient | None = None
+_wake_tasks: set = set()
+_loop: asyncio.AbstractEventLoop | None = None   # lifespan 里记下，线程池里的端点往这里投递
+
+async def _wake_worker(tick: str, http: httpx.AsyncClient | None = None) -> None:
+    """后台任务：响应已经发出后再打 tick；只要请求发出去就行，超时/失败都忽略"""
+    global _wake_http
+    if http is None:
+        # 全局客户端只在 _loop 上用（lifespan 里关闭）
+        if _wake_http is None:
+            _wake_http = httpx.AsyncClient(timeout=httpx.Timeout(WAKE_TIMEOUT))
+        http = _wake_http
+    try:
+        r = await http.get(tick)
+        log.info(f"[wake] self-trigger {tick} -> {r.status_code}")
+    except httpx.TimeoutException:
+        # tick 会跑完整个任务，超时是常态：请求已送达即可
+        log.info(f"[wake] self-trigger {tick} sent (timed out waiting, ignored)")
+    except Exception as e:
+        log.warning(f"[wake] self-trigger error: {e}")
+
+async def _wake_worker_once(tick: str) -> None:
+    """没走 lifespan 时的兜底：每次都是新线程里的新 loop，客户端只活这一次，不能复用全局的"""
+    async with httpx.AsyncClient(timeout=httpx.Timeout(WAKE_TIMEOUT)) as http:
+        await _wake_worker(tick, http)
+
+def _spawn_wake(tick: str) -> None:
+    t = asyncio.create_task(_wake_worker(tick))
+    _wake_tasks.add(t)
+    t.add_done_callback(_wake_tasks.discard)
+
+def _schedule_wake(request: Request, query: str) -> None:
+    """
+    不阻塞入队请求的唤醒：把 tick 请求丢到事件循环上立即返回（端点本身跑在线程池里）。
+    常驻引擎 BLPOP 阻塞在就绪令牌上，入队即唤醒，不需要 tick。
+    """
+    eng = worker_svc.engine
+    if (eng is not None and eng.running) or WORKER_WAKE != "http":
+        return
+    scheme = request.headers.get("x-forwarded-proto", "https")
+    host   = request.headers.get("host")
+    tick = f"{scheme}://{host}/worker/tick?{query}"
+    if _loop is not None and _loop.is_running():
+        _loop.call_soon_threadsafe(_spawn_wake, tick)
+    else:
+        # 没走 lifespan（没有事件循环可用）：后台线程里发
+        threading.Thread(target=asyncio.run, args=(_wake_worker_once(tick),), daemon=True).start()
 
-import httpx   # fire-and-forget self trigger + blob helpers
-
-# === Blob helper endpoints (Node routes in the same Vercel project) ===
-# We call these tiny Node handlers because Vercel Blob private objects
-# are easiest to access/delete via @vercel/blob on Node.
-# Example:
-#   POST   /api/blob/upload   -> issues client-upload token (used by the extension)
-#   GET    /api/blob/fetch    -> returns raw bytes of a private blob (server-to-server)
-#   POST   /api/blob/delete   -> deletes a blob by pathname
-BLOB_HELPER_BASE = os.environ.get("BLOB_HELPER_BASE") or ""  # e.g. "https://<your-app>.vercel.app"
-if not BLOB_HELPER_BASE:
-    # When FastAPI is deployed behind Vercel, we'll compute base_url per-request.
-    # Having this env makes local/dev calls simpler.
-    pass
-    
 def create_app() -> FastAPI:
-    app = FastAPI(title="Lease Analysis Backend", version="0.1.0")
+    app = FastAPI(title="Lease Analysis Backend", version="0.1.0", lifespan=lifespan)
     app.add_middleware(AccessLogMiddleware)
     
     # === CORS（关键）===
@@ -77,6 +153,21 @@ def create_app() -> FastAPI:
     def health() -> dict:
         return {"status": "ok"}
 
+    @app.get("/llm/pool", tags=["meta"])
+    def llm_pool() -> dict:
+        # OpenAI 连接池状态，用于调 OPENAI_MAX_CONNECTIONS / OPENAI_MAX_KEEPALIVE
+        return pool_stats()
+
+    @app.get("/metrics", tags=["meta"])
+    def prometheus_metrics() -> Response:
+        # 各阶段耗时 / token 直方图（Redis 聚合，worker 独立进程也能看到）
+        return Response(content=metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+    @app.get("/metrics/expensive", tags=["meta"])
+    def expensive_jobs(n: int = 20) -> dict:
+        # 按总 token 排序的最贵任务
+        return {"jobs": metrics.expensive(min(max(n, 1), 100))}
+
     @app.get("/", tags=["meta"])
     def root() -> dict:
         return {"message": "Lease Analysis Backend is running"}
@@ -85,8 +176,10 @@ def create_app() -> FastAPI:
     @app.post("/analyzeLeaseByUrl", tags=["upload"])
     def enqueue_by_url(p: dict = Body(...), request: Request = None) -> JSONResponse:
         """
-        Accepts { pathname, name?, size?, debug? } where `pathname` is the Blob's private identifier
-        returned by the client-upload flow. We only store metadata and the pathname.
+        Accepts { pathname, name?, size?, pages?, priority?, tenant?, debug? } where `pathname` is the Blob's
+        private identifier returned by the client-upload flow. We only store metadata and the pathname.
+        The queue lane comes from priority (default interactive) and pages / size (see job_store.pick_lane);
+        tenant falls back to the X-Tenant-Id header.
         """
         pathname = p.get("pathname") or p.get("path") or p.get("blob_pathname")
         if not pathname:
@@ -95,148 +188,170 @@ def create_app() -> FastAPI:
         debug = bool(p.get("debug", 0))
         size = int(p.get("size", 0))
         jurisdiction = p.get("jurisdiction") or {}
+        lane = pick_lane(p.get("priority") or "interactive", size=size, pages=int(p.get("pages") or 0))
+        tenant = p.get("tenant") or (request.headers.get("x-tenant-id") if request else None)
 
-        # Minimal metadata-only enqueue. Your job_store can accept extra fields;
-        # here we reuse the existing enqueue_job for id/queue, then stash pathname into the hash.
-        job_id = enqueue_job(filename, b64="", debug=debug)  # b64 intentionally empty
+        # Metadata-only enqueue: hash 字段（pathname / jurisdiction）和入队在同一次往返里写入
         try:
-            from app.services import job_store as _js
-            _js._r.hset(_js._hkey(job_id), mapping={
+            job_id = enqueue_job(filename, b64="", debug=debug, fields={  # b64 intentionally empty
                 "blob_pathname": pathname,
                 "size": size,
-                "b64": "",  # ensure no content copy is kept
-                "jurisdiction": json.dumps(jurisdiction, ensure_ascii=False)
-            })
+                "jurisdiction": json.dumps(jurisdiction, ensure_ascii=False),
+            }, lane=lane, tenant=tenant)
         except Exception as e:
-            log.error(f"[enqueue-url] failed to stash pathname: {e}")
+            log.error(f"[enqueue-url] enqueue failed: {e}")
             raise HTTPException(status_code=500, detail="enqueue failed")
 
-        # Fire-and-forget worker trigger (tolerate cold-start) + clear logs
+        _schedule_wake(request, f"single={job_id}")
+        return JSONResponse(status_code=202, content=EnqueueResponse(job_id=job_id).model_dump())
+
+    # ========= 批量入队：物业一次上传几十份合同 =========
+    @app.post("/analyzeLeasesByUrl", tags=["upload"])
+    def enqueue_batch_by_url(body: BatchEnqueueIn, request: Request) -> JSONResponse:
+        """
+        Accepts { items: [{ pathname, name?, size?, pages?, jurisdiction? }, ...], debug?, mode?, priority?, tenant? }.
+        All job hashes + queue entries are written in one Redis transaction; one worker wake-up.
+        realtime jobs go to the bulk lanes unless priority=interactive; each item is sized separately.
+        mode=batch: jobs go to the offline Batch API queue (app.services.batch_mode), no wake-up.
+        """
+        if not body.items:
+            raise HTTPException(status_code=400, detail="no items")
+        if len(body.items) > BATCH_ENQUEUE_MAX:
+            raise HTTPException(status_code=413, detail=f"too many items (max {BATCH_ENQUEUE_MAX})")
+        jobs = [{
+            "filename": it.name or "Lease.pdf",
+            "debug": body.debug,
+            "lane": pick_lane(body.priority, size=int(it.size or 0), pages=it.pages),
+            "fields": {
+                "blob_pathname": it.pathname,
+                "size": int(it.size or 0),
+                "jurisdiction": json.dumps(it.jurisdiction or {}, ensure_ascii=False),
+            },
+        } for it in body.items]
         try:
-            #base_url = str(request.base_url).rstrip("/")
-            #tick = f"{base_url}/worker/tick?single={job_id}"
-            
-            scheme = request.headers.get("x-forwarded-proto", "https")
-            host   = request.headers.get("host")
-            tick = f"{scheme}://{host}/worker/tick?single={job_id}"
-    
-            # Give it a little more headroom; cold start often > 200ms
-            with httpx.Client(timeout=httpx.Timeout(0.8)) as c:
-                r = c.get(tick)
-            log.info(f"[enqueue-url] self-trigger {tick} -> {getattr(r, 'status_code', 0)}")
-        except httpx.TimeoutException as e:
-            log.info(f"[enqueue-url] self-trigger timed out (ignored): {e}")
+            job_ids = enqueue_jobs(jobs, queue=BQKEY if body.mode == "batch" else None,
+                                   tenant=body.tenant or request.headers.get("x-tenant-id"))
         except Exception as e:
-            log.warning(f"[enqueue-url] self-trigger error: {e}")
+            log.error(f"[enqueue-batch] enqueue failed: {e}")
+            raise HTTPException(status_code=500, detail="enqueue failed")
+        log.info(f"[enqueue-batch] {len(job_ids)} jobs mode={body.mode}")
 
-        return JSONResponse(status_code=202, content=EnqueueResponse(job_id=job_id).model_dump())
+        if body.mode != "batch":
+            _schedule_wake(request, f"n={len(job_ids)}")
+        return JSONResponse(status_code=202, content=BatchEnqueueResponse(job_ids=job_ids).model_dump())
 
     # ========= 轮询：前端一直打这个 =========
     @app.get("/jobs/{job_id}", response_model=JobPollResponse)
-    def poll(job_id: str):
-        log.info(f"[poll] job_id={job_id}")
-        data = get_job(job_id)
-        if not data:
+    def poll(job_id: str, request: Request):
+        """
+        快路径：未完成时只 HMGET 状态字段；状态没变（If-None-Match 命中 ETag）回 304；
+        完成后把 Redis 里的 result JSON 原样拼进响应体，不解析再编码。
+        流式分析中（status=running）带上已完成的 partial findings（同样原样拼接）。
+        """
+        st = get_job_status(job_id)
+        if not st:
             log.warning(f"[poll] job_id={job_id} not found")
             raise HTTPException(status_code=404, detail="job not found")
-        return JobPollResponse(
-            job_id=job_id,
-            status=JobStatus(data["status"]),
-            message=data.get("message"),
-            result=data.get("result"),
-        )
+        status, message = st["status"], st["message"]
+        sig = f"{status}|{message or ''}|{st['finished_at'] or ''}|{st['partial']}"
+        etag = f'W/"{hashlib.sha1(sig.encode()).hexdigest()[:16]}"'
+        headers = {"ETag": etag, "Cache-Control": "no-cache"}
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers=headers)
+
+        head = json.dumps({"job_id": job_id, "status": JobStatus(status).value, "message": message,
+                           "error_code": st.get("error_code")}, ensure_ascii=False)
+        raw = get_job_result_raw(job_id) if status == JobStatus.done.value else None
+        # 只有 running 才带 partial：出错的任务即使还有残留 findings 也不返回
+        if status == JobStatus.running.value and st["partial"]:
+            head = head[:-1] + ', "findings": [' + ",".join(get_partial_findings_raw(job_id)) + "]}"
+        body = head[:-1] + ', "result": ' + (raw if raw else "null") + "}"
+        return Response(content=body.encode("utf-8"), media_type="application/json", headers=headers)
+
+    # ========= 推送：SSE，一个连接拿到所有阶段变化，替代轮询 =========
+    @app.get("/jobs/{job_id}/events")
+    async def job_events_sse(job_id: str, request: Request):
+        """
+        text/event-stream：先推当前状态，之后每次状态变化推一条（downloading / analyzing / done / error），
+        done 事件里带完整 result；到终态后服务端关闭连接。
+        流式分析时每批新完成的 findings 推一条 `event: findings`（只含新增的；第一条 status 事件带已有的全部）。
+        """
+        events = job_events(job_id)
+        first = await anext(events, None)
+        if first is None:
+            raise HTTPException(status_code=404, detail="job not found")
+
+        async def stream():
+            try:
+                yield f"event: status\ndata: {first}\n\n"
+                async for ev in events:
+                    if await request.is_disconnected():
+                        break
+                    # None = keepalive 周期内没有事件，发注释行防止代理断开
+                    if ev is None:
+                        yield ": ping\n\n"
+                    else:
+                        yield f"event: {'findings' if is_partial_event(ev) else 'status'}\ndata: {ev}\n\n"
+            finally:
+                await events.aclose()
+
+        return StreamingResponse(stream(), media_type="text/event-stream", headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",
+        })
 
     # ========= worker：支持处理单个 / 或批量 =========
     @app.get("/worker/tick")
-    def worker_tick(request: Request, single: str | None = None):
+    def worker_tick(request: Request, single: str | None = None, n: int = 3):
         log.info(f"[worker] start single={single!r}")
-        print(f"[worker] start single={single!r}")
-        handled = 0
-        ids = [single] if single else pop_jobs(max_n=3)
-        log.info(f"[worker] pop -> {ids}")
-        print(f"[worker] pop -> {ids}")
+        eng = worker_svc.engine
+        if eng is not None and eng.running:
+            # 常驻引擎已在阻塞取队列，任务入队即会被取走；tick 只作唤醒/探活
+            return {"handled": 0, "single": single, "engine": eng.stats()}
 
-        for job_id in ids:
-            if not job_id:
-                continue
-            handled += 1
+        try:
+            reap_expired()
+        except Exception as e:
+            log.warning(f"[worker] reap failed (ignored): {e}")
+        if single:
+            # 只处理仍在队列里的任务；已被别的 worker 取走就不重复处理
+            ids = [single] if claim_job(single) else []
+        else:
+            ids = pop_jobs(max_n=min(max(n, 1), TICK_MAX_JOBS))
+        log.info(f"[worker] pop -> {ids}")
+        # Prefer explicit env; otherwise same origin as this function
+        base_url = (BLOB_HELPER_BASE or str(request.base_url)).rstrip("/")
+        ids = [j for j in ids if j]
+        if ids:
+            # 多个任务走分阶段流水线：下一个任务的下载/解析与当前任务的 LLM 等待重叠
+            run_jobs(ids, base_url)
+            # 没有常驻引擎时靠 tick 链排空：一批最多 BATCH_ENQUEUE_MAX 个，单次 tick 只处理 TICK_MAX_JOBS 个
             try:
-                set_status(job_id, "running", "decoding")
-                data = get_job(job_id)
-                if not data:
-                    log.warning(f"[worker] job_id={job_id} hgetall miss")
-                    print(f"[worker] job_id={job_id} hgetall miss")
-                    continue
-                filename = data["filename"]
-                debug = data.get("debug", False)
-                log.info(f"[worker] job_id={job_id} file={filename!r} debug={debug}")
-                print(f"[worker] job_id={job_id} file={filename!r} debug={debug}")
-
-                # Acquire PDF bytes: prefer private Blob pathname
-                raw = None
-                blob_pathname = data.get("blob_pathname")
-                log.info(f"[worker] fetching blob_pathname={blob_pathname!r}")
-                print(f"[worker] fetching blob_pathname={blob_pathname!r}")
-                if blob_pathname:
-                    set_status(job_id, "running", "downloading")
-                    # Prefer explicit env; otherwise same origin as this function
-                    base_url = (BLOB_HELPER_BASE or str(request.base_url)).rstrip("/")
-                    # Server-to-server fetch of private blob bytes (POST JSON)
-                    fetch_url = f"{base_url}/api/blob/fetch"
-                    with httpx.Client(timeout=30.0) as c:
-                        fr = c.post(fetch_url, json={"pathname": blob_pathname})
-                        if fr.status_code != 200:
-                            # surface the first 200 chars of body to logs to know *why* it's 400
-                            err_txt = fr.text[:200] if hasattr(fr, "text") else ""
-                            log.error(f"[worker] blob fetch failed: {fr.status_code} body={err_txt!r}")
-                            print(f"[worker] blob fetch failed: {fr.status_code} body={err_txt!r}")
-                            raise RuntimeError(f"blob fetch failed: {fr.status_code}")
-                        raw = fr.content
-                
-                set_status(job_id, "running", "analyzing")
-                t0 = time.time()
-                # 取回地域参数并传入分析管线
-                j = {}
-                try:
-                    if data.get("jurisdiction"):
-                        j = json.loads(data["jurisdiction"])
-                except Exception:
-                    j = {}
-                result = analyze_pipeline(filename or "unknown.pdf", raw, debug=bool(debug), jurisdiction=j)
-                dt = int((time.time() - t0) * 1000)
-                log.info(f"[worker] job_id={job_id} analyze done in {dt}ms")
-                print(f"[worker] job_id={job_id} analyze done in {dt}ms")
-
-                # 兼容 pydantic 模型 / dict
-                out = result.model_dump() if hasattr(result, "model_dump") else result
-                ok  = getattr(result, "ok", True) if not isinstance(result, dict) else True
-
-                if ok:
-                    save_result(job_id, out)
-                    log.info(f"[worker] job_id={job_id} -> done")
-                    print(f"[worker] job_id={job_id} -> done")
-                    # Best-effort delete the private blob after success
-                    try:
-                        blob_pathname = blob_pathname or data.get("blob_pathname")
-                        if blob_pathname:
-                            base_url = (BLOB_HELPER_BASE or str(request.base_url)).rstrip("/")
-                            del_url = f"{base_url}/api/blob/delete"
-                            with httpx.Client(timeout=10.0) as c:
-                                c.post(del_url, json={"pathname": blob_pathname})
-                    except Exception as _:
-                        # Ignore deletion errors; lifecycle policies or cron can clean up
-                        pass
-                else:
-                    err = getattr(result, "error", "unknown error")
-                    save_error(job_id, err)
-                    log.warning(f"[worker] job_id={job_id} -> error: {err}")
-                    print(f"[worker] job_id={job_id} -> error: {err}")
+                left = queued_hint()
             except Exception as e:
-                log.error(f"[worker] job_id={job_id} crashed: {type(e).__name__}: {e}\n{traceback.format_exc()}")
-                print(f"[worker] job_id={job_id} crashed: {type(e).__name__}: {e}\n{traceback.format_exc()}")
-                save_error(job_id, f"{type(e).__name__}: {e}")
-        return {"handled": handled, "single": single}
-    
+                log.warning(f"[worker] queue check failed (ignored): {e}")
+                left = 0
+            if left:
+                log.info(f"[worker] {left} jobs still queued, re-waking tick")
+                _schedule_wake(request, f"n={min(left, TICK_MAX_JOBS)}")
+        return {"handled": len(ids), "single": single}
+
+    @app.get("/worker/batch/tick")
+    def worker_batch_tick(request: Request):
+        # 离线批量：提交排队的任务 + 拆分已完成批次的结果（cron 定期调，间隔参考 BATCH_POLL_INTERVAL_SECONDS）
+        base_url = (BLOB_HELPER_BASE or str(request.base_url)).rstrip("/")
+        try:
+            return batch_mode.tick(base_url)
+        except Exception as e:
+            log.error(f"[batch] tick failed: {type(e).__name__}: {e}")
+            raise HTTPException(status_code=502, detail="batch tick failed")
+
+    @app.get("/worker/stats", tags=["meta"])
+    def worker_stats() -> dict:
+        # 常驻引擎各阶段的排队数 / 在跑数 / 完成数，用于调 PIPELINE_*_CONCURRENCY
+        eng = worker_svc.engine
+        return {"engine": eng.stats() if eng is not None else None}
+
     return app
 
 app = create_app()
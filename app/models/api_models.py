@@ -7,10 +7,11 @@ from .extract_models import ExtractResult
 class AnalyzeResponse(BaseModel):
     ok: bool = True
     meta: Dict[str, Any]
-    llm: LlmOutput
+    llm: Optional[LlmOutput] = None   # 失败时为空
     extract_debug: Optional[ExtractResult] = None
     llm_input_debug: Optional[Dict[str, Any]] = None
     error: Optional[str] = None
+    error_code: Optional[str] = None
 
 # === 新增：JSON(Base64) 上传的请求体 ===
 class AnalyzeB64In(BaseModel):
@@ -33,8 +34,33 @@ class EnqueueResponse(BaseModel):
     job_id: str
     status: JobStatus = JobStatus.queued
 
+# --- 批量入队：一次上传多份合同 ---
+from typing import List
+
+class BatchEnqueueItem(BaseModel):
+    pathname: str
+    name: Optional[str] = None
+    size: int = 0
+    pages: int = 0        # 页数（前端已知时传；调度按页数分 small / large 通道，没有就按 size）
+    jurisdiction: Optional[Dict[str, Any]] = None
+
+from typing import Literal
+
+class BatchEnqueueIn(BaseModel):
+    items: List[BatchEnqueueItem]
+    debug: bool = False
+    mode: Literal["realtime", "batch"] = "realtime"   # batch：走 OpenAI Batch API（便宜，最长 24h）
+    priority: Literal["interactive", "bulk"] = "bulk"  # realtime 时的调度通道，见 job_store.pick_lane
+    tenant: Optional[str] = None                       # 租户（同一通道内按租户轮转）；也可用 X-Tenant-Id 头
+
+class BatchEnqueueResponse(BaseModel):
+    job_ids: List[str]
+    status: JobStatus = JobStatus.queued
+
 class JobPollResponse(BaseModel):
     job_id: str
     status: JobStatus
     message: Optional[str] = None
+    error_code: Optional[str] = None  # 失败时的错误码（如预检拒绝：encrypted / no_text / not_a_lease）
+    findings: Optional[List[Any]] = None  # 流式分析中已完成的 findings（临时 id；完成后以 result 为准）
     result: Optional[Any] = None  # 完成后放最终分析 JSON
@@ -1,23 +1,61 @@
 # app/models/extract_models.py
-from pydantic import BaseModel, Field
-from typing import List, Optional
+from array import array
+from pydantic import BaseModel, Field, PrivateAttr
+from typing import List, Optional, Dict, Any
 
 class TextBlock(BaseModel):
     bbox: List[float] = Field(..., description="[x0,y0,x1,y1]")
     text: str
 
+class CompactBlocks:
+    """
+    单页文本块的紧凑存储：bbox 扁平存进 array("d")（每块 4 个 double），
+    文本单独一个 list。只在需要 debug 输出时才转成 TextBlock。
+    """
+    __slots__ = ("bboxes", "texts")
+
+    def __init__(self):
+        self.bboxes = array("d")
+        self.texts: List[str] = []
+
+    def append(self, x0: float, y0: float, x1: float, y1: float, text: str) -> None:
+        self.bboxes.extend((x0, y0, x1, y1))
+        self.texts.append(text)
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+    def bbox(self, i: int) -> List[float]:
+        return list(self.bboxes[4 * i: 4 * i + 4])
+
+    def to_text_blocks(self) -> List[TextBlock]:
+        return [TextBlock(bbox=self.bbox(i), text=t) for i, t in enumerate(self.texts)]
+
+    def __getstate__(self):
+        return (self.bboxes, self.texts)
+
+    def __setstate__(self, state):
+        self.bboxes, self.texts = state
+
 class ExtractPage(BaseModel):
     page: int
     text: str
     blocks: List[TextBlock] = []
+    # 单遍抽取时的块信息（不参与序列化）；debug 时才展开到 blocks
+    _compact: Optional[CompactBlocks] = PrivateAttr(default=None)
+
+    def compact_blocks(self) -> Optional[CompactBlocks]:
+        return self._compact
 
 class ExtractMeta(BaseModel):
     filename: str
     page_count: int
     sha256: str
+    preflight: Optional[Dict[str, Any]] = None   # 预检抽样统计（见 preflight）
 
 class ExtractResult(BaseModel):
     ok: bool = True
     meta: ExtractMeta
     pages: List[ExtractPage]
     error: Optional[str] = None
+    error_code: Optional[str] = None   # 预检拒绝时的错误码（preflight.ENCRYPTED 等）
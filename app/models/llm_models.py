@@ -6,6 +6,11 @@ class LlmInput(BaseModel):
     full_text: str
     jurisdiction_hint: Optional[str] = None
 
+class Evidence(BaseModel):
+    page: Optional[int] = None
+    section: Optional[str] = None
+    quote: Optional[str] = None
+
 class Finding(BaseModel):
     id: Optional[str] = None
     status: str
@@ -15,6 +20,7 @@ class Finding(BaseModel):
     explanation: str
     recommendation: Optional[str] = None
     original_text: str
+    evidence: List[Evidence] = []
     page: Optional[int] = None
     low_confidence: Optional[bool] = None
     tags: Optional[List[str]] = None
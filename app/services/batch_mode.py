@@ -0,0 +1,308 @@
+# app/services/batch_mode.py
+"""
+Offline bulk mode: queued jobs -> one OpenAI Batch API file -> results split back per job.
+
+不赶时间的大批量合同（POST /analyzeLeasesByUrl mode=batch）进 job_store.BQKEY，不走 worker。
+请求体和实时路径完全一样（llm_client_existing.build_request_body：同一个 SYSTEM_PROMPT /
+LEASE_SCHEMA），只是换成 Batch API 提交，价格更低、不占实时的 RPM/TPM。
+
+  submit(base_url)  取出最多 BATCH_MAX_JOBS 个任务（移入 lease:batches:preparing，带截止时间）：
+                    下载 + 解析 + 压缩/分块（线程池），每块一行 JSONL（custom_id = "<job_id>:<chunk>"），
+                    上传后 batches.create；批次记录在 lease:batch:<id>（hash）并登记到 lease:batches:open。
+                    准备中进程崩溃 / tick 超时的任务，过了 BATCH_PREP_TIMEOUT_SECONDS 由 reap_preparing 放回队列
+  poll()            查询未完成的批次；结束的批次先读完 output / error 文件（读失败批次保持 open，下次再试），
+                    再按 custom_id 拆回各任务，多块的用 merge_outputs 合并，写结果缓存 + save_result / save_error + 删 blob
+  tick(base_url)    submit + poll（GET /worker/batch/tick 或 cron 调）
+
+    python -m app.services.batch_mode [submit|poll|run]
+
+本地测试：bench.fake_openai 实现了 /v1/files 和 /v1/batches（--batch-delay 控制完成时间）。
+"""
+import os, sys, json, time, logging, traceback
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Dict, Any, List
+
+from app.services import result_cache, job_store
+from app.services.orchestrator import extract_stage, _from_cache, _source_sha256
+from app.services.chunked_analysis import merge_outputs
+from app.services.llm_client_existing import get_client, build_request_body, parse_output, cached_tokens
+from app.services.metrics import observe_job
+from app.services.blob_store import download_to_tempfile, delete_blob
+from app.services.pipeline import _jurisdiction
+from app.services.preflight import wants_lease_check
+from app.services.job_store import BQKEY, get_job, set_status, save_result, save_error, JOB_TTL
+
+log = logging.getLogger("lease")
+
+BATCH_MAX_JOBS          = int(os.environ.get("BATCH_MAX_JOBS", "500"))
+BATCH_PREP_CONCURRENCY  = int(os.environ.get("BATCH_PREP_CONCURRENCY", "4"))
+BATCH_COMPLETION_WINDOW = os.environ.get("BATCH_COMPLETION_WINDOW", "24h")
+BATCH_POLL_INTERVAL     = float(os.environ.get("BATCH_POLL_INTERVAL_SECONDS", "60"))
+BATCH_PREP_TIMEOUT      = float(os.environ.get("BATCH_PREP_TIMEOUT_SECONDS", "1800"))
+BATCH_ENDPOINT          = "/v1/chat/completions"
+
+BPFX  = "lease:batch:"           # 每个批次的 hash 前缀（status / input_file_id / jobs JSON）
+BOPEN = "lease:batches:open"     # 已提交、还没拆分结果的批次（set）
+BPREP = "lease:batches:preparing" # 已从 BQKEY 取出、还没提交的任务（zset: job_id -> deadline ts）
+
+_TERMINAL = ("completed", "failed", "expired", "cancelled")
+
+def _bkey(batch_id: str) -> str:
+    return f"{BPFX}{batch_id}"
+
+# 原子取 n 个任务并登记到 preparing（带截止时间）+ attempts+1；和 job_store._POP_LUA 同一思路
+# KEYS: queue, preparing   ARGV: n, deadline, hash_prefix
+_TAKE_LUA = """
+local ids = redis.call('LRANGE', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+if #ids == 0 then return ids end
+redis.call('LTRIM', KEYS[1], #ids, -1)
+for _, id in ipairs(ids) do
+    redis.call('ZADD', KEYS[2], ARGV[2], id)
+    redis.call('HINCRBY', ARGV[3] .. id, 'attempts', 1)
+end
+return ids
+"""
+
+# 准备超时的任务：未结束的放回队首，超过最大次数的标记 error（ZREM 当认领，多个 tick 同时跑也安全）
+# KEYS: queue, preparing   ARGV: now, hash_prefix, max_attempts
+_REAP_PREP_LUA = """
+local requeued, failed = 0, 0
+for _, id in ipairs(redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1])) do
+    redis.call('ZREM', KEYS[2], id)
+    local hk = ARGV[2] .. id
+    local status = redis.call('HGET', hk, 'status')
+    if status and status ~= 'done' and status ~= 'error' then
+        if tonumber(redis.call('HGET', hk, 'attempts') or '0') >= tonumber(ARGV[3]) then
+            redis.call('HSET', hk, 'status', 'error', 'message', 'batch preparation timed out too many times', 'finished_at', ARGV[1])
+            failed = failed + 1
+        else
+            redis.call('HSET', hk, 'status', 'queued', 'message', 'batch_requeued')
+            redis.call('LPUSH', KEYS[1], id)
+            requeued = requeued + 1
+        end
+    end
+end
+return {requeued, failed}
+"""
+
+def _take(n: int) -> List[str]:
+    return list(job_store._r.eval(_TAKE_LUA, 2, BQKEY, BPREP, n, time.time() + BATCH_PREP_TIMEOUT, job_store.HPFX))
+
+def reap_preparing() -> Dict[str, int]:
+    """放回准备超时（进程崩溃 / tick 超时）的任务"""
+    requeued, failed = job_store._r.eval(_REAP_PREP_LUA, 2, BQKEY, BPREP, time.time(), job_store.HPFX, job_store.MAX_ATTEMPTS)
+    if requeued or failed:
+        log.warning(f"[batch] REAP preparing requeued={requeued} failed={failed}")
+    return {"requeued": int(requeued), "failed": int(failed)}
+
+# ========= submit =========
+def _prepare(job_id: str, base_url: str) -> Optional[Dict[str, Any]]:
+    """
+    下载 + 解析一个任务，返回 {job_id, lines, job}；job 是写进批次记录的信息。
+    缓存命中 / 解析失败在这里直接结束任务，返回 None。
+    """
+    t_start = time.time()
+    timings: Dict[str, float] = {}
+    data = get_job(job_id)
+    if not data:
+        log.warning(f"[batch] job_id={job_id} hgetall miss")
+        return None
+    filename = data.get("filename") or "unknown.pdf"
+    jurisdiction = _jurisdiction(data)
+    blob_pathname = data.get("blob_pathname")
+    timings["queue_wait"] = max(0.0, t_start - float(data.get("enqueued_at") or data.get("created_at") or t_start))
+    try:
+        set_status(job_id, "running", "batch_preparing")
+        if not blob_pathname:
+            save_error(job_id, "batch mode needs blob_pathname")
+            return None
+        t0 = time.perf_counter()
+        with download_to_tempfile(blob_pathname, base_url=base_url) as bf:
+            timings["download"] = time.perf_counter() - t0
+            key = None
+            if result_cache.CACHE_ENABLED:
+                key = result_cache.cache_key(_source_sha256(None, bf.path, bf.sha256), jurisdiction)
+                hit = result_cache.get(key)
+                if hit is not None:
+                    save_result(job_id, _from_cache(filename, hit).model_dump())
+                    delete_blob(blob_pathname, base_url=base_url)
+                    timings["total"] = time.time() - t_start + timings["queue_wait"]
+                    observe_job(job_id, timings, None, "done", filename=filename)
+                    return None
+            # 不查分页缓存：结果要等批次完成才回来，plan 不跨进程保存
+            extract, llm_inputs, prep, _ = extract_stage(filename, None, path=bf.path, sha256=bf.sha256, timings=timings,
+                                                         lease_check=wants_lease_check(jurisdiction))
+    except Exception as e:
+        log.error(f"[batch] job_id={job_id} prepare crashed: {type(e).__name__}: {e}\n{traceback.format_exc()}")
+        save_error(job_id, f"{type(e).__name__}: {e}")
+        return None
+    if not extract.ok:
+        save_error(job_id, extract.error or "extract failed", code=extract.error_code)
+        return None
+
+    meta = extract.meta.model_dump()
+    meta["llm_chunks"] = len(llm_inputs)
+    if prep:
+        meta["prompt_compaction"] = prep
+    meta["mode"] = "batch"
+    lines = [
+        json.dumps({"custom_id": f"{job_id}:{i}", "method": "POST", "url": BATCH_ENDPOINT,
+                    "body": build_request_body(text, jurisdiction)}, ensure_ascii=False)
+        for i, text in enumerate(llm_inputs)
+    ]
+    return {"job_id": job_id, "lines": lines, "job": {
+        "filename": filename, "chunks": len(llm_inputs), "meta": meta, "cache_key": key,
+        "blob_pathname": blob_pathname, "enqueued_at": t_start - timings["queue_wait"],
+        "timings": {k: round(v, 4) for k, v in timings.items()},
+    }}
+
+def submit(base_url: str = "", *, max_jobs: int = BATCH_MAX_JOBS) -> Optional[str]:
+    """把 BQKEY 里的任务打成一个批次提交；没有任务返回 None，否则返回 batch id"""
+    ids = _take(max_jobs)
+    if not ids:
+        return None
+    log.info(f"[batch] preparing {len(ids)} jobs")
+    with ThreadPoolExecutor(max_workers=max(1, BATCH_PREP_CONCURRENCY)) as pool:
+        prepared = [p for p in pool.map(lambda j: _prepare(j, base_url), ids) if p]
+    if not prepared:
+        job_store._r.zrem(BPREP, *ids)
+        return None
+
+    body = ("\n".join(line for p in prepared for line in p["lines"]) + "\n").encode("utf-8")
+    jobs = {p["job_id"]: p["job"] for p in prepared}
+    try:
+        client = get_client()
+        f = client.files.create(file=("lease-batch.jsonl", body), purpose="batch")
+        b = client.batches.create(input_file_id=f.id, endpoint=BATCH_ENDPOINT,
+                                  completion_window=BATCH_COMPLETION_WINDOW,
+                                  metadata={"source": "lease", "jobs": str(len(jobs))})
+    except Exception as e:
+        # 提交失败：放回队列头，下次 tick 重试（解析结果不缓存，会重新下载解析）
+        log.error(f"[batch] submit failed, requeue {len(jobs)} jobs: {type(e).__name__}: {e}")
+        p = job_store._r.pipeline()
+        p.lpush(BQKEY, *reversed(list(jobs)))
+        p.zrem(BPREP, *ids)
+        p.execute()
+        for job_id in jobs:
+            set_status(job_id, "queued", "batch_requeued")
+        raise
+
+    p = job_store._r.pipeline()
+    p.hset(_bkey(b.id), mapping={"status": b.status, "created_at": int(time.time()), "input_file_id": f.id,
+                                 "requests": sum(j["chunks"] for j in jobs.values()), "jobs": json.dumps(jobs)})
+    p.sadd(BOPEN, b.id)
+    p.zrem(BPREP, *ids)
+    p.execute()
+    for job_id in jobs:
+        set_status(job_id, "running", f"batch_submitted:{b.id}")
+    log.info(f"[batch] submitted {b.id} jobs={len(jobs)} requests={sum(j['chunks'] for j in jobs.values())} "
+             f"bytes={len(body)} window={BATCH_COMPLETION_WINDOW}")
+    return b.id
+
+# ========= poll =========
+def _read_rows(client: Any, file_id: Optional[str]) -> List[Dict[str, Any]]:
+    if not file_id:
+        return []
+    text = client.files.content(file_id).text
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+def _finish_job(job_id: str, job: Dict[str, Any], rows: Dict[int, Dict[str, Any]], batch: Any, base_url: str) -> None:
+    usage = {"prompt_tokens": 0, "completion_tokens": 0, "cached_tokens": 0, "calls": 0, "retries": 0}
+    outs, err = [], None
+    for i in range(job["chunks"]):
+        row = rows.get(i)
+        resp = (row or {}).get("response") or {}
+        if row is None or row.get("error") or resp.get("status_code") != 200:
+            err = (row or {}).get("error") or (resp.get("body") or {}).get("error") or f"batch {batch.status}: no output"
+            break
+        body = resp["body"]
+        u = body.get("usage") or {}
+        usage["calls"] += 1
+        usage["prompt_tokens"] += int(u.get("prompt_tokens") or 0)
+        usage["completion_tokens"] += int(u.get("completion_tokens") or 0)
+        usage["cached_tokens"] += cached_tokens(u)
+        try:
+            outs.append(parse_output(body["choices"][0]["message"]["content"]))
+        except Exception as e:
+            err = f"{type(e).__name__}: {e}"
+            break
+
+    status = "error"
+    if err is None:
+        llm = outs[0] if len(outs) == 1 else merge_outputs(outs)
+        meta = job["meta"]
+        if job.get("cache_key"):
+            result_cache.put(job["cache_key"], {"meta": meta, "llm": llm.model_dump()})
+        save_result(job_id, {"ok": True, "meta": {**meta, "filename": job["filename"], "batch_id": batch.id},
+                             "llm": llm.model_dump(), "extract_debug": None, "llm_input_debug": None, "error": None})
+        delete_blob(job["blob_pathname"], base_url=base_url)
+        status = "done"
+    else:
+        save_error(job_id, f"batch {batch.id}: {err if isinstance(err, str) else json.dumps(err)}")
+
+    timings = dict(job.get("timings") or {})
+    timings["batch_wait"] = max(0.0, time.time() - float(batch.created_at or time.time()))
+    timings["total"] = max(0.0, time.time() - float(job.get("enqueued_at") or time.time()))
+    observe_job(job_id, timings, usage, status, filename=job["filename"])
+
+def _poll_one(batch_id: str, base_url: str) -> str:
+    client = get_client()
+    b = client.batches.retrieve(batch_id)
+    job_store._r.hset(_bkey(batch_id), "status", b.status)
+    if b.status not in _TERMINAL:
+        return b.status
+    # 先读完两个文件再认领：读失败时异常抛给 poll，批次留在 BOPEN，下次 tick 重读（结果已付费，不能丢）
+    by_job: Dict[str, Dict[int, Dict[str, Any]]] = {}
+    for row in _read_rows(client, b.output_file_id) + _read_rows(client, b.error_file_id):
+        job_id, _, idx = str(row.get("custom_id", "")).rpartition(":")
+        by_job.setdefault(job_id, {})[int(idx or 0)] = row
+    # SREM 当认领：多个 tick 同时 poll 时只有一个去拆结果
+    if not job_store._r.srem(BOPEN, batch_id):
+        return b.status
+
+    jobs: Dict[str, Dict[str, Any]] = json.loads(job_store._r.hget(_bkey(batch_id), "jobs") or "{}")
+    for job_id, job in jobs.items():
+        try:
+            _finish_job(job_id, job, by_job.get(job_id, {}), b, base_url)
+        except Exception as e:
+            log.error(f"[batch] job_id={job_id} finish crashed: {type(e).__name__}: {e}\n{traceback.format_exc()}")
+            save_error(job_id, f"{type(e).__name__}: {e}")
+    job_store._r.expire(_bkey(batch_id), JOB_TTL)
+    counts = getattr(b, "request_counts", None)
+    log.info(f"[batch] {batch_id} {b.status} jobs={len(jobs)} counts={counts.model_dump() if counts else None}")
+    return b.status
+
+def poll(base_url: str = "") -> Dict[str, str]:
+    """检查所有未完成的批次，返回 {batch_id: status}"""
+    out: Dict[str, str] = {}
+    for bid in sorted(job_store._r.smembers(BOPEN)):
+        try:
+            out[bid] = _poll_one(bid, base_url)
+        except Exception as e:
+            log.warning(f"[batch] poll {bid} failed: {type(e).__name__}: {e}")
+            out[bid] = "poll_failed"
+    return out
+
+def tick(base_url: str = "") -> Dict[str, Any]:
+    try:
+        reap_preparing()
+    except Exception as e:
+        log.warning(f"[batch] reap failed (ignored): {e}")
+    submitted = submit(base_url)
+    return {"submitted": submitted, "batches": poll(base_url), "queued": job_store._r.llen(BQKEY)}
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    base = os.environ.get("BLOB_HELPER_BASE") or ""
+    cmd = sys.argv[1] if len(sys.argv) > 1 else "run"
+    if cmd == "submit":
+        print(submit(base))
+    elif cmd == "poll":
+        print(json.dumps(poll(base)))
+    else:
+        # run：循环 submit + poll，直到队列和未完成批次都清空
+        while True:
+            print(json.dumps(tick(base)), flush=True)
+            if not job_store._r.llen(BQKEY) and not job_store._r.scard(BOPEN) and not job_store._r.zcard(BPREP):
+                break
+            time.sleep(BATCH_POLL_INTERVAL)
@@ -0,0 +1,192 @@
+# app/services/blob_store.py
+"""
+Python-side blob reader: stream the uploaded PDF straight into a temp file.
+
+PyMuPDF then opens the file by path, so the worker never holds the whole
+document in memory and (with the gcs/local backends) skips the Node hop.
+
+BLOB_BACKEND:
+  gcs    直接读 GCS（与 api/blob/gcs.ts 相同的 GCS_SA_KEY_B64 / GCS_PROJECT_ID / GCS_BUCKET）
+  local  从 BLOB_LOCAL_DIR 读（本地开发 / 测试替身）
+  node   仍走 Node helper /api/blob/fetch，但响应体流式写盘
+默认：配置了 GCS_BUCKET 用 gcs，否则 node。
+
+删除（delete_blob，任务成功后）：gcs 后端和 api/blob/delete.ts 用同一套开关——
+GCS_DELETE_ENABLED（默认关，只记日志跳过）+ GCS_DOC_PREFIX（设置后只删该前缀下的对象）。
+"""
+import os, json, base64, hashlib, logging, tempfile, threading, asyncio
+from contextlib import contextmanager, asynccontextmanager
+from typing import Optional, Iterator, AsyncIterator, Any
+
+import httpx
+
+log = logging.getLogger("lease")
+
+BLOB_BACKEND   = os.environ.get("BLOB_BACKEND") or ("gcs" if os.environ.get("GCS_BUCKET") else "node")
+BLOB_LOCAL_DIR = os.environ.get("BLOB_LOCAL_DIR", "")
+BLOB_TMP_DIR   = os.environ.get("BLOB_TMP_DIR") or None   # None = 系统临时目录
+CHUNK_SIZE     = 1 << 20
+
+# 与 api/blob/delete.ts 一致：默认不删；前缀限制防止按客户端给的任意 pathname 删对象
+GCS_DELETE_ENABLED = os.environ.get("GCS_DELETE_ENABLED", "").strip().lower() in ("1", "true", "yes", "y", "on")
+GCS_DOC_PREFIX     = os.environ.get("GCS_DOC_PREFIX", "").lstrip("/")
+
+_gcs_bucket: Any = None
+_gcs_lock = threading.Lock()
+
+class BlobFile:
+    """下载到本地的 blob：路径 + 大小 + 边下边算的 sha256（供结果缓存用）"""
+    __slots__ = ("path", "size", "sha256", "_h", "_f")
+
+    def __init__(self, path: str, f):
+        self.path = path
+        self.size = 0
+        self.sha256 = ""
+        self._h = hashlib.sha256()
+        self._f = f
+
+    # 让 GCS download_to_file 之类的 API 直接往这里写
+    def write(self, b: bytes) -> int:
+        self._h.update(b)
+        self.size += len(b)
+        return self._f.write(b)
+
+    def _close(self) -> None:
+        self._f.close()
+        self.sha256 = self._h.hexdigest()
+
+def _object_path(pathname: str) -> str:
+    return pathname.strip().lstrip("/")
+
+def _gcs():
+    global _gcs_bucket
+    with _gcs_lock:
+        if _gcs_bucket is None:
+            # requirements.txt 里是必装依赖；放到这里 import 只是让 node / local 后端启动时不用加载它
+            from google.cloud import storage
+            from google.oauth2 import service_account
+            b64 = os.environ.get("GCS_SA_KEY_B64")
+            bucket = os.environ.get("GCS_BUCKET")
+            if not b64:
+                raise RuntimeError("Missing GCS_SA_KEY_B64")
+            if not bucket:
+                raise RuntimeError("Missing GCS_BUCKET")
+            info = json.loads(base64.b64decode(b64).decode("utf-8"))
+            creds = service_account.Credentials.from_service_account_info(info)
+            client = storage.Client(project=os.environ.get("GCS_PROJECT_ID"), credentials=creds)
+            _gcs_bucket = client.bucket(bucket)
+        return _gcs_bucket
+
+def _local_path(pathname: str) -> str:
+    if not BLOB_LOCAL_DIR:
+        raise RuntimeError("Missing BLOB_LOCAL_DIR")
+    root = os.path.realpath(BLOB_LOCAL_DIR)
+    p = os.path.realpath(os.path.join(root, _object_path(pathname)))
+    if not p.startswith(root + os.sep):
+        raise RuntimeError(f"invalid blob pathname: {pathname!r}")
+    return p
+
+def _new_tempfile() -> BlobFile:
+    f = tempfile.NamedTemporaryFile(prefix="lease-", suffix=".pdf", dir=BLOB_TMP_DIR, delete=False)
+    return BlobFile(f.name, f)
+
+def _fetch_direct(pathname: str, bf: BlobFile) -> None:
+    if BLOB_BACKEND == "gcs":
+        blob = _gcs().blob(_object_path(pathname))
+        if not blob.exists():
+            raise FileNotFoundError(f"blob not found: {pathname}")
+        blob.download_to_file(bf, raw_download=True)
+    elif BLOB_BACKEND == "local":
+        with open(_local_path(pathname), "rb") as src:
+            while chunk := src.read(CHUNK_SIZE):
+                bf.write(chunk)
+    else:
+        raise RuntimeError(f"unknown BLOB_BACKEND={BLOB_BACKEND!r}")
+
+def _check_status(r: httpx.Response, body: bytes = b"") -> None:
+    if r.status_code != 200:
+        # surface the first 200 chars of body to logs to know *why* it failed
+        log.error(f"[blob] fetch failed: {r.status_code} body={body[:200]!r}")
+        raise RuntimeError(f"blob fetch failed: {r.status_code}")
+
+@contextmanager
+def download_to_tempfile(pathname: str, *, base_url: str = "") -> Iterator[BlobFile]:
+    """流式下载到临时文件；退出 with 时删除"""
+    bf = _new_tempfile()
+    try:
+        try:
+            if BLOB_BACKEND == "node":
+                with httpx.Client(timeout=30.0) as c:
+                    with c.stream("POST", f"{base_url}/api/blob/fetch", json={"pathname": pathname}) as r:
+                        _check_status(r, r.read() if r.status_code != 200 else b"")
+                        for chunk in r.iter_bytes(CHUNK_SIZE):
+                            bf.write(chunk)
+            else:
+                _fetch_direct(pathname, bf)
+        finally:
+            bf._close()
+        log.info(f"[blob] {BLOB_BACKEND} {pathname!r} -> {bf.path} size={bf.size}")
+        yield bf
+    finally:
+        try:
+            os.unlink(bf.path)
+        except OSError:
+            pass
+
+@asynccontextmanager
+async def adownload_to_tempfile(pathname: str, *, base_url: str = "", http: Optional[httpx.AsyncClient] = None) -> AsyncIterator[BlobFile]:
+    """异步版本：node 后端用 AsyncClient 流式读；gcs/local 放线程里跑"""
+    bf = _new_tempfile()
+    try:
+        try:
+            if BLOB_BACKEND == "node":
+                own = http is None
+                c = http or httpx.AsyncClient()
+                try:
+                    async with c.stream("POST", f"{base_url}/api/blob/fetch", json={"pathname": pathname}, timeout=30.0) as r:
+                        _check_status(r, await r.aread() if r.status_code != 200 else b"")
+                        async for chunk in r.aiter_bytes(CHUNK_SIZE):
+                            bf.write(chunk)
+                finally:
+                    if own:
+                        await c.aclose()
+            else:
+                await asyncio.to_thread(_fetch_direct, pathname, bf)
+        finally:
+            bf._close()
+        log.info(f"[blob] {BLOB_BACKEND} {pathname!r} -> {bf.path} size={bf.size}")
+        yield bf
+    finally:
+        try:
+            os.unlink(bf.path)
+        except OSError:
+            pass
+
+def delete_blob(pathname: str, *, base_url: str = "") -> None:
+    """Best-effort delete；失败只记日志（生命周期策略 / cron 会兜底清理）"""
+    try:
+        if BLOB_BACKEND == "gcs":
+            path = _object_path(pathname)
+            if GCS_DOC_PREFIX and not path.startswith(GCS_DOC_PREFIX):
+                log.warning(f"[blob] delete {path!r} denied: outside GCS_DOC_PREFIX={GCS_DOC_PREFIX!r}")
+                return
+            if not GCS_DELETE_ENABLED:
+                log.info(f"[blob] delete {path!r} skipped: GCS_DELETE_ENABLED is off")
+                return
+            _gcs().blob(path).delete()
+        elif BLOB_BACKEND == "local":
+            os.unlink(_local_path(pathname))
+        else:
+            with httpx.Client(timeout=10.0) as c:
+                c.post(f"{base_url}/api/blob/delete", json={"pathname": pathname})
+    except Exception as e:
+        log.info(f"[blob] delete {pathname!r} failed (ignored): {e}")
+
+async def adelete_blob(pathname: str, *, base_url: str = "", http: Optional[httpx.AsyncClient] = None) -> None:
+    if BLOB_BACKEND == "node" and http is not None:
+        try:
+            await http.post(f"{base_url}/api/blob/delete", json={"pathname": pathname}, timeout=10.0)
+        except Exception as e:
+            log.info(f"[blob] delete {pathname!r} failed (ignored): {e}")
+        return
+    await asyncio.to_thread(delete_blob, pathname, base_url=base_url)
@@ -0,0 +1,143 @@
+# app/services/chunked_analysis.py
+"""
+Map-reduce analysis for long leases.
+
+map:    每个分块（见 llm_prep_adapter.split_llm_chunks）单独调用一次 LLM，
+        并发数受 LLM_CHUNK_CONCURRENCY 限制
+reduce: 合并各块 findings，去重，重新计算 summary（verdict / risk_score）
+"""
+import os, re, asyncio, logging, contextvars, threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Tuple, Optional, Callable
+
+from app.models.llm_models import LlmOutput, LlmSummary, Finding
+from app.services.llm_client_existing import run_leases_check_with_text, arun_leases_check_with_text
+
+log = logging.getLogger("lease")
+
+CHUNK_CONCURRENCY = int(os.environ.get("LLM_CHUNK_CONCURRENCY", "4"))
+
+_SEVERITY_RANK = {"low": 1, "medium": 2, "high": 3}
+_STATUS_RANK = {"ok": 0, "borderline": 1, "needs_detail": 1, "non_compliant": 2}
+# (status, severity) -> 风险分贡献
+_RISK_WEIGHT = {
+    ("non_compliant", "high"): 25, ("non_compliant", "medium"): 15, ("non_compliant", "low"): 8,
+    ("borderline", "high"): 10, ("borderline", "medium"): 6, ("borderline", "low"): 3,
+}
+_WS_RE = re.compile(r"\W+")
+
+def _norm(text: str, n: int = 160) -> str:
+    return _WS_RE.sub(" ", (text or "").lower()).strip()[:n]
+
+def _rank(f: Finding) -> Tuple[int, int]:
+    return _STATUS_RANK.get(f.status, 1), _SEVERITY_RANK.get(f.severity or "medium", 2)
+
+def dedupe_findings(findings: List[Finding]) -> List[Finding]:
+    """
+    同一类别、原文开头相同（或互相包含）的视为重复（块边界附近的条款常被两块都报出），
+    保留更严重的那条。
+    """
+    kept: List[Finding] = []
+    index: Dict[str, List[int]] = {}
+    for f in findings:
+        key = _norm(f.original_text)
+        dup: Optional[int] = None
+        for i in index.get(f.category, []):
+            other = _norm(kept[i].original_text)
+            if key == other or (key and other and (key in _norm(kept[i].original_text, 2000) or other in _norm(f.original_text, 2000))):
+                dup = i
+                break
+        if dup is None:
+            index.setdefault(f.category, []).append(len(kept))
+            kept.append(f)
+        elif _rank(f) > _rank(kept[dup]):
+            kept[dup] = f
+    return kept
+
+def recompute_summary(findings: List[Finding], partial: List[LlmSummary]) -> LlmSummary:
+    weighted = sum(_RISK_WEIGHT.get((f.status, f.severity or "medium"), 0) for f in findings)
+    risk = min(100, max([weighted] + [s.risk_score for s in partial]))
+
+    if any(s.verdict == "do_not_sign" for s in partial) or any(
+        f.status == "non_compliant" and f.severity == "high" for f in findings
+    ):
+        verdict = "do_not_sign"
+    elif any(f.status != "ok" for f in findings) or any(s.verdict == "conditional_ok" for s in partial):
+        verdict = "conditional_ok"
+    else:
+        verdict = "ok"
+
+    jurisdiction = next((s.jurisdiction for s in partial if s.jurisdiction), None)
+    notes = []
+    for s in partial:
+        if s.notes and s.notes not in notes:
+            notes.append(s.notes)
+    return LlmSummary(verdict=verdict, risk_score=risk, jurisdiction=jurisdiction,
+                      notes=" ".join(notes)[:2000] or None)
+
+def merge_outputs(outputs: List[LlmOutput]) -> LlmOutput:
+    findings = dedupe_findings([f for o in outputs for f in o.findings])
+    for i, f in enumerate(findings, 1):
+        f.id = str(i)
+    summary = recompute_summary(findings, [o.summary for o in outputs])
+    log.info(f"[chunked] merged {len(outputs)} chunks -> {len(findings)} findings risk={summary.risk_score}")
+    return LlmOutput(
+        schema_version=outputs[0].schema_version if outputs else "1.0",
+        summary=summary,
+        findings=findings,
+    )
+
+def _gated(on_findings: Optional[Callable[[List[Finding]], None]], failed: threading.Event
+           ) -> Optional[Callable[[List[Finding]], None]]:
+    """一块失败后其余块不再往外发 findings（任务已经 save_error，再 append 会把 findings 列表重新建出来）"""
+    if on_findings is None:
+        return None
+
+    def cb(fs: List[Finding]) -> None:
+        if not failed.is_set():
+            on_findings(fs)
+    return cb
+
+def run_chunked(chunks: List[str], *, jurisdiction: dict | None = None,
+                on_findings: Optional[Callable[[List[Finding]], None]] = None) -> LlmOutput:
+    """on_findings：各块流式产出的 findings（块之间的重复由回调方去重，见 llm_stream.FindingPublisher）"""
+    log.info(f"[chunked] map {len(chunks)} chunks concurrency={CHUNK_CONCURRENCY}")
+    failed = threading.Event()
+    cb = _gated(on_findings, failed)
+    # 每块一份上下文副本，token 统计（track_usage）才能跟到线程里
+    ctxs = [contextvars.copy_context() for _ in chunks]
+    ex = ThreadPoolExecutor(max_workers=max(1, CHUNK_CONCURRENCY))
+    try:
+        futs = [ex.submit(cc.run, run_leases_check_with_text, c, jurisdiction=jurisdiction, on_findings=cb)
+                for cc, c in zip(ctxs, chunks)]
+        outputs = [f.result() for f in futs]
+    except BaseException:
+        # 一块失败：还没开始的块取消，正在跑的块静默跑完
+        failed.set()
+        ex.shutdown(wait=False, cancel_futures=True)
+        raise
+    ex.shutdown()
+    return merge_outputs(outputs)
+
+async def arun_chunked(chunks: List[str], *, jurisdiction: dict | None = None,
+                       on_findings: Optional[Callable[[List[Finding]], None]] = None) -> LlmOutput:
+    log.info(f"[chunked] map {len(chunks)} chunks concurrency={CHUNK_CONCURRENCY}")
+    sem = asyncio.Semaphore(max(1, CHUNK_CONCURRENCY))
+    failed = threading.Event()
+    cb = _gated(on_findings, failed)
+
+    async def one(c: str) -> LlmOutput:
+        async with sem:
+            return await arun_leases_check_with_text(c, jurisdiction=jurisdiction, on_findings=cb)
+
+    tasks = [asyncio.ensure_future(one(c)) for c in chunks]
+    try:
+        outputs = await asyncio.gather(*tasks)
+    except BaseException:
+        # 一块失败就取消其余块的流，免得它们在 save_error 之后继续 append_findings
+        failed.set()
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    return merge_outputs(list(outputs))
@@ -0,0 +1,153 @@
+# app/services/clause_screen.py
+"""
+Local clause pre-screen: send the LLM only the pages that can produce findings.
+
+模型只报告 LEASE_SCHEMA 里 10 个 category 的问题，但长合同里大段是定义、楼规、附录。
+这里在本地给每页的每个段落（按条款/空行切分）打分：
+
+  * 每个 category 一组加权正则（关键词 / 短语 / n-gram）
+  * 法条触发词索引（STATUTE_TERMS，import 时编译成一个正则）：non-refundable、as-is、
+    waives、without notice、regardless of which party prevails 这类几乎必然触发法条审查的措辞，
+    命中即视为相关
+
+页里任一段落得分 ≥ SCREEN_MIN_SCORE（或命中法条触发词）就整页原文送 LLM；其余页换成一行摘要
+（各段开头几个词），保留页码，模型仍知道那里有什么。少于 SCREEN_MIN_PAGES 页的合同不筛，原样发送。
+
+召回率基准：python -m bench.bench_screen（合成语料，埋入的条款原文当标注）。
+"""
+import os, re, logging
+from typing import Dict, Any, List, Tuple
+
+from app.models.extract_models import ExtractResult
+from app.services.prompt_compact import count_tokens
+
+log = logging.getLogger("lease")
+
+SCREEN_ENABLED   = os.environ.get("CLAUSE_SCREEN", "1") not in ("0", "false", "False", "")
+SCREEN_MIN_PAGES = int(os.environ.get("CLAUSE_SCREEN_MIN_PAGES", "4"))
+SCREEN_MIN_SCORE = float(os.environ.get("CLAUSE_SCREEN_MIN_SCORE", "2"))
+DIGEST_CHARS     = int(os.environ.get("CLAUSE_SCREEN_DIGEST_CHARS", "160"))
+
+# category -> [(pattern, weight)]；2 = 单独出现就足以判相关，1 = 需要和别的词一起出现
+CATEGORY_PATTERNS: Dict[str, List[Tuple[str, float]]] = {
+    "money_dates": [
+        (r"\brent\b", 1), (r"late (?:fee|charge)s?", 2), (r"\$\s?\d", 1), (r"\bdue (?:on|date)\b", 1),
+        (r"returned[- ]check|nsf fee|insufficient funds", 2), (r"per (?:day|diem)", 1), (r"\bprorat", 2),
+        (r"rent increase|increase (?:the|in) rent", 2), (r"on or before the \w+ day", 2),
+    ],
+    "deposit_return": [
+        (r"security deposit", 2), (r"\bdeposit", 1), (r"\brefund", 1), (r"wear and tear", 2),
+        (r"itemi[sz]ed", 2), (r"deduct", 1), (r"move[- ]out inspection", 2),
+    ],
+    "renewal": [
+        (r"\brenew", 2), (r"automatic(?:ally)? (?:renew|extend)", 2), (r"month[- ]to[- ]month", 2),
+        (r"\bholdover|holds? over", 2), (r"\bextension\b", 1), (r"\bexpir", 1),
+    ],
+    "repairs_entry": [
+        (r"\brepair", 2), (r"habitab", 2), (r"\benter(?:s|ing)? the premises|right (?:of|to) entry|\bentry\b", 2),
+        (r"\bmaintenance|\bmaintain", 1), (r"\bas[- ]is\b", 2), (r"\bnotice\b", 0.5), (r"\binspect", 1),
+        (r"\bmold|\bpest|\bvermin", 2),
+    ],
+    "termination": [
+        (r"\bterminat", 2), (r"\bevict", 2), (r"\bdefault", 1), (r"\bvacate", 1), (r"\bsurrender", 1),
+        (r"early termination|break (?:the|this) lease", 2), (r"\bforfeit", 2), (r"notice to quit", 2),
+    ],
+    "insurance_indemnity": [
+        (r"\binsurance\b|\binsured\b", 2), (r"\bindemnif", 2), (r"hold (?:\w+ )?harmless", 2), (r"\bliab", 1),
+        (r"\bdamages?\b", 0.5), (r"\bnegligen", 1),
+    ],
+    "rights_limits": [
+        (r"\bwaive|\bwaiver", 1), (r"\bsublet|\bsublease|\bassign", 2), (r"\bpets?\b|\banimals?\b", 2),
+        (r"\bguests?\b", 1), (r"quiet enjoyment", 2), (r"\bdiscriminat", 2), (r"\bsmok", 1),
+        (r"\balteration|\bmodif", 1), (r"\bparking|\btow(?:ed|ing)?\b", 1),
+    ],
+    "utilities": [
+        (r"\butilit", 2), (r"\belectric", 1), (r"\bgas\b", 1), (r"\bwater\b", 1), (r"\bsewer", 1),
+        (r"\btrash|\bgarbage", 0.5), (r"\binternet|\bcable\b", 1),
+    ],
+    "dispute": [
+        (r"attorney'?s?'? fees", 2), (r"\barbitrat", 2), (r"jury trial", 2), (r"prevailing party", 2),
+        (r"\bcourt\b|\blitigation|\bsue\b|\blawsuit", 1), (r"\bdisputes?\b", 1), (r"\bmediat", 1),
+    ],
+    "other": [
+        (r"\blead[- ]based paint", 2), (r"\bdisclos", 1), (r"\bbed ?bugs?", 2), (r"\bflood", 1),
+    ],
+}
+
+# 法条触发词索引：措辞本身就常见于违法/可撤销条款，命中直接判相关
+STATUTE_TERMS: Dict[str, str] = {
+    "non-refundable": "deposit_return", "nonrefundable": "deposit_return",
+    "normal wear and tear": "deposit_return",
+    "as-is": "repairs_entry", "waives any right": "rights_limits", "waive the right": "rights_limits",
+    "waives the right": "rights_limits", "without notice": "repairs_entry", "with or without notice": "repairs_entry",
+    "at any time": "repairs_entry", "for any reason": "termination", "immediately terminate": "termination",
+    "terminate this lease immediately": "termination", "retain all prepaid": "termination",
+    "regardless of which party prevails": "dispute", "jury trial": "dispute", "confession of judgment": "dispute",
+    "confess judgment": "dispute", "liquidated damages": "money_dates", "without limit": "money_dates",
+    "automatically renew": "renewal", "self-help": "termination", "change the locks": "termination",
+    "lockout": "termination", "hold harmless": "insurance_indemnity", "indemnify": "insurance_indemnity",
+    "retaliat": "rights_limits", "habitability": "repairs_entry",
+}
+
+_COMPILED: Dict[str, List[Tuple[re.Pattern, float]]] = {
+    cat: [(re.compile(p, re.I), w) for p, w in pats] for cat, pats in CATEGORY_PATTERNS.items()
+}
+_STATUTE_RE = re.compile("|".join(re.escape(t) for t in sorted(STATUTE_TERMS, key=len, reverse=True)), re.I)
+# 与 llm_prep_adapter._SECTION_RE 一致：空行，或 "12." / "Section 4" / "ARTICLE IV" 开头的行
+_BLOCK_RE = re.compile(r"\n\s*\n|\n(?=\s*(?:\d{1,3}\.\s|section\s+\d|article\s+[ivxlc\d]+)\b)", re.I)
+_WS_RE = re.compile(r"\s+")
+
+def score_block(text: str) -> Dict[str, float]:
+    """一个段落对各 category 的得分；法条触发词给对应 category 加 SCREEN_MIN_SCORE"""
+    scores: Dict[str, float] = {}
+    for cat, pats in _COMPILED.items():
+        s = sum(w for rx, w in pats if rx.search(text))
+        if s:
+            scores[cat] = s
+    for m in _STATUTE_RE.finditer(text):
+        cat = STATUTE_TERMS.get(m.group(0).lower(), "other")
+        scores[cat] = scores.get(cat, 0.0) + SCREEN_MIN_SCORE
+    return scores
+
+def score_page(text: str) -> Tuple[Dict[str, float], List[str]]:
+    """返回（各 category 的最高段落得分, 段落列表）"""
+    blocks = [b.strip() for b in _BLOCK_RE.split(text or "") if b and b.strip()]
+    best: Dict[str, float] = {}
+    for b in blocks:
+        for cat, s in score_block(b).items():
+            if s > best.get(cat, 0.0):
+                best[cat] = s
+    return best, blocks
+
+def _digest(blocks: List[str]) -> str:
+    heads = [" ".join(_WS_RE.sub(" ", b).split(" ")[:8]) for b in blocks]
+    d = "; ".join(h for h in heads if h)
+    return d if len(d) <= DIGEST_CHARS else d[:DIGEST_CHARS].rstrip() + " …"
+
+def screen(extract: ExtractResult) -> Tuple[ExtractResult, Dict[str, Any]]:
+    """
+    extract 是压缩后的结果。返回（不相关页换成摘要的副本, 统计）；不满足条件时原样返回、统计为空。
+    """
+    if not SCREEN_ENABLED or len(extract.pages) < SCREEN_MIN_PAGES:
+        return extract, {}
+    pages, kept, hits = [], 0, {}
+    for p in extract.pages:
+        best, blocks = score_page(p.text or "")
+        relevant = {c: s for c, s in best.items() if s >= SCREEN_MIN_SCORE}
+        if relevant:
+            kept += 1
+            for c in relevant:
+                hits[c] = hits.get(c, 0) + 1
+            pages.append(p)
+        else:
+            digest = _digest(blocks)
+            text = f"(summarized: no lease-risk clauses found locally) {digest}" if digest else ""
+            # 签字页 / 缩写页这类短页，摘要比原文还长，就原样留着
+            pages.append(p if len(text) >= len(p.text or "") else p.model_copy(update={"text": text}))
+    screened = extract.model_copy(update={"pages": pages})
+    before = count_tokens("\n".join(p.text or "" for p in extract.pages))
+    after = count_tokens("\n".join(p.text or "" for p in pages))
+    stats = {"pages_sent": kept, "pages_digested": len(pages) - kept, "tokens_before": before,
+             "tokens_after": after, "category_pages": dict(sorted(hits.items()))}
+    log.info(f"[screen] {extract.meta.filename!r} pages {kept}/{len(pages)} sent, tokens {before} -> {after}")
+    return screened, stats
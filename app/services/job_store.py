@@ -1,88 +1,457 @@
 # app/services/job_store.py
-import os, json, time, uuid, logging
-from typing import Optional, Dict, Any, List
+import os, re, json, time, uuid, logging
+from typing import Optional, Dict, Any, List, AsyncIterator
 import redis
+import redis.asyncio as aredis
 
 log = logging.getLogger("lease")
 
 REDIS_URL = os.environ["REDIS_URL"]
 JOB_TTL   = int(os.environ.get("JOB_TTL_SECONDS", "86400"))
 
-QKEY = "lease:jobs:queue"   # 待处理队列（list）
-HPFX = "lease:job:"         # 每个任务的 hash 前缀
+# 取出任务后的可见性超时：超过该时间未 ack/续租，reaper 会把任务放回队列
+VISIBILITY_TIMEOUT = int(os.environ.get("JOB_VISIBILITY_TIMEOUT_SECONDS", "600"))
+MAX_ATTEMPTS       = int(os.environ.get("JOB_MAX_ATTEMPTS", "3"))
+
+QKEY = "lease:jobs:queue"        # 旧版单一 FIFO 队列（list）：升级前 / 旧版本实例入队的任务，取任务时先排空
+PKEY = "lease:jobs:processing"   # 已取出、处理中（list）
+LKEY = "lease:jobs:leases"       # 租约到期时间（zset: job_id -> deadline ts）
+HPFX = "lease:job:"              # 每个任务的 hash 前缀
+EPFX = "lease:job:events:"       # 每个任务的 pub/sub 频道前缀（SSE 推送进度）
+BQKEY = "lease:jobs:batch"       # 离线批量（Batch API）待提交队列（list），见 batch_mode
+FPFX = "lease:job:findings:"     # 流式分析中已完成的 findings（list，每项一个 JSON），终态时删除，见 llm_stream
+
+LANE_PFX = "lease:jobs:lane:"    # 优先级通道：lane:<lane> 有任务的租户轮转表（list），lane:<lane>:<tenant> 该租户的任务（list）
+RKEY = "lease:jobs:ready"        # 就绪令牌（list，每个排队任务一个 "1"）：常驻引擎 BLPOP 在上面等，入队即唤醒
+WKEY = "lease:jobs:wrr"          # 通道间平滑加权轮询的状态（hash: lane -> current weight）
+
+PARTIAL_MSG = "partial_findings" # partial findings 事件的 message
+
+# 优先级通道：interactive = 单份上传、有人在前端等；bulk = 批量入队。再按页数（未知时按文件大小）分 small / large。
+# 取任务时非空通道按权重做平滑加权轮询（权重 8:4:2:1 = 每 15 个任务里 bulk_large 至少 1 个，不会饿死），
+# 同一通道内按租户轮转，一个租户的 150 份批量不会挡住别的租户。
+LANES = ("interactive_small", "interactive_large", "bulk_small", "bulk_large")
+
+def _parse_weights(spec: str) -> Dict[str, int]:
+    w = {lane: 1 for lane in LANES}
+    for part in spec.split(","):
+        k, _, v = part.partition("=")
+        if k.strip() in w and v.strip():
+            w[k.strip()] = max(1, int(v))
+    return w
+
+LANE_WEIGHTS = _parse_weights(os.environ.get("QUEUE_LANE_WEIGHTS", "interactive_small=8,interactive_large=4,bulk_small=2,bulk_large=1"))
+LARGE_PAGES  = int(os.environ.get("QUEUE_LARGE_PAGES", "30"))
+LARGE_BYTES  = int(os.environ.get("QUEUE_LARGE_BYTES", "3000000"))   # 请求里没有页数时按文件大小判
+DEFAULT_TENANT = "default"
+
+_TENANT_RE = re.compile(r"[^\w.@-]+")
 
 _r = redis.Redis.from_url(REDIS_URL, decode_responses=True)
+_ar: Optional[aredis.Redis] = None   # 异步客户端：worker engine 阻塞取任务用，按需创建
+
+def _async_client() -> aredis.Redis:
+    global _ar
+    if _ar is None:
+        _ar = aredis.Redis.from_url(REDIS_URL, decode_responses=True)
+    return _ar
 
 def _hkey(job_id: str) -> str:
     return f"{HPFX}{job_id}"
 
+def _fkey(job_id: str) -> str:
+    return f"{FPFX}{job_id}"
+
+def events_channel(job_id: str) -> str:
+    return f"{EPFX}{job_id}"
+
+def _event(job_id: str, status: str, message: Optional[str] = None, result_json: Optional[str] = None,
+           findings_json: Optional[List[str]] = None) -> str:
+    ev = json.dumps({"job_id": job_id, "status": status, "message": message}, ensure_ascii=False)
+    if findings_json is not None:
+        ev = ev[:-1] + ', "findings": [' + ",".join(findings_json) + "]}"
+    if result_json is not None:
+        # 结果已是 JSON 字符串，直接拼进去，不再解析/重编码
+        ev = ev[:-1] + ', "result": ' + result_json + "}"
+    return ev
+
+def is_partial_event(ev: str) -> bool:
+    """SSE 端区分事件类型用：partial findings 事件（_event 的固定格式，不用解析）"""
+    return f'"message": "{PARTIAL_MSG}"' in ev
+
+# 入通道：租户队列从空变非空时把租户挂到轮转表尾部；每个任务一个就绪令牌
+# KEYS: tenant queue, lane ring, ready   ARGV: tenant, job_id...
+_PUSH_LUA = """
+local was_empty = redis.call('LLEN', KEYS[1]) == 0
+for i = 2, #ARGV do
+    redis.call('RPUSH', KEYS[1], ARGV[i])
+    redis.call('RPUSH', KEYS[3], '1')
+end
+if was_empty then redis.call('RPUSH', KEYS[2], ARGV[1]) end
+return #ARGV - 1
+"""
+
+# 原子批量公平取任务，一次往返：
+#   先排空旧版 QKEY；之后在非空通道间做平滑加权轮询（nginx smooth WRR，状态在 wrr hash），
+#   选中通道内取轮转表头部租户的一个任务，该租户还有任务就挂回表尾。
+# 取到的任务移入 processing + 记租约 + attempts+1；tokens=1 时每取一个顺带消耗一个就绪令牌
+# KEYS: queue, processing, leases, ready, wrr   ARGV: max_n, deadline, hash_prefix, lane_prefix, tokens, lane1, weight1, ...
+_POP_LUA = """
+local lanes = {}
+for i = 6, #ARGV, 2 do lanes[#lanes + 1] = {ARGV[i], tonumber(ARGV[i + 1])} end
+local ids = {}
+for k = 1, tonumber(ARGV[1]) do
+    local id = redis.call('LPOP', KEYS[1])
+    if not id then
+        local best, best_cw, total, cws = nil, nil, 0, {}
+        for _, l in ipairs(lanes) do
+            if redis.call('LLEN', ARGV[4] .. l[1]) > 0 then
+                local cw = tonumber(redis.call('HGET', KEYS[5], l[1]) or '0') + l[2]
+                cws[l[1]] = cw
+                total = total + l[2]
+                if not best_cw or cw > best_cw then best, best_cw = l[1], cw end
+            end
+        end
+        if not best then break end
+        cws[best] = cws[best] - total
+        for lane, cw in pairs(cws) do redis.call('HSET', KEYS[5], lane, cw) end
+        local ring = ARGV[4] .. best
+        local tenant = redis.call('LPOP', ring)
+        local q = ring .. ':' .. tenant
+        id = redis.call('LPOP', q)
+        if redis.call('LLEN', q) > 0 then redis.call('RPUSH', ring, tenant) end
+    end
+    if id then
+        redis.call('RPUSH', KEYS[2], id)
+        redis.call('ZADD', KEYS[3], ARGV[2], id)
+        redis.call('HINCRBY', ARGV[3] .. id, 'attempts', 1)
+        if ARGV[5] == '1' then redis.call('LPOP', KEYS[4]) end
+        ids[#ids + 1] = id
+    end
+end
+return ids
+"""
+
+# 按 id 认领（/worker/tick?single=）：只有还在队列里的才能认领，防止重复处理
+# 通道 / 租户从任务 hash 里读；租户队列因此变空时从轮转表摘掉；没有通道字段的去旧版 QKEY 里找
+# KEYS: queue, processing, leases, ready   ARGV: job_id, deadline, hash_prefix, lane_prefix
+_CLAIM_LUA = """
+local hk = ARGV[3] .. ARGV[1]
+local lane, tenant = redis.call('HGET', hk, 'lane'), redis.call('HGET', hk, 'tenant')
+local removed = 0
+if lane and tenant then
+    local ring = ARGV[4] .. lane
+    local q = ring .. ':' .. tenant
+    removed = redis.call('LREM', q, 1, ARGV[1])
+    if removed > 0 and redis.call('LLEN', q) == 0 then redis.call('LREM', ring, 1, tenant) end
+end
+if removed == 0 then removed = redis.call('LREM', KEYS[1], 1, ARGV[1]) end
+if removed == 0 then return 0 end
+redis.call('LPOP', KEYS[4])
+redis.call('RPUSH', KEYS[2], ARGV[1])
+redis.call('ZADD', KEYS[3], ARGV[2], ARGV[1])
+redis.call('HINCRBY', ARGV[3] .. ARGV[1], 'attempts', 1)
+return 1
+"""
+
+# 回收过期租约：未完成的放回原通道该租户的队首（租户挂到轮转表头部），超过最大次数的标记 error；
+# 顺带给 processing 里没有租约的孤儿（旧版本 BLMOVE 后进程崩溃）补一个租约
+# KEYS: queue, processing, leases, ready   ARGV: now, hash_prefix, max_attempts, visibility, lane_prefix
+_REAP_LUA = """
+local requeued, failed = 0, 0
+local expired = redis.call('ZRANGEBYSCORE', KEYS[3], '-inf', ARGV[1])
+for _, id in ipairs(expired) do
+    redis.call('ZREM', KEYS[3], id)
+    redis.call('LREM', KEYS[2], 1, id)
+    local hk = ARGV[2] .. id
+    local status = redis.call('HGET', hk, 'status')
+    if status and status ~= 'done' and status ~= 'error' then
+        local attempts = tonumber(redis.call('HGET', hk, 'attempts') or '0')
+        if attempts >= tonumber(ARGV[3]) then
+            redis.call('HSET', hk, 'status', 'error', 'message', 'worker lease expired too many times', 'finished_at', ARGV[1])
+            failed = failed + 1
+        else
+            redis.call('HSET', hk, 'status', 'queued', 'message', 'requeued after worker lease expired')
+            local lane, tenant = redis.call('HGET', hk, 'lane'), redis.call('HGET', hk, 'tenant')
+            if lane and tenant then
+                local ring = ARGV[5] .. lane
+                if redis.call('LPUSH', ring .. ':' .. tenant, id) == 1 then redis.call('LPUSH', ring, tenant) end
+            else
+                redis.call('LPUSH', KEYS[1], id)
+            end
+            redis.call('RPUSH', KEYS[4], '1')
+            requeued = requeued + 1
+        end
+    end
+end
+for _, id in ipairs(redis.call('LRANGE', KEYS[2], 0, -1)) do
+    if not redis.call('ZSCORE', KEYS[3], id) then
+        redis.call('ZADD', KEYS[3], tonumber(ARGV[1]) + tonumber(ARGV[4]), id)
+    end
+end
+return {requeued, failed}
+"""
+
+# 各通道排队数 + 最老任务已等待秒数（各租户队首里最早的 enqueued_at）；最后一项是旧版 QKEY 的长度
+# KEYS: queue   ARGV: now, hash_prefix, lane_prefix, lane...
+_LANE_STATS_LUA = """
+local out = {}
+for i = 4, #ARGV do
+    local ring = ARGV[3] .. ARGV[i]
+    local depth, oldest = 0, 0
+    for _, t in ipairs(redis.call('LRANGE', ring, 0, -1)) do
+        local q = ring .. ':' .. t
+        depth = depth + redis.call('LLEN', q)
+        local head = redis.call('LINDEX', q, 0)
+        local at = head and tonumber(redis.call('HGET', ARGV[2] .. head, 'enqueued_at'))
+        if at then oldest = math.max(oldest, tonumber(ARGV[1]) - at) end
+    end
+    out[#out + 1] = tostring(depth)
+    out[#out + 1] = tostring(oldest)
+end
+out[#out + 1] = tostring(redis.call('LLEN', KEYS[1]))
+return out
+"""
+
+_push_script  = _r.register_script(_PUSH_LUA)
+_pop_script   = _r.register_script(_POP_LUA)
+_claim_script = _r.register_script(_CLAIM_LUA)
+_reap_script  = _r.register_script(_REAP_LUA)
+_apop_script = None   # bpop_job 用的 _POP_LUA，注册在异步客户端上（第一次调用时）
+
 def new_job_id() -> str:
     return uuid.uuid4().hex
 
-def enqueue_job(filename: str, b64: str, debug: bool) -> str:
-    """
-    将任务写入：hash 保存任务内容 + list 入队
-    注意：Redis 不接受 bool，统一转 int(0/1) 或 str
-    """
-    job_id = new_job_id()
-    hk = _hkey(job_id)
+def pick_lane(priority: Optional[str] = None, *, size: int = 0, pages: int = 0) -> str:
+    """priority：interactive / bulk（其它值按 interactive）；页数已知按页数分大小，否则按字节数"""
+    kind = "bulk" if priority == "bulk" else "interactive"
+    large = pages >= LARGE_PAGES if pages else size >= LARGE_BYTES
+    return f"{kind}_{'large' if large else 'small'}"
+
+def normalize_tenant(tenant: Optional[str]) -> str:
+    """租户名要拼进 key：只留 [\w.@-]，最长 64；空的算 default"""
+    t = _TENANT_RE.sub("_", (tenant or "").strip())[:64]
+    return t or DEFAULT_TENANT
+
+def _lane_keys(lane: str, tenant: str) -> List[str]:
+    ring = f"{LANE_PFX}{lane}"
+    return [f"{ring}:{tenant}", ring, RKEY]
+
+def _pop_args(max_n: int, *, tokens: bool) -> List[Any]:
+    args: List[Any] = [max_n, time.time() + VISIBILITY_TIMEOUT, HPFX, LANE_PFX, int(tokens)]
+    for lane in LANES:
+        args += [lane, LANE_WEIGHTS[lane]]
+    return args
+
+def _job_payload(job_id: str, filename: str, b64: str, debug: bool, fields: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    now = time.time()
     payload: Dict[str, Any] = {
         "job_id": str(job_id),
         "filename": str(filename),
         "b64": str(b64),
         "debug": int(bool(debug)),        # 关键修复：bool -> 0/1
         "status": "queued",
-        "created_at": int(time.time()),
+        "created_at": int(now),
+        "enqueued_at": round(now, 3),     # 排队耗时用（秒，带小数）
     }
-    log.info(f"[redis] HSET {hk} (ttl={JOB_TTL}) + RPUSH {QKEY} job_id={job_id}")
+    if fields:
+        payload.update({k: v for k, v in fields.items() if v is not None})
+    return payload
+
+def enqueue_job(filename: str, b64: str, debug: bool, *, fields: Optional[Dict[str, Any]] = None,
+                lane: str = "interactive_small", tenant: Optional[str] = None) -> str:
+    """
+    将任务写入：hash 保存任务内容 + 入 lane 通道里该租户的队列（见 pick_lane）
+    注意：Redis 不接受 bool，统一转 int(0/1) 或 str
+    fields：额外写进 hash 的字段（如 blob_pathname / jurisdiction），和入队在同一次往返里
+    """
+    job_id = new_job_id()
+    hk = _hkey(job_id)
+    tenant = normalize_tenant(tenant)
+    payload = _job_payload(job_id, filename, b64, debug, {**(fields or {}), "lane": lane, "tenant": tenant})
+    log.info(f"[redis] HSET {hk} (ttl={JOB_TTL}) + PUSH lane={lane} tenant={tenant} job_id={job_id}")
     p = _r.pipeline()
     p.hset(hk, mapping=payload)
     p.expire(hk, JOB_TTL)
-    p.rpush(QKEY, job_id)
+    _push_script(keys=_lane_keys(lane, tenant), args=[tenant, job_id], client=p)
     p.execute()
     return job_id
 
-def pop_jobs(max_n: int = 1) -> List[str]:
+def enqueue_jobs(jobs: List[Dict[str, Any]], *, queue: Optional[str] = None, tenant: Optional[str] = None) -> List[str]:
     """
-    先 LLEN 再 LPOP，减少无效命令；返回弹出的 job_id 列表
+    批量入队：每个元素 {filename, debug?, fields?, lane?}（lane 默认 bulk_small），同属 tenant。
+    所有 hash 和入队放在同一个 MULTI/EXEC 里，一次往返，要么全进要么全不进。
+    queue=BQKEY 时进离线批量队列（不走 worker，由 batch_mode 提交到 Batch API）。
     """
-    n = min(max_n, int(_r.llen(QKEY)))
-    log.info(f"[redis] LLEN {QKEY} = {n}")
     ids: List[str] = []
-    for _ in range(n):
-        j = _r.lpop(QKEY)
-        if j:
-            ids.append(j)
-    log.info(f"[redis] LPOP {QKEY} -> {ids}")
+    by_lane: Dict[str, List[str]] = {}
+    tenant = normalize_tenant(tenant)
+    p = _r.pipeline()
+    for j in jobs:
+        job_id = new_job_id()
+        ids.append(job_id)
+        hk = _hkey(job_id)
+        fields = j.get("fields")
+        if queue is None:
+            lane = j.get("lane") or "bulk_small"
+            by_lane.setdefault(lane, []).append(job_id)
+            fields = {**(fields or {}), "lane": lane, "tenant": tenant}
+        p.hset(hk, mapping=_job_payload(job_id, j["filename"], "", j.get("debug", False), fields))
+        p.expire(hk, JOB_TTL)
+    if ids:
+        if queue is not None:
+            p.rpush(queue, *ids)
+        for lane, lane_ids in by_lane.items():
+            _push_script(keys=_lane_keys(lane, tenant), args=[tenant, *lane_ids], client=p)
+        p.execute()
+    where = queue or ",".join(f"{lane}x{len(v)}" for lane, v in by_lane.items())
+    log.info(f"[redis] batch HSET x{len(ids)} + PUSH {where} tenant={tenant} (1 round trip)")
     return ids
 
+def pop_jobs(max_n: int = 1) -> List[str]:
+    """
+    原子批量取出最多 max_n 个任务（Lua，一次往返），同时移入 processing 并记租约。
+    处理完必须 ack_job；否则租约到期后由 reap_expired 放回队列。
+    """
+    ids: List[str] = list(_pop_script(keys=[QKEY, PKEY, LKEY, RKEY, WKEY], args=_pop_args(max_n, tokens=True), client=_r))
+    log.info(f"[redis] POP(lua) lanes n<={max_n} -> {ids}")
+    return ids
+
+async def bpop_job(timeout: int = 5) -> Optional[str]:
+    """
+    BLPOP 就绪令牌阻塞等待，再用 _POP_LUA 公平地取一个任务（原子移入 processing 并记租约）；
+    超时返回 None（调用方借此检查是否该退出）。
+    超时时也不阻塞地取一次：旧版 QKEY 里的任务没有令牌，令牌万一丢了任务也不会卡住。
+    """
+    global _apop_script
+    ar = _async_client()
+    # 脚本注册在异步客户端上，之后走 EVALSHA（_ar 可能被换掉，换了就重新注册）
+    if _apop_script is None or _apop_script.registered_client is not ar:
+        _apop_script = ar.register_script(_POP_LUA)
+    token = await ar.blpop(RKEY, timeout)
+    ids = await _apop_script(keys=[QKEY, PKEY, LKEY, RKEY, WKEY], args=_pop_args(1, tokens=not token))
+    if not ids:
+        return None
+    log.info(f"[redis] POP(lua) lanes -> {PKEY} {ids[0]}")
+    return ids[0]
+
+def claim_job(job_id: str) -> bool:
+    """按 id 认领仍在队列中的任务；已被别的 worker 取走则返回 False"""
+    ok = bool(_claim_script(keys=[QKEY, PKEY, LKEY, RKEY],
+                            args=[job_id, time.time() + VISIBILITY_TIMEOUT, HPFX, LANE_PFX], client=_r))
+    log.info(f"[redis] CLAIM {job_id} -> {ok}")
+    return ok
+
+def ack_job(job_id: str) -> None:
+    """任务处理完（成功或失败都算），释放租约"""
+    p = _r.pipeline()
+    p.lrem(PKEY, 1, job_id)
+    p.zrem(LKEY, job_id)
+    p.execute()
+    log.info(f"[redis] ACK {job_id}")
+
+def extend_leases(job_ids: List[str]) -> None:
+    """续租（心跳）：长任务定期调用，避免被 reaper 误回收"""
+    if not job_ids:
+        return
+    deadline = time.time() + VISIBILITY_TIMEOUT
+    _r.zadd(LKEY, {j: deadline for j in job_ids}, xx=True)
+
+def reap_expired() -> Dict[str, int]:
+    """回收过期租约；多个 worker 同时调用也安全（Lua 原子执行）"""
+    requeued, failed = _reap_script(keys=[QKEY, PKEY, LKEY, RKEY],
+                                    args=[time.time(), HPFX, MAX_ATTEMPTS, VISIBILITY_TIMEOUT, LANE_PFX], client=_r)
+    if requeued or failed:
+        log.warning(f"[redis] REAP requeued={requeued} failed={failed}")
+    return {"requeued": int(requeued), "failed": int(failed)}
+
+def queued_hint() -> int:
+    """排队任务数的近似值（就绪令牌数 + 旧版 QKEY 长度），一次往返；/worker/tick 判断要不要接着唤醒"""
+    p = _r.pipeline(transaction=False)
+    p.llen(RKEY)
+    p.llen(QKEY)
+    return sum(int(n or 0) for n in p.execute())
+
+def lane_stats() -> Dict[str, Dict[str, float]]:
+    """各通道 {depth: 排队数, oldest: 最老任务已等待秒数}，一次往返；旧版 QKEY 里有任务时多一项 legacy"""
+    res = _r.eval(_LANE_STATS_LUA, 1, QKEY, time.time(), HPFX, LANE_PFX, *LANES)
+    out = {lane: {"depth": float(res[2 * i]), "oldest": float(res[2 * i + 1])} for i, lane in enumerate(LANES)}
+    if int(res[-1]):
+        out["legacy"] = {"depth": float(res[-1]), "oldest": 0.0}
+    return out
+
 def set_status(job_id: str, status: str, message: Optional[str] = None):
     hk = _hkey(job_id)
     m: Dict[str, Any] = {"status": str(status)}
     if message is not None:
         m["message"] = str(message)       # 保底转字符串
-    log.info(f"[redis] HSET {hk} status={status} msg={message!r}")
-    _r.hset(hk, mapping=m)
+    log.info(f"[redis] HSET {hk} status={status} msg={message!r} + PUBLISH")
+    p = _r.pipeline(transaction=False)
+    p.hset(hk, mapping=m)
+    p.publish(events_channel(job_id), _event(job_id, status, message))
+    p.execute()
 
 def save_result(job_id: str, result_obj: Any):
     hk = _hkey(job_id)
     # result 序列化为 JSON 字符串
     result_json = json.dumps(result_obj, ensure_ascii=False)
-    log.info(f"[redis] HSET {hk} status=done + result(len)={len(result_json)}")
-    _r.hset(hk, mapping={
+    log.info(f"[redis] HSET {hk} status=done + result(len)={len(result_json)} + PUBLISH")
+    p = _r.pipeline(transaction=False)
+    p.hset(hk, mapping={
         "status": "done",
         "result": result_json,
         "finished_at": int(time.time()),
     })
+    p.delete(_fkey(job_id))   # 完整结果取代 partial findings
+    p.publish(events_channel(job_id), _event(job_id, "done", None, result_json))
+    p.execute()
 
-def save_error(job_id: str, err: str):
+def save_error(job_id: str, err: str, *, code: Optional[str] = None):
+    """code：机器可读的错误码（如预检拒绝 encrypted / no_text），前端按它给出提示"""
     hk = _hkey(job_id)
-    log.warning(f"[redis] HSET {hk} status=error msg={err!r}")
-    _r.hset(hk, mapping={
-        "status": "error",
-        "message": str(err),
-        "finished_at": int(time.time()),
-    })
+    log.warning(f"[redis] HSET {hk} status=error code={code} msg={err!r} + PUBLISH")
+    m: Dict[str, Any] = {"status": "error", "message": str(err), "finished_at": int(time.time())}
+    if code:
+        m["error_code"] = str(code)
+    p = _r.pipeline(transaction=False)
+    p.hset(hk, mapping=m)
+    p.delete(_fkey(job_id))
+    p.publish(events_channel(job_id), _event(job_id, "error", str(err)))
+    p.execute()
+
+def append_findings(job_id: str, findings: List[Dict[str, Any]]) -> int:
+    """
+    流式分析：追加已完成的 findings 到 partial 列表，并推一条 partial_findings 事件（只含新增的）。
+    返回列表长度。
+    """
+    items = [json.dumps(f, ensure_ascii=False) for f in findings]
+    fk = _fkey(job_id)
+    p = _r.pipeline(transaction=False)
+    p.rpush(fk, *items)
+    p.expire(fk, JOB_TTL)
+    p.publish(events_channel(job_id), _event(job_id, "running", PARTIAL_MSG, findings_json=items))
+    n = int(p.execute()[0])
+    log.info(f"[redis] RPUSH {fk} +{len(items)} -> {n} + PUBLISH")
+    return n
+
+def get_partial_findings_raw(job_id: str) -> List[str]:
+    """partial findings（每项 JSON 字符串，不解析）"""
+    return _r.lrange(_fkey(job_id), 0, -1)
+
+def get_job_status(job_id: str) -> Optional[Dict[str, Optional[str]]]:
+    """轮询快路径：只取状态字段（不拉 result）+ partial findings 条数，一次往返；任务不存在返回 None"""
+    p = _r.pipeline(transaction=False)
+    p.hmget(_hkey(job_id), ["status", "message", "finished_at", "error_code"])
+    p.llen(_fkey(job_id))
+    (status, message, finished_at, error_code), partial = p.execute()
+    if status is None:
+        return None
+    return {"status": status, "message": message, "finished_at": finished_at, "error_code": error_code,
+            "partial": int(partial or 0)}
+
+def get_job_result_raw(job_id: str) -> Optional[str]:
+    """已完成任务的 result 原样返回（JSON 字符串，不解析）"""
+    return _r.hget(_hkey(job_id), "result")
 
 def get_job(job_id: str) -> Optional[Dict[str, Any]]:
     hk = _hkey(job_id)
@@ -103,3 +472,36 @@ def get_job(job_id: str) -> Optional[Dict[str, Any]]:
         except Exception:
             pass
     return data
+
+async def job_events(job_id: str, *, keepalive: float = 15.0, max_seconds: float = 600.0) -> AsyncIterator[Optional[str]]:
+    """
+    订阅任务频道：先给出当前状态，之后每次 set_status/save_result/save_error 推一条事件；
+    到终态（done/error）或超时结束。keepalive 秒内没有事件时 yield None（调用方发心跳）。
+    先 SUBSCRIBE 再读 hash，避免两步之间的状态变化被漏掉。
+    """
+    ar = _async_client()
+    ps = ar.pubsub()
+    await ps.subscribe(events_channel(job_id))
+    try:
+        data = await ar.hmget(_hkey(job_id), ["status", "message", "result"])
+        status, message, result_json = data
+        if status is None:
+            return
+        # 中途连上来的：第一条事件带上已经发布的 partial findings
+        partial = await ar.lrange(_fkey(job_id), 0, -1) if status not in ("done", "error") else []
+        yield _event(job_id, status, message, result_json if status == "done" else None, partial or None)
+        if status in ("done", "error"):
+            return
+        deadline = time.time() + max_seconds
+        while time.time() < deadline:
+            msg = await ps.get_message(ignore_subscribe_messages=True, timeout=keepalive)
+            if msg is None:
+                yield None
+                continue
+            ev = msg["data"]
+            yield ev
+            if json.loads(ev).get("status") in ("done", "error"):
+                return
+    finally:
+        await ps.unsubscribe()
+        await ps.aclose()
@@ -1,10 +1,32 @@
-import os, json, time
-from typing import Optional
-from openai import OpenAI
+import os, json, asyncio, logging, threading, hashlib
+from contextlib import contextmanager
+from functools import lru_cache
+from contextvars import ContextVar
+from types import SimpleNamespace
+from typing import Optional, Dict, Any, List, Iterator, Callable
+from openai import OpenAI, AsyncOpenAI
 from httpx import Timeout, Limits
 import httpx
 
-from ..models.llm_models import LlmInput, LlmOutput
+from ..models.llm_models import LlmInput, LlmOutput, Finding
+from .llm_stream import FindingStream, STREAM_ENABLED
+from . import llm_resilience, rate_limit
+
+# 流式调用时每闭合一批 findings 回调一次（llm_stream.FindingPublisher）
+OnFindings = Callable[[List[Finding]], None]
+
+log = logging.getLogger("lease")
+
+LLM_MODEL = os.environ.get("LLM_MODEL", "gpt-4o-mini")
+
+# 进程级共享连接池（按需创建）；大小可配置，便于按并发度调优
+OPENAI_MAX_CONNECTIONS  = int(os.environ.get("OPENAI_MAX_CONNECTIONS", "20"))
+OPENAI_MAX_KEEPALIVE    = int(os.environ.get("OPENAI_MAX_KEEPALIVE", "10"))
+OPENAI_KEEPALIVE_EXPIRY = float(os.environ.get("OPENAI_KEEPALIVE_EXPIRY_SECONDS", "60"))
+OPENAI_HTTP2            = os.environ.get("OPENAI_HTTP2", "0") in ("1", "true", "True")
+OPENAI_READ_TIMEOUT     = float(os.environ.get("OPENAI_READ_TIMEOUT_SECONDS", "120"))
+# provider 端 prompt caching 的最小前缀（OpenAI：1024 token，之后按 128 token 递增）
+PROMPT_CACHE_MIN_TOKENS = int(os.environ.get("LLM_PROMPT_CACHE_MIN_TOKENS", "1024"))
 
 # === 以下内容直接参考你已有脚本（保留同样的语气/Schema/规则） === :contentReference[oaicite:7]{index=7}
 LEASE_SCHEMA = {
@@ -144,8 +166,11 @@ def build_rules_section(jurisdiction: dict | None) -> str:
     Expected jurisdiction example: {"country": "United States", "state": "WA"|"ALL_STATES"|"N/A"}
     """
     j = jurisdiction or {}
-    country = j.get("country") or "United States"
-    state   = j.get("state") or ""
+    return _rules_section(j.get("country") or "United States", j.get("state") or "")
+
+@lru_cache(maxsize=256)
+def _rules_section(country: str, state: str) -> str:
+    # 按 (country, state) 缓存：同一地域每次生成的文本逐字节相同，也省掉重复拼接
     # 人类可读：US_ALL -> All U.S. states
     if state == "ALL_STATES": state_h = "all U.S. states (nationwide)"
     elif state in (None, "", "N/A", "OTHER"): state_h = "N/A"
@@ -170,48 +195,324 @@ def build_rules_section(jurisdiction: dict | None) -> str:
         f"around {focus_str}. Cite or name statutes if feasible. Keep answers grounded in the contract text."
     )
 
-def _client_from_env() -> OpenAI:
-    api_key = os.getenv("OPENAI_API_KEY")
+_client: Optional[OpenAI] = None
+_aclient: Optional[AsyncOpenAI] = None
+_aclient_loop: Optional[asyncio.AbstractEventLoop] = None
+_client_lock = threading.Lock()
 
-    http_client = httpx.Client(
-        http2=False,
+def _http2_enabled() -> bool:
+    if not OPENAI_HTTP2:
+        return False
+    try:
+        import h2  # noqa: F401  (httpx[http2])
+        return True
+    except ImportError:
+        log.warning("[llm] OPENAI_HTTP2=1 but 'h2' is not installed; using HTTP/1.1")
+        return False
+
+def _http_client_kwargs() -> Dict[str, Any]:
+    return dict(
+        http2=_http2_enabled(),
         headers={"Accept-Encoding": "identity", "Connection": "keep-alive"},
-        timeout=Timeout(connect=30.0, read=120.0, write=30.0, pool=120.0),
-        limits=Limits(max_connections=10, max_keepalive_connections=2),
+        timeout=Timeout(connect=30.0, read=OPENAI_READ_TIMEOUT, write=30.0, pool=120.0),
+        limits=Limits(
+            max_connections=OPENAI_MAX_CONNECTIONS,
+            max_keepalive_connections=OPENAI_MAX_KEEPALIVE,
+            keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY,
+        ),
         trust_env=False,
     )
-    return OpenAI(http_client=http_client, api_key=api_key)
 
-def run_leases_check_with_text(contract_text: str, *, jurisdiction: dict | None = None, retries:int=3, temperature:float=0.0, max_tokens:int=2000) -> LlmOutput:
-    client = _client_from_env()
+def _client_from_env() -> OpenAI:
+    api_key = os.getenv("OPENAI_API_KEY")
+    # 重试 / 退避统一由 llm_resilience 做，SDK 自带的重试关掉，免得两层叠加
+    return OpenAI(http_client=httpx.Client(**_http_client_kwargs()), api_key=api_key, max_retries=0)
+
+def get_client() -> OpenAI:
+    """进程内共享的同步客户端（复用 TCP/TLS 连接）"""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = _client_from_env()
+                log.info(f"[llm] client created max_conn={OPENAI_MAX_CONNECTIONS} "
+                         f"keepalive={OPENAI_MAX_KEEPALIVE} http2={_http2_enabled()}")
+                _log_prefix_size()
+    return _client
 
-    user_prompt = (
-        f"{build_rules_section(jurisdiction)}\n\n"
-        "=== CONTRACT TEXT START ===\n"
-        f"{contract_text}\n"
-        "=== CONTRACT TEXT END ==="
-    )
+def get_async_client() -> AsyncOpenAI:
+    """
+    共享的异步客户端。httpx.AsyncClient 的连接绑定事件循环，
+    换了循环（如测试里多次 asyncio.run）就重建一个；旧的要关掉，否则每次都漏一个连接池。
+    """
+    global _aclient, _aclient_loop
+    loop = asyncio.get_running_loop()
+    if _aclient is None or _aclient_loop is not loop:
+        _discard_async_client()
+        api_key = os.getenv("OPENAI_API_KEY")
+        _aclient = AsyncOpenAI(http_client=httpx.AsyncClient(**_http_client_kwargs()), api_key=api_key, max_retries=0)
+        _aclient_loop = loop
+        log.info(f"[llm] async client created max_conn={OPENAI_MAX_CONNECTIONS}")
+    return _aclient
+
+def _discard_async_client() -> None:
+    """丢掉当前的异步客户端：原来的循环还活着就投递到那边 aclose，已经关了就只能留给 GC"""
+    global _aclient, _aclient_loop
+    c, loop = _aclient, _aclient_loop
+    _aclient, _aclient_loop = None, None
+    if c is None or loop is None:
+        return
+    if loop.is_closed():
+        log.warning("[llm] async client outlived its event loop; call aclose_async_client() before the loop ends")
+        return
+    try:
+        running = asyncio.get_running_loop()
+    except RuntimeError:
+        running = None
+    if running is loop:
+        loop.create_task(c.close())
+    elif loop.is_running():
+        asyncio.run_coroutine_threadsafe(c.close(), loop)
+    elif running is None:
+        loop.run_until_complete(c.close())
+    else:
+        log.warning("[llm] cannot close async client of a stopped event loop from another loop")
+
+async def aclose_async_client() -> None:
+    """关闭当前循环上的异步客户端（asyncio.run 结束前调用：run_jobs_staged、worker main、lifespan）"""
+    global _aclient, _aclient_loop
+    if _aclient is not None and _aclient_loop is asyncio.get_running_loop():
+        c = _aclient
+        _aclient, _aclient_loop = None, None
+        await c.close()
+
+def close_clients() -> None:
+    global _client
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+            _client = None
+    _discard_async_client()
+
+def _pool_snapshot(c: Any) -> Optional[Dict[str, Any]]:
+    """读取 httpx 底层 httpcore 连接池状态（私有属性，取不到就返回 None）"""
+    try:
+        pool = c._client._transport._pool
+        conns = list(pool.connections)
+        return {
+            "connections": len(conns),
+            "idle": sum(1 for x in conns if x.is_idle()),
+            "active": sum(1 for x in conns if not x.is_idle() and not x.is_closed()),
+            "http2": sum(1 for x in conns if "HTTP/2" in repr(x)),
+            "queued_requests": sum(1 for r in getattr(pool, "_requests", []) if r.is_queued()),
+        }
+    except Exception:
+        return None
+
+def pool_stats() -> Dict[str, Any]:
+    return {
+        "limits": {
+            "max_connections": OPENAI_MAX_CONNECTIONS,
+            "max_keepalive_connections": OPENAI_MAX_KEEPALIVE,
+            "keepalive_expiry": OPENAI_KEEPALIVE_EXPIRY,
+            "http2": OPENAI_HTTP2,
+        },
+        "sync": _pool_snapshot(_client) if _client is not None else None,
+        "async": _pool_snapshot(_aclient) if _aclient is not None else None,
+        "resilience": llm_resilience.stats(),
+    }
+
+# Prompt 布局（为 provider 端 prompt caching 排序：越稳定越靠前，前缀逐字节相同才能命中）：
+#   1. system: SYSTEM_PROMPT             所有请求相同（response_format 里的 LEASE_SCHEMA 同样固定）
+#   2. system: 地域规则                   同一地域相同（_rules_section 缓存）
+#   3. user:   合同文本                   每次不同，放最后
+# prompt_cache_key 按地域分组，让同一前缀的请求尽量落到同一台缓存机器上。
+def _build_messages(contract_text: str, jurisdiction: dict | None) -> List[Dict[str, str]]:
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "system", "content": build_rules_section(jurisdiction)},
+        {"role": "user", "content": (
+            "=== CONTRACT TEXT START ===\n"
+            f"{contract_text}\n"
+            "=== CONTRACT TEXT END ==="
+        )},
+    ]
+
+_RESPONSE_FORMAT = {"type": "json_schema", "json_schema": LEASE_SCHEMA}
+
+def _prompt_cache_key(jurisdiction: dict | None) -> str:
+    j = jurisdiction or {}
+    raw = f"{j.get('country') or 'United States'}|{j.get('state') or ''}"
+    return f"lease:{hashlib.sha1(raw.encode('utf-8')).hexdigest()[:12]}"
+
+def build_request_body(contract_text: str, jurisdiction: dict | None, *, temperature: float = 0.0, max_tokens: int = 2000) -> Dict[str, Any]:
+    """chat.completions 请求体；实时调用和 Batch API（batch_mode）共用，保证两边请求完全一致"""
+    return {
+        "model": LLM_MODEL,
+        "temperature": temperature,
+        "max_tokens": max_tokens,
+        "response_format": _RESPONSE_FORMAT,
+        "prompt_cache_key": _prompt_cache_key(jurisdiction),
+        "messages": _build_messages(contract_text, jurisdiction),
+    }
+
+def stable_prefix_tokens(jurisdiction: dict | None = None) -> int:
+    """schema + SYSTEM_PROMPT + 地域规则 的 token 数（近似：JSON schema 的实际计费方式 provider 没公开）"""
+    from app.services.prompt_compact import count_tokens  # prompt_compact 依赖本模块，延迟导入
+    return (count_tokens(json.dumps(LEASE_SCHEMA)) + count_tokens(SYSTEM_PROMPT)
+            + count_tokens(build_rules_section(jurisdiction)))
+
+def _log_prefix_size() -> None:
+    # 前缀不够 PROMPT_CACHE_MIN_TOKENS 时 provider 不缓存，只有同一份合同的重试/重跑能命中
+    n = stable_prefix_tokens()
+    if n < PROMPT_CACHE_MIN_TOKENS:
+        log.warning(f"[llm] stable prompt prefix ~{n} tokens < {PROMPT_CACHE_MIN_TOKENS}; "
+                    "provider prompt cache will only hit on repeated contract text")
+    else:
+        log.info(f"[llm] stable prompt prefix ~{n} tokens (cacheable)")
+
+def estimate_tokens(body: Dict[str, Any]) -> int:
+    """限流用的 token 估算：messages 的 token + max_tokens（OpenAI 计 TPM 时按 max_tokens 预扣）"""
+    from app.services.prompt_compact import count_tokens  # prompt_compact 依赖本模块，延迟导入
+    return sum(count_tokens(m.get("content") or "") for m in body["messages"]) + int(body.get("max_tokens") or 0)
+
+def _sdk_kwargs(body: Dict[str, Any], *, stream: bool = False) -> Dict[str, Any]:
+    # 老版本 SDK 的 create() 没有 prompt_cache_key 参数，走 extra_body 原样带上
+    kw = dict(body)
+    kw["extra_body"] = {"prompt_cache_key": kw.pop("prompt_cache_key")}
+    if stream:
+        # 最后一个 chunk 带 usage（choices 为空）
+        kw["stream"] = True
+        kw["stream_options"] = {"include_usage": True}
+    return kw
+
+def _chunk_text(chunk: Any) -> str:
+    return "".join(c.delta.content for c in (chunk.choices or []) if c.delta is not None and c.delta.content)
+
+def _stream_once(client: OpenAI, body: Dict[str, Any], on_findings: OnFindings) -> LlmOutput:
+    """一次流式调用：边收边把闭合的 findings 交给 on_findings，结束后按完整文本严格解析"""
+    fs, tail = FindingStream(), None
+    for chunk in client.chat.completions.create(**_sdk_kwargs(body, stream=True)):
+        if getattr(chunk, "usage", None) is not None:
+            tail = chunk
+        done = fs.feed(_chunk_text(chunk))
+        if done:
+            on_findings(done)
+    _record_usage(tail or SimpleNamespace(usage=None))
+    return parse_output(fs.text)
+
+async def _astream_once(client: AsyncOpenAI, body: Dict[str, Any], on_findings: OnFindings) -> LlmOutput:
+    fs, tail = FindingStream(), None
+    async for chunk in await client.chat.completions.create(**_sdk_kwargs(body, stream=True)):
+        if getattr(chunk, "usage", None) is not None:
+            tail = chunk
+        done = fs.feed(_chunk_text(chunk))
+        if done:
+            # 回调写 Redis（同步），放线程里
+            await asyncio.to_thread(on_findings, done)
+    _record_usage(tail or SimpleNamespace(usage=None))
+    return parse_output(fs.text)
+
+def parse_output(raw: str) -> LlmOutput:
+    return LlmOutput(**json.loads(raw))  # 期望严格 JSON
+
+class LlmUsage:
+    """一个任务累计的 token / 调用 / 重试 / 对冲次数（分块并发时多个调用共享同一个对象）"""
+    __slots__ = ("prompt_tokens", "completion_tokens", "cached_tokens", "calls", "retries", "hedges", "_lock")
+
+    def __init__(self):
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cached_tokens = 0      # prompt_tokens 里命中 provider prompt cache 的部分
+        self.calls = 0
+        self.retries = 0
+        self.hedges = 0             # 对冲请求数（llm_resilience），两个请求都计费
+        self._lock = threading.Lock()
+
+    def add(self, resp: Any = None, *, retries: int = 0, hedges: int = 0) -> None:
+        u = getattr(resp, "usage", None)
+        with self._lock:
+            if resp is not None:
+                self.calls += 1
+            self.retries += retries
+            self.hedges += hedges
+            if u is not None:
+                self.prompt_tokens += int(getattr(u, "prompt_tokens", 0) or 0)
+                self.completion_tokens += int(getattr(u, "completion_tokens", 0) or 0)
+                self.cached_tokens += cached_tokens(u)
+
+    def as_dict(self) -> Dict[str, int]:
+        return {"prompt_tokens": self.prompt_tokens, "completion_tokens": self.completion_tokens,
+                "cached_tokens": self.cached_tokens, "calls": self.calls, "retries": self.retries,
+                "hedges": self.hedges}
+
+def cached_tokens(usage: Any) -> int:
+    """usage.prompt_tokens_details.cached_tokens；SDK 对象或 dict（Batch 输出）都行，没有就是 0"""
+    if isinstance(usage, dict):
+        return int((usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0)
+    details = getattr(usage, "prompt_tokens_details", None)
+    return int(getattr(details, "cached_tokens", 0) or 0)
+
+_usage: ContextVar[Optional[LlmUsage]] = ContextVar("llm_usage", default=None)
+
+@contextmanager
+def track_usage() -> Iterator[LlmUsage]:
+    """
+    with track_usage() as u: ... 期间（同一上下文里，含 asyncio 子任务）的 LLM 调用都记到 u。
+    线程池里调用要用 contextvars.copy_context().run 把上下文带过去（见 chunked_analysis）。
+    """
+    u = LlmUsage()
+    token = _usage.set(u)
+    try:
+        yield u
+    finally:
+        _usage.reset(token)
+
+def _record_usage(resp: Any = None, *, retries: int = 0, hedges: int = 0) -> None:
+    u = _usage.get()
+    if u is not None:
+        u.add(resp, retries=retries, hedges=hedges)
+
+def run_leases_check_with_text(contract_text: str, *, jurisdiction: dict | None = None, retries:int=3, temperature:float=0.0, max_tokens:int=2000,
+                               on_findings: Optional[OnFindings] = None) -> LlmOutput:
+    """
+    on_findings：给了且 LLM_STREAM 打开时流式调用，findings 边生成边回调（重试 / 对冲时会重复回调，回调方去重）
+    重试、退避、对冲、熔断见 llm_resilience；最终失败抛 llm_resilience.LlmCallError（RuntimeError 子类）
+    每次尝试前按估算 token 向集群限流（rate_limit）要额度，不够就等
+    """
+    client = get_client()
+    body = build_request_body(contract_text, jurisdiction, temperature=temperature, max_tokens=max_tokens)
+    stream = on_findings is not None and STREAM_ENABLED
+
+    def attempt() -> LlmOutput:
+        if stream:
+            return _stream_once(client, body, on_findings)
+        resp = client.chat.completions.create(**_sdk_kwargs(body))
+        _record_usage(resp)
+        return parse_output(resp.choices[0].message.content)
+
+    before = None
+    if rate_limit.RATELIMIT_ENABLED:
+        est = estimate_tokens(body)
+        before = lambda wait: rate_limit.acquire(est, wait=wait)
+    return llm_resilience.call(attempt, retries=retries, record=_record_usage, before=before)
 
-    last_err: Optional[Exception] = None
-    for attempt in range(1, retries+1):
-        try:
-            resp = client.chat.completions.create(
-                model="gpt-4o-mini",
-                temperature=temperature,
-                max_tokens=max_tokens,
-                response_format={"type": "json_schema", "json_schema": LEASE_SCHEMA},
-                messages=[
-                    {"role": "system", "content": SYSTEM_PROMPT},
-                    {"role": "user", "content": user_prompt}
-                ],
-            )
-            raw = resp.choices[0].message.content
-            data = json.loads(raw)  # 期望严格 JSON
-            return LlmOutput(**data)
-        except Exception as e:
-            last_err = e
-            time.sleep(0.8 * attempt)
-
-    raise RuntimeError(f"LLM call failed after {retries} retries: {last_err}")
+async def arun_leases_check_with_text(contract_text: str, *, jurisdiction: dict | None = None, retries:int=3, temperature:float=0.0, max_tokens:int=2000,
+                                      on_findings: Optional[OnFindings] = None) -> LlmOutput:
+    """run_leases_check_with_text 的异步版本（AsyncOpenAI，给 worker engine 用）"""
+    client = get_async_client()
+    body = build_request_body(contract_text, jurisdiction, temperature=temperature, max_tokens=max_tokens)
+    stream = on_findings is not None and STREAM_ENABLED
 
+    async def attempt() -> LlmOutput:
+        if stream:
+            return await _astream_once(client, body, on_findings)
+        resp = await client.chat.completions.create(**_sdk_kwargs(body))
+        _record_usage(resp)
+        return parse_output(resp.choices[0].message.content)
 
+    before = None
+    if rate_limit.RATELIMIT_ENABLED:
+        est = estimate_tokens(body)
+        before = lambda wait: rate_limit.aacquire(est, wait=wait)
+    return await llm_resilience.acall(attempt, retries=retries, record=_record_usage, before=before)
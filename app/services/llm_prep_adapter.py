@@ -1,6 +1,16 @@
 # app/services/llm_prep_adapter.py
-from typing import Dict, Any
+import os, re
+from typing import Dict, Any, List, Tuple
 from app.models.extract_models import ExtractResult
+from app.services.prompt_compact import count_tokens, truncate_to_tokens
+
+# 单次调用能放下的上限（约等于原来的 120k 字符）；超过就分块 map-reduce 而不是截断
+SINGLE_CALL_TOKENS = int(os.environ.get("LLM_SINGLE_CALL_TOKENS", "30000"))
+CHUNK_TOKENS       = int(os.environ.get("LLM_CHUNK_TOKENS", "12000"))
+CHUNKED_ENABLED    = os.environ.get("LLM_CHUNKED", "1") not in ("0", "false", "False", "")
+
+# 条款/段落边界：空行，或 "12." / "Section 4" / "ARTICLE IV" 开头的行
+_SECTION_RE = re.compile(r"\n\s*\n|\n(?=\s*(?:\d{1,3}\.\s|section\s+\d|article\s+[ivxlc\d]+)\b)", re.I)
 
 def build_llm_input_text(extract: ExtractResult, *, max_chars: int = 120_000) -> str:
     parts = []
@@ -10,3 +20,68 @@ def build_llm_input_text(extract: ExtractResult, *, max_chars: int = 120_000) ->
     if max_chars and len(full) > max_chars:
         full = full[:max_chars] + "\n...[TRUNCATED]"
     return full
+
+def _split_page(page_no: int, text: str, max_tokens: int) -> List[str]:
+    """单页超出预算时按条款/段落边界切开；仍然过长的段落按字符硬切"""
+    pieces: List[str] = []
+    cur = ""
+    for seg in _SECTION_RE.split(text):
+        seg = seg.strip()
+        if not seg:
+            continue
+        while count_tokens(seg) > max_tokens:
+            pieces.append(seg[:max_tokens * 4])
+            seg = seg[max_tokens * 4:]
+        if cur and count_tokens(cur) + count_tokens(seg) > max_tokens:
+            pieces.append(cur)
+            cur = ""
+        cur = f"{cur}\n\n{seg}" if cur else seg
+    if cur:
+        pieces.append(cur)
+    return [f"[Page {page_no} (part {i + 1}/{len(pieces)})]\n{t}\n" for i, t in enumerate(pieces)]
+
+def split_llm_chunks(extract: ExtractResult, *, max_tokens: int | None = None) -> List[str]:
+    """
+    按页边界贪心打包成若干块，每块不超过 max_tokens（默认 LLM_CHUNK_TOKENS）；
+    每块带一行说明，让模型知道这只是长合同的一部分。
+    """
+    max_tokens = max_tokens or CHUNK_TOKENS
+    units: List[Tuple[int, str]] = []
+    for p in extract.pages:
+        t = f"[Page {p.page}]\n{(p.text or '').strip()}\n"
+        if count_tokens(t) > max_tokens:
+            units.extend((p.page, u) for u in _split_page(p.page, (p.text or "").strip(), max_tokens))
+        else:
+            units.append((p.page, t))
+
+    groups: List[List[Tuple[int, str]]] = []
+    cur: List[Tuple[int, str]] = []
+    cur_tokens = 0
+    for u in units:
+        n = count_tokens(u[1])
+        if cur and cur_tokens + n > max_tokens:
+            groups.append(cur)
+            cur, cur_tokens = [], 0
+        cur.append(u)
+        cur_tokens += n
+    if cur:
+        groups.append(cur)
+
+    total = len(groups)
+    return [
+        f"[Excerpt {k + 1}/{total} of a longer lease, pages {g[0][0]}-{g[-1][0]}. "
+        "Report only clauses found in this excerpt.]\n\n" + "\n".join(t for _, t in g)
+        for k, g in enumerate(groups)
+    ]
+
+def build_llm_inputs(extract: ExtractResult) -> List[str]:
+    """
+    1 个元素 = 单次调用；多个元素 = 分块调用后合并（见 chunked_analysis）。
+    预算按 token 计（见 prompt_compact.count_tokens）。
+    """
+    full = build_llm_input_text(extract, max_chars=0)
+    if count_tokens(full) <= SINGLE_CALL_TOKENS:
+        return [full]
+    if not CHUNKED_ENABLED:
+        return [truncate_to_tokens(full, SINGLE_CALL_TOKENS) + "\n...[TRUNCATED]"]
+    return split_llm_chunks(extract)
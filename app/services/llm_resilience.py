@@ -0,0 +1,378 @@
+# app/services/llm_resilience.py
+"""
+Resilient call layer for LLM requests: classified errors, backoff, hedging, circuit breaker.
+
+llm_client 的每次尝试（普通或流式）都交给 call() / acall()：
+
+  classify(e)       错误分类：rate_limit / server / timeout / connection 可重试；
+                    bad_request / quota / invalid_output（JSON / schema 校验失败，temperature=0 重试结果一样）不重试
+  backoff_delay()   指数退避 + full jitter；429 时至少等 Retry-After / retry-after-ms /
+                    x-ratelimit-reset-*（对应的 remaining 为 0 时）给出的时间，上限 LLM_RETRY_MAX_WAIT_SECONDS
+  hedging           LLM_HEDGE=1 时：一次尝试超过最近成功调用的 p95（至少 LLM_HEDGE_MIN_DELAY_SECONDS）
+                    还没返回，再发一个相同请求，先成功的为准（异步版取消另一个；同步版另一个在线程里跑完丢弃）。
+                    对冲次数不超过调用数的 LLM_HEDGE_MAX_RATIO，样本不足 LLM_HEDGE_MIN_SAMPLES 时不对冲
+  CircuitBreaker    连续 LLM_BREAKER_FAILURES 次 server / timeout / connection 失败后打开，
+                    LLM_BREAKER_COOLDOWN_SECONDS 内直接失败（code=llm_circuit_open）；之后放一个探测请求，
+                    成功关闭、失败重新打开。429 不计入（限流由调用方控制速率）
+
+OpenAI SDK 自带的重试已关掉（max_retries=0，见 llm_client），重试只在这一层做。
+before(wait)：每次尝试前调用（rate_limit 的集群限流）；对冲请求调 before(False)，只扣额度不等，
+等待时间不计入延迟统计。
+最终失败抛 LlmCallError，code（llm_<kind>）随 save_error 写进任务的 error_code。
+状态（p95 / 对冲数 / 熔断状态）在 stats()，/llm/pool 一并返回。均为进程内状态。
+"""
+import os, json, time, random, asyncio, logging, threading, contextvars
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from email.utils import parsedate_to_datetime
+from typing import Optional, Dict, Any, Callable, Awaitable, TypeVar
+
+import httpx
+import openai
+from pydantic import ValidationError
+
+log = logging.getLogger("lease")
+
+RETRY_BASE_SECONDS  = float(os.environ.get("LLM_RETRY_BASE_SECONDS", "0.8"))
+RETRY_MAX_SECONDS   = float(os.environ.get("LLM_RETRY_MAX_SECONDS", "20"))        # 退避本身的上限
+RETRY_MAX_WAIT      = float(os.environ.get("LLM_RETRY_MAX_WAIT_SECONDS", "60"))   # 含 Retry-After 的总上限
+
+HEDGE_ENABLED       = os.environ.get("LLM_HEDGE", "0") in ("1", "true", "True")
+HEDGE_MIN_DELAY     = float(os.environ.get("LLM_HEDGE_MIN_DELAY_SECONDS", "2"))
+HEDGE_MIN_SAMPLES   = int(os.environ.get("LLM_HEDGE_MIN_SAMPLES", "20"))
+HEDGE_MAX_RATIO     = float(os.environ.get("LLM_HEDGE_MAX_RATIO", "0.1"))
+
+BREAKER_FAILURES    = int(os.environ.get("LLM_BREAKER_FAILURES", "5"))
+BREAKER_COOLDOWN    = float(os.environ.get("LLM_BREAKER_COOLDOWN_SECONDS", "30"))
+
+T = TypeVar("T")
+Record = Callable[..., None]   # llm_client._record_usage（retries= / hedges=）
+Before = Optional[Callable[[bool], Any]]   # rate_limit.acquire / aacquire 的包装，参数 = 是否等待
+
+# ---------- 错误分类 ----------
+RATE_LIMIT, QUOTA, SERVER, TIMEOUT, CONNECTION, BAD_REQUEST, INVALID_OUTPUT, CIRCUIT_OPEN, UNKNOWN = (
+    "rate_limit", "quota", "server", "timeout", "connection", "bad_request", "invalid_output", "circuit_open", "unknown")
+_RETRYABLE = {RATE_LIMIT, SERVER, TIMEOUT, CONNECTION, UNKNOWN}
+# 这几类说明 provider 不健康，计入熔断
+_BREAKER_KINDS = {SERVER, TIMEOUT, CONNECTION}
+
+class LlmCallError(RuntimeError):
+    """重试用尽 / 不可重试 / 熔断；code 写进任务的 error_code"""
+    def __init__(self, message: str, kind: str):
+        super().__init__(message)
+        self.kind = kind
+        self.code = f"llm_{kind}"
+
+class Classified:
+    __slots__ = ("kind", "retry_after")
+
+    def __init__(self, kind: str, retry_after: Optional[float] = None):
+        self.kind = kind
+        self.retry_after = retry_after
+
+    @property
+    def retryable(self) -> bool:
+        return self.kind in _RETRYABLE
+
+def _duration(v: str) -> Optional[float]:
+    """x-ratelimit-reset-* 的格式：'1s' / '250ms' / '6m0s' / '1h2m3.5s'"""
+    total, num = 0.0, ""
+    i = 0
+    try:
+        while i < len(v):
+            c = v[i]
+            if c.isdigit() or c == ".":
+                num += c
+            elif v.startswith("ms", i):
+                total += float(num) / 1000
+                num, i = "", i + 1
+            else:
+                total += float(num) * {"h": 3600, "m": 60, "s": 1}[c]
+                num = ""
+            i += 1
+        return total + (float(num) if num else 0.0)
+    except (KeyError, ValueError):
+        return None
+
+def retry_after(headers: Any) -> Optional[float]:
+    """响应头里 provider 要求的等待秒数；没有返回 None"""
+    if not headers:
+        return None
+    ms = headers.get("retry-after-ms")
+    if ms:
+        try:
+            return float(ms) / 1000
+        except ValueError:
+            pass
+    ra = headers.get("retry-after")
+    if ra:
+        try:
+            return float(ra)
+        except ValueError:
+            try:
+                return max(0.0, parsedate_to_datetime(ra).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+    # 哪个额度用完了就等哪个重置
+    waits = [_duration(headers.get(f"x-ratelimit-reset-{k}") or "")
+             for k in ("requests", "tokens") if headers.get(f"x-ratelimit-remaining-{k}") == "0"]
+    waits = [w for w in waits if w is not None]
+    return max(waits) if waits else None
+
+def classify(e: BaseException) -> Classified:
+    if isinstance(e, LlmCallError):
+        return Classified(e.kind)
+    headers = getattr(getattr(e, "response", None), "headers", None)
+    if isinstance(e, openai.RateLimitError):
+        # 额度用完（insufficient_quota）也是 429，但等多久都没用
+        return Classified(QUOTA if getattr(e, "code", None) == "insufficient_quota" else RATE_LIMIT, retry_after(headers))
+    if isinstance(e, (openai.APITimeoutError, httpx.TimeoutException)):
+        return Classified(TIMEOUT)
+    if isinstance(e, (openai.APIConnectionError, httpx.TransportError)):
+        return Classified(CONNECTION)
+    if isinstance(e, openai.APIStatusError):
+        if e.status_code >= 500 or e.status_code in (408, 409):
+            return Classified(SERVER, retry_after(headers))
+        return Classified(BAD_REQUEST)
+    if isinstance(e, (json.JSONDecodeError, ValidationError, openai.LengthFinishReasonError)):
+        return Classified(INVALID_OUTPUT)
+    return Classified(UNKNOWN)
+
+def backoff_delay(attempt: int, after: Optional[float] = None) -> float:
+    """attempt 从 1 开始；full jitter，provider 给了等待时间就至少等那么久"""
+    d = random.uniform(0, min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * 2 ** (attempt - 1)))
+    if after is not None:
+        d = max(d, after + random.uniform(0, RETRY_BASE_SECONDS / 4))
+    return min(d, RETRY_MAX_WAIT)
+
+# ---------- 熔断 ----------
+class CircuitBreaker:
+    """closed -> (连续失败) open -> (冷却后) half_open（只放一个探测）-> closed / open"""
+
+    def __init__(self, failures: int = BREAKER_FAILURES, cooldown: float = BREAKER_COOLDOWN):
+        self.failures = max(1, failures)
+        self.cooldown = cooldown
+        self.state = "closed"
+        self._consecutive = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self.opened = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    def before(self) -> None:
+        with self._lock:
+            if self.state == "open" and time.time() - self._opened_at >= self.cooldown:
+                self.state, self._probing = "half_open", False
+            if self.state == "closed" or (self.state == "half_open" and not self._probing):
+                self._probing = self.state == "half_open"
+                return
+            self.rejected += 1
+        raise LlmCallError(f"LLM circuit open after {self.failures} consecutive failures; retry in "
+                           f"{max(0.0, self.cooldown - (time.time() - self._opened_at)):.0f}s", CIRCUIT_OPEN)
+
+    def success(self) -> None:
+        with self._lock:
+            self._close()
+
+    def _close(self) -> None:
+        if self.state != "closed":
+            log.info("[llm] circuit closed (probe succeeded)")
+        self.state, self._consecutive, self._probing = "closed", 0, False
+
+    def failure(self, kind: str) -> None:
+        if kind not in _BREAKER_KINDS:
+            with self._lock:
+                if kind == UNKNOWN:
+                    # 未知错误不算失败，但要放开探测名额
+                    self._probing = False
+                elif self.state == "closed" or (self.state == "half_open" and self._probing):
+                    # provider 有响应（429 / 4xx / 输出不合格）：说明它是好的。
+                    # open 时不算：可能是熔断前发出、现在才回来的请求，不能不经探测就合上
+                    self._close()
+            return
+        with self._lock:
+            self._consecutive += 1
+            if self.state == "half_open" or (self.state == "closed" and self._consecutive >= self.failures):
+                self.state, self._opened_at, self._probing = "open", time.time(), False
+                self.opened += 1
+                log.warning(f"[llm] circuit OPEN after {self._consecutive} consecutive failures ({kind}); "
+                            f"failing fast for {self.cooldown:.0f}s")
+
+    def stats(self) -> Dict[str, Any]:
+        return {"state": self.state, "consecutive_failures": self._consecutive, "opened": self.opened,
+                "rejected": self.rejected}
+
+# ---------- 延迟统计 / 对冲 ----------
+class LatencyTracker:
+    """最近成功调用的耗时（秒），对冲延迟取 p95"""
+
+    def __init__(self, size: int = 200):
+        self._xs: deque = deque(maxlen=size)
+        self.calls = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float) -> None:
+        with self._lock:
+            self._xs.append(seconds)
+
+    def p95(self) -> Optional[float]:
+        with self._lock:
+            if len(self._xs) < HEDGE_MIN_SAMPLES:
+                return None
+            xs = sorted(self._xs)
+        return xs[min(len(xs) - 1, int(0.95 * len(xs)))]
+
+    def hedge_delay(self) -> Optional[float]:
+        """None = 不对冲（关闭 / 样本不足 / 超出对冲配额）"""
+        if not HEDGE_ENABLED:
+            return None
+        p = self.p95()
+        if p is None:
+            return None
+        with self._lock:
+            if self.hedges >= HEDGE_MAX_RATIO * max(1, self.calls):
+                return None
+        return max(HEDGE_MIN_DELAY, p)
+
+    def stats(self) -> Dict[str, Any]:
+        p = self.p95()
+        return {"samples": len(self._xs), "p95_seconds": round(p, 3) if p is not None else None,
+                "calls": self.calls, "hedges": self.hedges, "hedge_wins": self.hedge_wins}
+
+breaker = CircuitBreaker()
+latency = LatencyTracker()
+_hedge_pool: Optional[ThreadPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+def stats() -> Dict[str, Any]:
+    return {"breaker": breaker.stats(), "latency": latency.stats(), "hedge_enabled": HEDGE_ENABLED}
+
+def _pool() -> ThreadPoolExecutor:
+    global _hedge_pool
+    if _hedge_pool is None:
+        with _pool_lock:
+            if _hedge_pool is None:
+                _hedge_pool = ThreadPoolExecutor(max_workers=int(os.environ.get("OPENAI_MAX_CONNECTIONS", "20")),
+                                                 thread_name_prefix="llm-hedge")
+    return _hedge_pool
+
+def _timed(fn: Callable[[], T]) -> T:
+    t0 = time.perf_counter()
+    out = fn()
+    latency.observe(time.perf_counter() - t0)
+    return out
+
+def _hedged(fn: Callable[[], T], delay: float, record: Record, before: Before) -> T:
+    pool = _pool()
+    # 线程里跑要带上上下文（track_usage 的 ContextVar）
+    first = pool.submit(contextvars.copy_context().run, _timed, fn)
+    done, _ = wait([first], timeout=delay)
+    if done:
+        return first.result()
+    with latency._lock:
+        latency.hedges += 1
+    record(hedges=1)
+    if before is not None:
+        before(False)
+    log.info(f"[llm] hedge: no response after {delay:.1f}s, sending a second request")
+    second = pool.submit(contextvars.copy_context().run, _timed, fn)
+    pending = {first, second}
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for f in done:
+            if f.exception() is None:
+                if f is second:
+                    with latency._lock:
+                        latency.hedge_wins += 1
+                return f.result()
+    return first.result()   # 两个都失败：抛第一个的错误
+
+async def _atimed(afn: Callable[[], Awaitable[T]]) -> T:
+    t0 = time.perf_counter()
+    out = await afn()
+    latency.observe(time.perf_counter() - t0)
+    return out
+
+async def _ahedged(afn: Callable[[], Awaitable[T]], delay: float, record: Record, before: Before) -> T:
+    first = asyncio.ensure_future(_atimed(afn))
+    done, _ = await asyncio.wait({first}, timeout=delay)
+    if done:
+        return first.result()
+    with latency._lock:
+        latency.hedges += 1
+    record(hedges=1)
+    if before is not None:
+        await before(False)
+    log.info(f"[llm] hedge: no response after {delay:.1f}s, sending a second request")
+    second = asyncio.ensure_future(_atimed(afn))
+    try:
+        pending = {first, second}
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for t in done:
+                if t.exception() is None:
+                    if t is second:
+                        with latency._lock:
+                            latency.hedge_wins += 1
+                    return t.result()
+        return first.result()
+    finally:
+        for t in (first, second):
+            if not t.done():
+                t.cancel()
+
+def _failed(attempt: int, retries: int, e: Exception, record: Record) -> float:
+    """记一次失败；返回重试前要等的秒数，不再重试时抛 LlmCallError"""
+    c = classify(e)
+    breaker.failure(c.kind)
+    record(retries=1)
+    if not c.retryable or attempt >= retries:
+        raise LlmCallError(f"LLM call failed after {attempt} attempt(s) ({c.kind}): {type(e).__name__}: {e}", c.kind) from e
+    d = backoff_delay(attempt, c.retry_after)
+    log.warning(f"[llm] attempt {attempt}/{retries} failed ({c.kind}"
+                + (f", retry-after={c.retry_after:.1f}s" if c.retry_after is not None else "")
+                + f"): {type(e).__name__}: {e}; retrying in {d:.1f}s")
+    return d
+
+def call(fn: Callable[[], T], *, retries: int, record: Record, before: Before = None) -> T:
+    """fn = 一次完整尝试（请求 + 解析）；失败按分类重试 / 放弃（_failed 抛 LlmCallError）"""
+    attempt = 0
+    while True:
+        attempt += 1
+        breaker.before()
+        if before is not None:
+            before(True)
+        with latency._lock:
+            latency.calls += 1
+        try:
+            delay = latency.hedge_delay()
+            out = _hedged(fn, delay, record, before) if delay is not None else _timed(fn)
+            breaker.success()
+            return out
+        except LlmCallError:
+            raise
+        except Exception as e:
+            time.sleep(_failed(attempt, retries, e, record))
+
+async def acall(afn: Callable[[], Awaitable[T]], *, retries: int, record: Record, before: Before = None) -> T:
+    """before 是 async（rate_limit.aacquire 的包装）"""
+    attempt = 0
+    while True:
+        attempt += 1
+        breaker.before()
+        if before is not None:
+            await before(True)
+        with latency._lock:
+            latency.calls += 1
+        try:
+            delay = latency.hedge_delay()
+            out = await (_ahedged(afn, delay, record, before) if delay is not None else _atimed(afn))
+            breaker.success()
+            return out
+        except LlmCallError:
+            raise
+        except Exception as e:
+            await asyncio.sleep(_failed(attempt, retries, e, record))
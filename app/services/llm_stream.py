@@ -0,0 +1,119 @@
+# app/services/llm_stream.py
+"""
+Streaming LLM output: publish each finding as soon as its JSON object closes.
+
+整份结构化 JSON（最多 ~2000 token）生成完之前用户什么都看不到，首条 finding 的时间 = LLM 总耗时。
+LLM_STREAM=1（默认）且调用方传了 on_findings 时，llm_client 用 stream=True 调用：
+
+  FindingStream       增量扫描输出文本（只跟踪字符串 / 转义 / 括号深度，不做完整解析），
+                      顶层 "findings" 数组里的对象一闭合就 json.loads 成 Finding
+  FindingPublisher    on_findings 回调：去重（重试 / 分块会重复报）、临时编号，
+                      job_store.append_findings 追加到任务的 partial 列表并推 SSE 事件
+
+最终结果仍以完整解析 + 合并（chunked_analysis / segment_cache）为准；save_result 时 partial 列表删除。
+partial 里的 id 是临时编号，和最终结果的 id 不对应。
+"""
+import os, re, json, time, threading, logging
+from typing import Optional, Dict, Any, List, Set, Tuple
+
+from app.models.llm_models import Finding
+
+log = logging.getLogger("lease")
+
+STREAM_ENABLED = os.environ.get("LLM_STREAM", "1") not in ("0", "false", "False", "")
+
+_WS_RE = re.compile(r"\W+")
+
+class FindingStream:
+    """feed(delta) 返回这段文本里新闭合的 findings；不是合法 JSON 的对象跳过（最终解析时再报错）"""
+
+    def __init__(self):
+        self._text = ""
+        self._pos = 0
+        self._depth = 0
+        self._in_str = False
+        self._esc = False
+        self._str_start = -1
+        self._key: Optional[str] = None   # depth 1 最近一个字符串；遇到 [ 时就是它的 key
+        self._arr_depth = 0               # findings 数组所在深度（0 = 不在数组里）
+        self._obj_start = -1
+
+    def feed(self, delta: str) -> List[Finding]:
+        self._text += delta
+        t, out = self._text, []
+        for i in range(self._pos, len(t)):
+            c = t[i]
+            if self._in_str:
+                if self._esc:
+                    self._esc = False
+                elif c == "\\":
+                    self._esc = True
+                elif c == '"':
+                    self._in_str = False
+                    if self._depth == 1:
+                        self._key = t[self._str_start + 1:i]
+                continue
+            if c == '"':
+                self._in_str, self._str_start = True, i
+            elif c in "[{":
+                self._depth += 1
+                if c == "[" and self._depth == 2 and self._key == "findings":
+                    self._arr_depth = 2
+                elif c == "{" and self._arr_depth and self._depth == self._arr_depth + 1:
+                    self._obj_start = i
+            elif c in "]}":
+                if c == "}" and self._arr_depth and self._depth == self._arr_depth + 1 and self._obj_start >= 0:
+                    out.append(t[self._obj_start:i + 1])
+                    self._obj_start = -1
+                elif c == "]" and self._arr_depth and self._depth == self._arr_depth:
+                    self._arr_depth = 0
+                self._depth -= 1
+        self._pos = len(t)
+        return [f for f in map(_finding, out) if f is not None]
+
+    @property
+    def text(self) -> str:
+        return self._text
+
+def _finding(raw: str) -> Optional[Finding]:
+    try:
+        return Finding(**json.loads(raw))
+    except Exception as e:
+        log.debug(f"[stream] skip unparsable finding: {e}")
+        return None
+
+class FindingPublisher:
+    """
+    on_findings 回调（线程安全：同步分块在线程池里并发调用）。
+    since：任务入队时间（epoch 秒），first_after = 入队到第一条 finding 发布的秒数。
+    """
+
+    def __init__(self, job_id: str, *, since: Optional[float] = None):
+        self.job_id = job_id
+        self.since = since if since is not None else time.time()
+        self.first_after: Optional[float] = None
+        self.published = 0
+        self._seen: Set[Tuple[str, str]] = set()
+        self._lock = threading.Lock()
+
+    def __call__(self, findings: List[Finding]) -> None:
+        items: List[Dict[str, Any]] = []
+        with self._lock:
+            for f in findings:
+                key = (f.category, _WS_RE.sub(" ", (f.original_text or "").lower()).strip()[:160])
+                if key in self._seen:
+                    continue
+                self._seen.add(key)
+                self.published += 1
+                items.append({**f.model_dump(exclude={"id"}), "id": str(self.published)})
+            if not items:
+                return
+            if self.first_after is None:
+                self.first_after = max(0.0, time.time() - self.since)
+                log.info(f"[stream] job_id={self.job_id} first finding after {self.first_after * 1000:.0f}ms")
+            # 在锁里写，partial 列表的顺序和临时编号一致
+            from app.services import job_store  # llm_client 依赖本模块，job_store import 时要 REDIS_URL，延迟导入
+            try:
+                job_store.append_findings(self.job_id, items)
+            except Exception as e:
+                log.warning(f"[stream] job_id={self.job_id} publish failed (ignored): {e}")
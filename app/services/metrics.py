@@ -0,0 +1,206 @@
+# app/services/metrics.py
+"""
+Per-job timings / token usage, aggregated in Redis and rendered for Prometheus.
+
+worker 可能是单独的进程（python -m app.services.worker），所以聚合放在 Redis 里，
+/metrics 在 API 进程里读出来渲染成 text exposition 格式。
+
+  observe_job()  一次 pipeline 往返：
+                   * 任务 hash 写 timings / llm_usage（JSON）
+                   * 直方图：lease_job_stage_seconds{stage}, lease_llm_tokens{kind}
+                     （kind=cached 是 prompt 里命中 provider prompt cache 的部分，看前缀布局是否生效），
+                     lease_queue_wait_seconds{lane}（按 job_store 优先级通道分的排队耗时）
+                   * 计数器：lease_jobs_total{status}, lease_llm_calls_total, lease_llm_retries_total,
+                     lease_llm_hedges_total
+                   * lease:metrics:expensive（zset，按总 token 排的最贵任务，保留 EXPENSIVE_KEEP 个）
+  inc()          直接加计数器（不属于某个任务的事件，如 rate_limit 的等待）
+  render()       /metrics 文本（另含 gauge，渲染时现读：lease_llm_ratelimit_fill 读 rate_limit 的桶，
+                 lease_queue_depth / lease_queue_oldest_seconds 读 job_store.lane_stats）
+  expensive()    最贵的 N 个任务（/metrics/expensive）
+
+Redis 布局：每个直方图序列一个 hash（b:<le> 为非累计桶计数 + sum + count），
+序列名登记在 lease:metrics:series；计数器都在 lease:metrics:counters 一个 hash 里。
+"""
+import os, json, time, logging
+from typing import Dict, Any, Optional, List, Tuple
+
+from app.services import job_store
+
+log = logging.getLogger("lease")
+
+METRICS_ENABLED = os.environ.get("METRICS", "1") not in ("0", "false", "False", "")
+EXPENSIVE_KEEP  = int(os.environ.get("METRICS_EXPENSIVE_KEEP", "100"))
+
+MPFX = "lease:metrics:"
+SERIES_KEY = f"{MPFX}series"
+COUNTERS_KEY = f"{MPFX}counters"
+EXPENSIVE_KEY = f"{MPFX}expensive"
+
+# 阶段名固定，便于看板按 stage 分组
+# first_finding：入队到第一条 partial finding 发布（流式模式，不是独立阶段，和 total 对比看）
+STAGES = ("queue_wait", "download", "extract", "prompt_build", "llm", "persist", "total", "first_finding")
+
+_BUCKETS: Dict[str, Tuple[float, ...]] = {
+    "seconds": (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80, 160, 320),
+    "tokens": (250, 500, 1000, 2000, 4000, 8000, 16000, 32000, 64000, 128000),
+}
+# name -> (help, bucket set)
+HISTOGRAMS: Dict[str, Tuple[str, str]] = {
+    "lease_job_stage_seconds": ("Per-job time spent in each stage.", "seconds"),
+    "lease_llm_tokens": ("LLM tokens per job by kind (prompt/completion/cached).", "tokens"),
+    "lease_queue_wait_seconds": ("Per-job time from enqueue to dequeue, by priority lane.", "seconds"),
+}
+COUNTERS: Dict[str, str] = {
+    "lease_jobs_total": "Jobs finished, by status.",
+    "lease_llm_calls_total": "LLM requests that returned a response.",
+    "lease_llm_retries_total": "LLM request attempts that failed and were retried.",
+    "lease_llm_hedges_total": "Hedged (duplicate) LLM requests sent because the first one was slower than p95.",
+    "lease_llm_tokens_total": "LLM tokens, by kind (cached = prompt tokens served from the provider prompt cache).",
+    "lease_llm_ratelimit_waits_total": "LLM requests that waited for cluster-wide rate-limit budget.",
+    "lease_llm_ratelimit_wait_seconds_total": "Seconds spent waiting for cluster-wide rate-limit budget.",
+}
+GAUGES: Dict[str, str] = {
+    "lease_llm_ratelimit_fill": "Available fraction of the cluster-wide LLM rate-limit bucket (0..1), by bucket.",
+    "lease_queue_depth": "Jobs waiting in the queue, by priority lane.",
+    "lease_queue_oldest_seconds": "Age of the oldest job waiting in each priority lane.",
+}
+
+def _labels(labels: Dict[str, str]) -> str:
+    return ",".join(f'{k}="{v}"' for k, v in sorted(labels.items()))
+
+def _hist_key(name: str, labels: Dict[str, str]) -> str:
+    return f"{MPFX}h:{name}{{{_labels(labels)}}}"
+
+def _observe(p, name: str, labels: Dict[str, str], value: float) -> None:
+    key = _hist_key(name, labels)
+    le = next((b for b in _BUCKETS[HISTOGRAMS[name][1]] if value <= b), "+Inf")
+    p.sadd(SERIES_KEY, key)
+    p.hincrby(key, f"b:{le}", 1)
+    p.hincrbyfloat(key, "sum", float(value))
+    p.hincrby(key, "count", 1)
+
+def _inc(p, name: str, labels: Optional[Dict[str, str]], value: float = 1) -> None:
+    p.hincrbyfloat(COUNTERS_KEY, f"{name}{{{_labels(labels or {})}}}", value)
+
+def inc(name: str, value: float = 1, labels: Optional[Dict[str, str]] = None) -> None:
+    """单独加一个计数器；失败只记日志"""
+    if not METRICS_ENABLED:
+        return
+    try:
+        job_store._r.hincrbyfloat(COUNTERS_KEY, f"{name}{{{_labels(labels or {})}}}", value)
+    except Exception as e:
+        log.warning(f"[metrics] inc {name} failed (ignored): {e}")
+
+def _gauges() -> Dict[str, Dict[str, float]]:
+    from app.services import rate_limit
+    out: Dict[str, Dict[str, float]] = {}
+    try:
+        fill = rate_limit.fill()
+    except Exception as e:
+        log.warning(f"[metrics] ratelimit fill failed (ignored): {e}")
+        fill = None
+    if fill:
+        out["lease_llm_ratelimit_fill"] = {_labels({"bucket": b}): v for b, v in fill.items()}
+    try:
+        lanes = job_store.lane_stats()
+    except Exception as e:
+        log.warning(f"[metrics] lane stats failed (ignored): {e}")
+        lanes = {}
+    for lane, st in lanes.items():
+        out.setdefault("lease_queue_depth", {})[_labels({"lane": lane})] = st["depth"]
+        out.setdefault("lease_queue_oldest_seconds", {})[_labels({"lane": lane})] = st["oldest"]
+    return out
+
+def observe_job(job_id: str, timings: Dict[str, float], usage: Optional[Dict[str, int]], status: str,
+                *, filename: Optional[str] = None, lane: Optional[str] = None) -> None:
+    """记录一个已结束任务的耗时和 token；失败只记日志，不影响任务本身。lane：任务所在的优先级通道"""
+    usage = usage or {}
+    log.info(f"[metrics] job_id={job_id} status={status} timings="
+             + " ".join(f"{k}={v * 1000:.0f}ms" for k, v in timings.items()) + f" usage={usage}")
+    if not METRICS_ENABLED:
+        return
+    try:
+        p = job_store._r.pipeline(transaction=False)
+        fields = {"timings": json.dumps({k: round(v, 4) for k, v in timings.items()})}
+        if usage:
+            fields["llm_usage"] = json.dumps(usage)
+        p.hset(job_store._hkey(job_id), mapping=fields)
+        for stage, sec in timings.items():
+            _observe(p, "lease_job_stage_seconds", {"stage": stage}, sec)
+        if lane and "queue_wait" in timings:
+            _observe(p, "lease_queue_wait_seconds", {"lane": lane}, timings["queue_wait"])
+        _inc(p, "lease_jobs_total", {"status": status})
+        if usage.get("calls"):
+            _inc(p, "lease_llm_calls_total", None, usage["calls"])
+        if usage.get("retries"):
+            _inc(p, "lease_llm_retries_total", None, usage["retries"])
+        if usage.get("hedges"):
+            _inc(p, "lease_llm_hedges_total", None, usage["hedges"])
+        for kind in ("prompt", "completion", "cached"):
+            n = usage.get(f"{kind}_tokens") or 0
+            if n:
+                _observe(p, "lease_llm_tokens", {"kind": kind}, n)
+                _inc(p, "lease_llm_tokens_total", {"kind": kind}, n)
+        total = (usage.get("prompt_tokens") or 0) + (usage.get("completion_tokens") or 0)
+        if total:
+            member = json.dumps({"job_id": job_id, "filename": filename, "at": int(time.time()), **usage,
+                                 "seconds": round(timings.get("total", 0.0), 2)}, sort_keys=True)
+            p.zadd(EXPENSIVE_KEY, {member: total})
+            p.zremrangebyrank(EXPENSIVE_KEY, 0, -EXPENSIVE_KEEP - 1)
+        p.execute()
+    except Exception as e:
+        log.warning(f"[metrics] observe failed (ignored): {e}")
+
+def expensive(n: int = 20) -> List[Dict[str, Any]]:
+    rows = job_store._r.zrevrange(EXPENSIVE_KEY, 0, max(0, n - 1), withscores=True)
+    return [{**json.loads(m), "total_tokens": int(s)} for m, s in rows]
+
+def _fmt(v: float) -> str:
+    return str(int(v)) if float(v).is_integer() else repr(float(v))
+
+def render() -> str:
+    """Prometheus text exposition（0.0.4）"""
+    series = sorted(job_store._r.smembers(SERIES_KEY))
+    p = job_store._r.pipeline(transaction=False)
+    for key in series:
+        p.hgetall(key)
+    p.hgetall(COUNTERS_KEY)
+    *hashes, counters = p.execute()
+
+    out: List[str] = []
+    by_name: Dict[str, List[Tuple[str, Dict[str, str]]]] = {}
+    for key, h in zip(series, hashes):
+        body = key[len(f"{MPFX}h:"):]
+        name, labels = body.split("{", 1)
+        by_name.setdefault(name, []).append((labels[:-1], h))
+    for name, (help_, kind) in HISTOGRAMS.items():
+        out.append(f"# HELP {name} {help_}")
+        out.append(f"# TYPE {name} histogram")
+        for labels, h in by_name.get(name, []):
+            sep = "," if labels else ""
+            cum = 0
+            for b in _BUCKETS[kind]:
+                cum += int(h.get(f"b:{b}", 0))
+                out.append(f'{name}_bucket{{{labels}{sep}le="{_fmt(b)}"}} {cum}')
+            cum += int(h.get("b:+Inf", 0))
+            out.append(f'{name}_bucket{{{labels}{sep}le="+Inf"}} {cum}')
+            out.append(f"{name}_sum{{{labels}}} {_fmt(float(h.get('sum', 0)))}")
+            out.append(f"{name}_count{{{labels}}} {int(h.get('count', 0))}")
+
+    by_counter: Dict[str, List[Tuple[str, str]]] = {}
+    for field, v in (counters or {}).items():
+        name, labels = field.split("{", 1)
+        by_counter.setdefault(name, []).append((labels[:-1], v))
+    for name, help_ in COUNTERS.items():
+        out.append(f"# HELP {name} {help_}")
+        out.append(f"# TYPE {name} counter")
+        for labels, v in sorted(by_counter.get(name, [])):
+            out.append(f"{name}{{{labels}}} {_fmt(float(v))}" if labels else f"{name} {_fmt(float(v))}")
+
+    gauges = _gauges()
+    for name, help_ in GAUGES.items():
+        out.append(f"# HELP {name} {help_}")
+        out.append(f"# TYPE {name} gauge")
+        for labels, v in sorted(gauges.get(name, {}).items()):
+            out.append(f"{name}{{{labels}}} {round(v, 4)}")
+    return "\n".join(out) + "\n"
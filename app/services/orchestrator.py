@@ -1,13 +1,120 @@
 # app/services/orchestrator.py
-import json
+import json, time, logging
+from typing import Callable, Optional
 from app.models.api_models import AnalyzeResponse
-from app.services.pdf_extract import extract_from_pdf_bytes
-from app.services.llm_prep_adapter import build_llm_input_text
-from app.services.llm_client_existing import run_leases_check_with_text
+from app.models.llm_models import LlmOutput, LlmSummary, Finding
+from app.models.extract_models import ExtractResult
+from app.services.pdf_extract import extract_from_pdf_bytes, extract_from_pdf_path, _sha256, _sha256_file
+from app.services.llm_prep_adapter import build_llm_inputs
+from app.services.prompt_compact import compact_extract
+from app.services.llm_client_existing import run_leases_check_with_text, arun_leases_check_with_text
+from app.services.chunked_analysis import run_chunked, arun_chunked
+from app.services import result_cache, segment_cache, clause_screen, preflight
+from app.services.segment_cache import SegmentPlan
 
-def analyze_pipeline(filename: str, data: bytes, *, debug: bool=False, jurisdiction: dict | None = None) -> AnalyzeResponse:
-    # 1) pdf -> json
-    extract = extract_from_pdf_bytes(filename, data)
+log = logging.getLogger("lease")
+
+# llm_stream.FindingPublisher：流式模式下 findings 边生成边发布
+OnFindings = Optional[Callable[[list[Finding]], None]]
+
+def analyze_pipeline(filename: str, data: bytes | None, *, debug: bool=False, jurisdiction: dict | None = None,
+                     path: str | None = None, sha256: str | None = None, timings: dict | None = None,
+                     on_findings: OnFindings = None) -> AnalyzeResponse:
+    """
+    data: PDF 字节；或者给 path（blob_store 下载的临时文件）+ 下载时算好的 sha256
+    timings: 传入 dict 时填各阶段耗时（秒）：extract / prompt_build / llm
+    on_findings: 流式模式下已完成的 findings 回调（缓存命中时不调用，结果直接就绪）
+    """
+    # debug 需要 extract_debug / llm_input_debug，直接走完整流程
+    if debug or not result_cache.CACHE_ENABLED:
+        return _analyze_uncached(filename, data, debug=debug, jurisdiction=jurisdiction, path=path, sha256=sha256,
+                                 timings=timings, on_findings=on_findings)
+
+    key = result_cache.cache_key(_source_sha256(data, path, sha256), jurisdiction)
+    hit = result_cache.get(key)
+    if hit is not None:
+        return _from_cache(filename, hit)
+
+    with result_cache.inflight(key) as leader:
+        if not leader:
+            # 同一份合同正在被别的任务分析：等它的结果
+            hit = result_cache.wait_for(key)
+            if hit is not None:
+                return _from_cache(filename, hit)
+            log.info(f"[cache] no result from leader for {key}, analyzing ourselves")
+        resp = _analyze_uncached(filename, data, debug=False, jurisdiction=jurisdiction, path=path, sha256=sha256,
+                                 timings=timings, on_findings=on_findings)
+        if resp.ok and resp.llm is not None:
+            result_cache.put(key, {"meta": resp.meta, "llm": resp.llm.model_dump()})
+        return resp
+
+def _source_sha256(data: bytes | None, path: str | None, sha256: str | None) -> str:
+    if sha256:
+        return sha256
+    return _sha256_file(path) if path else _sha256(data or b"")
+
+def _from_cache(filename: str, hit: dict) -> AnalyzeResponse:
+    meta = dict(hit.get("meta") or {})
+    meta["filename"] = filename
+    meta["cache"] = "hit"
+    return AnalyzeResponse(ok=True, meta=meta, llm=LlmOutput(**hit["llm"]))
+
+def _analyze_uncached(filename: str, data: bytes | None, *, debug: bool=False, jurisdiction: dict | None = None,
+                      path: str | None = None, sha256: str | None = None, timings: dict | None = None,
+                      on_findings: OnFindings = None) -> AnalyzeResponse:
+    extract, llm_inputs, prep, plan = extract_stage(filename, data, debug=debug, path=path, sha256=sha256,
+                                                    timings=timings, jurisdiction=jurisdiction)
+    if not extract.ok:
+        return AnalyzeResponse(ok=False, meta={"filename": filename}, error=extract.error,
+                               error_code=extract.error_code, llm=None)
+    publish_cached(plan, on_findings)
+    t0 = time.perf_counter()
+    llm_out = llm_stage(llm_inputs, jurisdiction=jurisdiction, on_findings=on_findings)
+    if timings is not None:
+        timings["llm"] = time.perf_counter() - t0
+    return assemble_stage(extract, llm_inputs, llm_out, prep=prep, debug=debug, plan=plan)
+
+def _empty_output() -> LlmOutput:
+    # 所有页都复用了分页缓存，不用调 LLM（segment_cache.combine 会重算 summary）
+    return LlmOutput(summary=LlmSummary(verdict="ok", risk_score=0), findings=[])
+
+def publish_cached(plan: SegmentPlan | None, on_findings: OnFindings) -> None:
+    # 分页缓存复用的 findings 不用等 LLM，先发布
+    if on_findings is not None and plan is not None and plan.cached:
+        on_findings(plan.cached_findings())
+
+def llm_stage(llm_inputs: list[str], *, jurisdiction: dict | None = None, on_findings: OnFindings = None) -> LlmOutput:
+    # 3) text -> OpenAI 严格 JSON；长合同分块并发后合并
+    if not llm_inputs:
+        return _empty_output()
+    if len(llm_inputs) == 1:
+        return run_leases_check_with_text(llm_inputs[0], jurisdiction=jurisdiction or {}, on_findings=on_findings)
+    return run_chunked(llm_inputs, jurisdiction=jurisdiction or {}, on_findings=on_findings)
+
+async def allm_stage(llm_inputs: list[str], *, jurisdiction: dict | None = None, on_findings: OnFindings = None) -> LlmOutput:
+    if not llm_inputs:
+        return _empty_output()
+    if len(llm_inputs) == 1:
+        return await arun_leases_check_with_text(llm_inputs[0], jurisdiction=jurisdiction or {}, on_findings=on_findings)
+    return await arun_chunked(llm_inputs, jurisdiction=jurisdiction or {}, on_findings=on_findings)
+
+def extract_stage(filename: str, data: bytes | None, *, debug: bool=False,
+                  path: str | None = None, sha256: str | None = None, timings: dict | None = None,
+                  jurisdiction: dict | None = None, lease_check: bool | None = None
+                  ) -> tuple[ExtractResult, list[str], dict, SegmentPlan | None]:
+    """
+    jurisdiction 不为 None（且非 debug）时查分页缓存（segment_cache）：llm_inputs 只含变化的页，
+    返回的 plan 交给 assemble_stage 合并缓存的 findings。
+    lease_check：预检要不要做 not_a_lease；None = 按 jurisdiction 判断（preflight.wants_lease_check）
+    """
+    if lease_check is None:
+        lease_check = preflight.wants_lease_check(jurisdiction)
+    # 1) pdf -> json（有临时文件路径就按路径打开，不把整份 PDF 读进内存）
+    t0 = time.perf_counter()
+    if path:
+        extract = extract_from_pdf_path(filename, path, sha256=sha256, debug=debug, lease_check=lease_check)
+    else:
+        extract = extract_from_pdf_bytes(filename, data or b"", debug=debug, lease_check=lease_check)
     if debug:
         # 直接打印：模型对象也能打印；另外补一行更友好的摘要
         print("[extract]", extract, flush=True)
@@ -18,17 +125,34 @@ def analyze_pipeline(filename: str, data: bytes, *, debug: bool=False, jurisdict
                   f"p1_text100='{p1[:100]}'", flush=True)
         except Exception as _:
             pass
+    if timings is not None:
+        timings["extract"] = time.perf_counter() - t0
     if not extract.ok:
-        return AnalyzeResponse(ok=False, meta={"filename": filename}, error=extract.error, llm=None)  # type: ignore
+        return extract, [], {}, None
 
-    # 2) json -> text（沿用你的 prompt_builder 组织方式）
-    llm_text = build_llm_input_text(extract)
+    # 2) json -> text：先压缩（去页眉页脚/页码/签名行），再按 token 预算组织（超长时切成多块）
+    compacted, prep = compact_extract(extract)
+    plan = segment_cache.plan(compacted, jurisdiction) if jurisdiction is not None and not debug else None
+    # 修订版：只分析变化的页
+    todo = plan.changed if plan is not None and plan.changed is not None else compacted
+    # 本地预筛：与 10 个 category 无关的页只发一行摘要
+    screened, screen_stats = clause_screen.screen(todo)
+    if screen_stats:
+        prep = {**prep, "screen": screen_stats}
+    llm_inputs = build_llm_inputs(screened) if screened.pages else []
+    if timings is not None:
+        timings["prompt_build"] = time.perf_counter() - t0 - timings.get("extract", 0.0)
     if debug:
         # 只打印前 2000 个字符，防止日志过大
-        print("[llm_text]", (llm_text[:2000] + (" ...[truncated]" if len(llm_text) > 2000 else "")), flush=True)
+        llm_text = "\n".join(llm_inputs)
+        print(f"[llm_text] chunks={len(llm_inputs)}", (llm_text[:2000] + (" ...[truncated]" if len(llm_text) > 2000 else "")), flush=True)
+    return extract, llm_inputs, prep, plan
 
-    # 3) text -> OpenAI 严格 JSON
-    llm_out = run_leases_check_with_text(llm_text, jurisdiction=jurisdiction or {})
+def assemble_stage(extract: ExtractResult, llm_inputs: list[str], llm_out: LlmOutput, *, prep: dict | None = None,
+                   debug: bool=False, plan: SegmentPlan | None = None) -> AnalyzeResponse:
+    if plan is not None:
+        llm_out = segment_cache.combine(plan, llm_out)
+    llm_text = "\n".join(llm_inputs)
     if debug:
         try:
             payload = llm_out.model_dump() if hasattr(llm_out, "model_dump") else (
@@ -40,11 +164,16 @@ def analyze_pipeline(filename: str, data: bytes, *, debug: bool=False, jurisdict
             print("[llm_out] <print failed>", flush=True)
 
     # 4) 汇总
+    meta = extract.meta.model_dump()
+    meta["llm_chunks"] = len(llm_inputs)
+    if prep:
+        meta["prompt_compaction"] = prep
+    if plan is not None:
+        meta["segments"] = plan.stats()
     return AnalyzeResponse(
         ok=True,
-        meta=extract.meta.dict() if hasattr(extract.meta, "dict") else extract.meta.model_dump(),
+        meta=meta,
         llm=llm_out,
         extract_debug=extract if debug else None,
         llm_input_debug={"full_text": llm_text[:2000] + (" ...[truncated]" if len(llm_text) > 2000 else "")} if debug else None,
     )
-
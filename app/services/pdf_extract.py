@@ -1,33 +1,200 @@
-import fitz, hashlib
-from typing import List
-from ..models.extract_models import ExtractResult, ExtractMeta, ExtractPage, TextBlock
+import os, fitz, hashlib, logging, threading
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from typing import List, Optional, Tuple
+from ..models.extract_models import ExtractResult, ExtractMeta, ExtractPage, TextBlock, CompactBlocks
+from . import preflight
+
+log = logging.getLogger("lease")
+
+# 页数 >= 该阈值时才走多进程分片；小合同留在单进程，避免进程间开销
+PARALLEL_MIN_PAGES = int(os.environ.get("EXTRACT_PARALLEL_MIN_PAGES", "40"))
+EXTRACT_PROCESSES  = int(os.environ.get("EXTRACT_PROCESSES", str(min(4, os.cpu_count() or 1))))
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
 
 def _sha256(data: bytes) -> str:
     return hashlib.sha256(data).hexdigest()
 
-def extract_from_pdf_bytes(filename: str, data: bytes) -> ExtractResult:
-    filehash = _sha256(data)
+def _extract_page(page, page_no: int, debug: bool = False) -> ExtractPage:
+    """
+    单遍抽取：只调用一次 get_text("blocks")，页面文本由文本块拼出
+    （与 get_text("text") 输出一致），bbox 存进 CompactBlocks。
+    debug=True 时才物化成 TextBlock 列表。
+    """
+    compact = CompactBlocks()
+    parts: List[str] = []
+    for b in page.get_text("blocks"):
+        if b[6] != 0:  # 图片块
+            continue
+        t = b[4]
+        parts.append(t)
+        if t.strip():
+            compact.append(b[0], b[1], b[2], b[3], t.strip())
+    ep = ExtractPage(page=page_no, text="".join(parts), blocks=compact.to_text_blocks() if debug else [])
+    ep._compact = compact
+    return ep
+
+def _extract_page_two_pass(page, page_no: int, debug: bool = False) -> ExtractPage:
+    """旧路径：text + blocks 各解析一遍，每块一个 TextBlock（保留给基准对比）"""
+    text = page.get_text("text")
+    blocks_raw = page.get_text("blocks")
+    blocks = []
+    for b in blocks_raw:
+        x0, y0, x1, y1, t = b[0], b[1], b[2], b[3], b[4]
+        if isinstance(t, str) and t.strip():
+            blocks.append(TextBlock(bbox=[float(x0), float(y0), float(x1), float(y1)], text=t.strip()))
+    return ExtractPage(page=page_no, text=text, blocks=blocks)
+
+def _extract_range_from_path(path: str, start: int, stop: int, debug: bool = False) -> List[ExtractPage]:
+    """进程池 worker：按路径打开（MuPDF 按需读文件，不整份进内存）"""
+    doc = fitz.open(path, filetype="pdf")
+    try:
+        return [_extract_page(doc[i], i + 1, debug) for i in range(start, stop)]
+    finally:
+        doc.close()
+
+def _extract_range_from_shm(shm_name: str, size: int, start: int, stop: int, debug: bool = False) -> List[ExtractPage]:
+    """进程池 worker：从共享内存打开同一份 PDF，只解析 [start, stop) 页"""
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        doc = fitz.open(stream=bytes(shm.buf[:size]), filetype="pdf")
+    finally:
+        shm.close()
+    try:
+        return [_extract_page(doc[i], i + 1, debug) for i in range(start, stop)]
+    finally:
+        doc.close()
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawn：uvicorn 进程里有线程，fork 不安全
+            _pool = ProcessPoolExecutor(max_workers=EXTRACT_PROCESSES, mp_context=mp.get_context("spawn"))
+            log.info(f"[extract] process pool started workers={EXTRACT_PROCESSES}")
+        return _pool
+
+def shutdown_pool() -> None:
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=True, cancel_futures=True)
+            _pool = None
+
+def _page_ranges(n_pages: int, n_shards: int) -> List[Tuple[int, int]]:
+    n_shards = max(1, min(n_shards, n_pages))
+    step, extra = divmod(n_pages, n_shards)
+    ranges, start = [], 0
+    for k in range(n_shards):
+        stop = start + step + (1 if k < extra else 0)
+        ranges.append((start, stop))
+        start = stop
+    return ranges
+
+def _run_shards(n_pages: int, submit) -> List[ExtractPage]:
+    # 每个 worker 分 2 片，慢页不至于拖住整体
+    ranges = _page_ranges(n_pages, EXTRACT_PROCESSES * 2)
+    futs = [submit(a, b) for a, b in ranges]
+    pages: List[ExtractPage] = []
+    for f in futs:  # 按提交顺序合并 = 页序
+        pages.extend(f.result())
+    return pages
+
+def _extract_pages_parallel(data: bytes, n_pages: int, debug: bool = False) -> List[ExtractPage]:
+    shm = shared_memory.SharedMemory(create=True, size=max(1, len(data)))
     try:
-        doc = fitz.open(stream=data, filetype="pdf")
+        shm.buf[:len(data)] = data
+        pool = _get_pool()
+        return _run_shards(n_pages, lambda a, b: pool.submit(_extract_range_from_shm, shm.name, len(data), a, b, debug))
+    finally:
+        shm.close()
+        shm.unlink()
+
+def _extract_pages_parallel_path(path: str, n_pages: int, debug: bool = False) -> List[ExtractPage]:
+    pool = _get_pool()
+    return _run_shards(n_pages, lambda a, b: pool.submit(_extract_range_from_path, path, a, b, debug))
+
+def _sha256_file(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(1 << 20):
+            h.update(chunk)
+    return h.hexdigest()
+
+def extract_from_pdf_bytes(filename: str, data: bytes, *, debug: bool = False,
+                           parallel: Optional[bool] = None, single_pass: bool = True,
+                           lease_check: bool = True) -> ExtractResult:
+    """
+    parallel=None: 页数 >= PARALLEL_MIN_PAGES 时自动走进程池；True/False 强制指定
+    debug=True: pages[*].blocks 填充 TextBlock；否则只有 text（块信息留在 compact_blocks()）
+    single_pass=False: 旧的双遍解析（仅用于基准对比）
+    lease_check=False: 预检跳过 not_a_lease（非英文地区，见 preflight.wants_lease_check）
+    """
+    return _extract(
+        filename, _sha256(data),
+        lambda: fitz.open(stream=data, filetype="pdf"),
+        lambda n: _extract_pages_parallel(data, n, debug),
+        debug=debug, parallel=parallel, single_pass=single_pass, lease_check=lease_check,
+    )
+
+def extract_from_pdf_path(filename: str, path: str, *, sha256: Optional[str] = None, debug: bool = False,
+                          parallel: Optional[bool] = None, lease_check: bool = True) -> ExtractResult:
+    """
+    按路径打开（blob_store 流式下载的临时文件），避免 PDF 整份在内存里再复制一次；
+    sha256 可由下载时顺带算好传入。
+    """
+    return _extract(
+        filename, sha256 or _sha256_file(path),
+        lambda: fitz.open(path, filetype="pdf"),
+        lambda n: _extract_pages_parallel_path(path, n, debug),
+        debug=debug, parallel=parallel, single_pass=True, lease_check=lease_check,
+    )
+
+def _extract(filename: str, filehash: str, open_doc, run_parallel, *, debug: bool,
+             parallel: Optional[bool], single_pass: bool, lease_check: bool = True) -> ExtractResult:
+    try:
+        doc = open_doc()
     except Exception as e:
         return ExtractResult(
             ok=False,
             meta=ExtractMeta(filename=filename, page_count=0, sha256=filehash),
             pages=[],
             error=f"Cannot open as PDF: {e}",
+            error_code="not_pdf",
         )
 
-    pages: List[ExtractPage] = []
-    for i in range(len(doc)):
-        page = doc[i]
-        text = page.get_text("text")
-        blocks_raw = page.get_text("blocks")
-        blocks = []
-        for b in blocks_raw:
-            x0, y0, x1, y1, t = b[0], b[1], b[2], b[3], b[4]
-            if isinstance(t, str) and t.strip():
-                blocks.append(TextBlock(bbox=[float(x0), float(y0), float(x1), float(y1)], text=t.strip()))
-        pages.append(ExtractPage(page=i+1, text=text, blocks=blocks))
-
-    meta = ExtractMeta(filename=filename, page_count=len(doc), sha256=filehash)
+    # 预检：在解析全文之前拒掉加密 / 扫描件 / 超长 / 非租约文档
+    checked, rejected = preflight.check(doc, filename, lease_check=lease_check)
+    if rejected is not None:
+        n_pages = len(doc) if not doc.needs_pass else 0
+        doc.close()
+        return ExtractResult(
+            ok=False,
+            meta=ExtractMeta(filename=filename, page_count=n_pages, sha256=filehash),
+            pages=[],
+            error=str(rejected),
+            error_code=rejected.code,
+        )
+
+    try:
+        n_pages = len(doc)
+        use_pool = parallel if parallel is not None else (EXTRACT_PROCESSES > 1 and n_pages >= PARALLEL_MIN_PAGES)
+        pages: Optional[List[ExtractPage]] = None
+        if use_pool and n_pages > 1 and single_pass:
+            try:
+                pages = run_parallel(n_pages)
+                log.info(f"[extract] {filename!r} pages={n_pages} parallel workers={EXTRACT_PROCESSES}")
+            except Exception as e:
+                log.warning(f"[extract] parallel extraction failed, falling back to serial: {e}")
+                pages = None
+        if pages is None:
+            page_fn = _extract_page if single_pass else _extract_page_two_pass
+            pages = [page_fn(doc[i], i + 1, debug) for i in range(n_pages)]
+    finally:
+        doc.close()
+
+    meta = ExtractMeta(filename=filename, page_count=n_pages, sha256=filehash, preflight=checked)
     return ExtractResult(ok=True, meta=meta, pages=pages)
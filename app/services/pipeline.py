@@ -0,0 +1,351 @@
+# app/services/pipeline.py
+"""
+Staged job pipeline: fetch -> extract -> llm -> save, connected by bounded queues.
+
+每个阶段有自己的并发数（PIPELINE_*_CONCURRENCY），阶段之间是有界队列（PIPELINE_QUEUE_SIZE）。
+这样下一个任务的 blob 下载、PDF 解析可以和当前任务的 LLM 等待重叠进行；
+下游队列满了上游自然停下（背压），内存里的任务数有上限。
+
+  fetch    get_job + 流式下载到临时文件 + 结果缓存查询 / in-flight 合并
+  extract  PDF 解析 + prompt 压缩/分块（放线程里，CPU 为主）
+  llm      OpenAI 调用（异步；长合同分块并发）
+  save     组装结果、写缓存、保存、删 blob、ack
+
+同一份合同正在被别的任务分析时（result_cache in-flight 合并），跟随者在单独的有界线程池
+（PIPELINE_FOLLOW_THREADS）里等结果，不占 asyncio 默认线程池：默认池要留给 extract / set_status 等。
+
+stats() 返回每个阶段的排队数 / 在跑数 / 完成数（/worker/stats 和引擎日志用）。
+"""
+import os, json, time, asyncio, logging, threading, traceback
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import AsyncExitStack
+from typing import Optional, Dict, Any, List, Set, Callable
+
+import httpx
+
+from app.models.api_models import AnalyzeResponse
+from app.services import result_cache
+from app.services.orchestrator import extract_stage, allm_stage, assemble_stage, publish_cached, _from_cache, _source_sha256
+from app.services.segment_cache import SegmentPlan
+from app.services.blob_store import adownload_to_tempfile, adelete_blob
+from app.services.llm_client_existing import track_usage, aclose_async_client
+from app.services.llm_stream import FindingPublisher
+from app.services.metrics import observe_job
+from app.services.job_store import ack_job, set_status, save_result, save_error, get_job
+
+log = logging.getLogger("lease")
+
+FETCH_CONCURRENCY   = int(os.environ.get("PIPELINE_FETCH_CONCURRENCY", "4"))
+EXTRACT_CONCURRENCY = int(os.environ.get("PIPELINE_EXTRACT_CONCURRENCY", "2"))
+LLM_CONCURRENCY     = int(os.environ.get("PIPELINE_LLM_CONCURRENCY") or os.environ.get("WORKER_CONCURRENCY", "4"))
+SAVE_CONCURRENCY    = int(os.environ.get("PIPELINE_SAVE_CONCURRENCY", "2"))
+# 每个阶段前的队列长度
+QUEUE_SIZE          = int(os.environ.get("PIPELINE_QUEUE_SIZE", "2"))
+# 等 leader 结果的跟随者最多同时占几个线程；多出来的在这个池里排队
+FOLLOW_THREADS      = int(os.environ.get("PIPELINE_FOLLOW_THREADS", "8"))
+
+_follow_pool = ThreadPoolExecutor(max_workers=max(1, FOLLOW_THREADS), thread_name_prefix="follow")
+
+STAGES = ("fetch", "extract", "llm", "save")
+
+def _jurisdiction(data: Dict[str, Any]) -> dict:
+    # 取回地域参数并传入分析管线
+    try:
+        if data.get("jurisdiction"):
+            return json.loads(data["jurisdiction"])
+    except Exception:
+        pass
+    return {}
+
+def _finish(job_id: str, result: Any) -> bool:
+    """保存结果或错误；返回是否成功（成功才删 blob）"""
+    # 兼容 pydantic 模型 / dict
+    out = result.model_dump() if hasattr(result, "model_dump") else result
+    ok  = getattr(result, "ok", True) if not isinstance(result, dict) else True
+    if ok:
+        save_result(job_id, out)
+        log.info(f"[worker] job_id={job_id} -> done")
+    else:
+        err = getattr(result, "error", "unknown error")
+        save_error(job_id, err, code=getattr(result, "error_code", None))
+        log.warning(f"[worker] job_id={job_id} -> error: {err}")
+    return ok
+
+class _Job:
+    """一个任务在各阶段之间传递的状态；stack 持有临时文件和 in-flight 锁，任务结束时统一释放"""
+    __slots__ = ("job_id", "filename", "debug", "jurisdiction", "blob_pathname", "path", "sha256",
+                 "cache_key", "extract", "llm_inputs", "prep", "plan", "llm_out", "resp", "stack", "t0", "enqueued_at",
+                 "lane", "timings", "usage")
+
+    def __init__(self, job_id: str):
+        self.job_id = job_id
+        self.filename = "unknown.pdf"
+        self.debug = False
+        self.jurisdiction: dict = {}
+        self.blob_pathname: Optional[str] = None
+        self.path: Optional[str] = None
+        self.sha256: Optional[str] = None
+        self.cache_key: Optional[str] = None
+        self.extract = None
+        self.llm_inputs: List[str] = []
+        self.prep: dict = {}
+        self.plan: Optional[SegmentPlan] = None
+        self.llm_out = None
+        self.resp: Optional[AnalyzeResponse] = None
+        self.stack = AsyncExitStack()
+        self.t0 = time.time()
+        self.enqueued_at: Optional[float] = None
+        self.lane: Optional[str] = None      # job_store 优先级通道（metrics 按通道记排队耗时）
+        # queue_wait / download / extract / prompt_build / llm / persist / total（秒），见 metrics.STAGES
+        self.timings: Dict[str, float] = {}
+        self.usage: Optional[Dict[str, int]] = None
+
+class _Stage:
+    def __init__(self, name: str, concurrency: int):
+        self.name = name
+        self.concurrency = max(1, concurrency)
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max(1, QUEUE_SIZE))
+        self.active = 0
+        self.done = 0
+
+class StagedPipeline:
+    """
+    start() 起各阶段的 worker 协程；submit() 把任务放进 fetch 队列（满了就等）；
+    drain() 等所有在途任务结束；close() 取消剩余任务（不 ack，租约到期后由 reaper 放回队列）。
+    """
+
+    def __init__(self, *, base_url: str, http: httpx.AsyncClient, concurrency: Optional[Dict[str, int]] = None):
+        self.base_url = base_url
+        self.http = http
+        conc = {"fetch": FETCH_CONCURRENCY, "extract": EXTRACT_CONCURRENCY,
+                "llm": LLM_CONCURRENCY, "save": SAVE_CONCURRENCY}
+        conc.update(concurrency or {})
+        self._stages = {name: _Stage(name, conc[name]) for name in STAGES}
+        self._handlers = {"fetch": self._fetch, "extract": self._extract, "llm": self._llm, "save": self._save}
+        self._jobs: Dict[str, _Job] = {}
+        self._workers: List[asyncio.Task] = []
+        self._followers: Set[asyncio.Task] = set()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        # 任务离开流水线时回调 (job_id, 各阶段耗时)；基准测试用
+        self.on_finish: Optional[Callable[[str, Dict[str, float]], None]] = None
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._jobs)
+
+    @property
+    def job_ids(self) -> List[str]:
+        return list(self._jobs)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "in_flight": len(self._jobs),
+            "waiting_on_leader": len(self._followers),
+            "stages": {
+                name: {"queued": st.queue.qsize(), "active": st.active, "concurrency": st.concurrency, "done": st.done}
+                for name, st in self._stages.items()
+            },
+        }
+
+    def start(self) -> None:
+        for st in self._stages.values():
+            for _ in range(st.concurrency):
+                self._workers.append(asyncio.create_task(self._work(st)))
+        log.info("[pipeline] started " + " ".join(f"{n}={st.concurrency}" for n, st in self._stages.items())
+                 + f" queue={QUEUE_SIZE}")
+
+    async def submit(self, job_id: str) -> None:
+        job = _Job(job_id)
+        self._jobs[job_id] = job
+        self._idle.clear()
+        await self._stages["fetch"].queue.put(job)
+
+    async def drain(self, timeout: Optional[float] = None) -> bool:
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout=timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def close(self) -> None:
+        tasks = self._workers + list(self._followers)
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._workers.clear()
+        for job in list(self._jobs.values()):
+            log.warning(f"[pipeline] job_id={job.job_id} cancelled, left for lease expiry")
+            await self._close_job(job, ack=False)
+
+    async def _work(self, st: _Stage) -> None:
+        handler = self._handlers[st.name]
+        while True:
+            job = await st.queue.get()
+            st.active += 1
+            try:
+                nxt = await handler(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                nxt = None
+                await self._fail(job, e)
+            finally:
+                st.active -= 1
+                st.done += 1
+            if nxt is None and job.job_id not in self._jobs and self.on_finish is not None:
+                self.on_finish(job.job_id, job.timings)
+            if nxt:
+                await self._stages[nxt].queue.put(job)
+
+    async def _close_job(self, job: _Job, *, ack: bool) -> None:
+        # 先释放临时文件和 in-flight 锁（缓存已写好，follower 能读到），再 ack
+        try:
+            await job.stack.aclose()
+        except Exception as e:
+            log.warning(f"[pipeline] job_id={job.job_id} cleanup failed (ignored): {e}")
+        if ack:
+            try:
+                await asyncio.to_thread(ack_job, job.job_id)
+            except Exception as e:
+                log.warning(f"[pipeline] job_id={job.job_id} ack failed, lease will expire: {e}")
+        self._jobs.pop(job.job_id, None)
+        if not self._jobs:
+            self._idle.set()
+
+
+    async def _fail(self, job: _Job, e: Exception) -> None:
+        log.error(f"[pipeline] job_id={job.job_id} crashed: {type(e).__name__}: {e}\n{traceback.format_exc()}")
+        try:
+            # LlmCallError 带 code（llm_rate_limit / llm_circuit_open …）
+            await asyncio.to_thread(save_error, job.job_id, f"{type(e).__name__}: {e}", code=getattr(e, "code", None))
+        except Exception as e2:
+            log.error(f"[pipeline] job_id={job.job_id} save_error failed: {e2}")
+        await self._observe(job, "error")
+        await self._close_job(job, ack=True)
+
+    async def _observe(self, job: _Job, status: str) -> None:
+        job.timings["total"] = time.time() - (job.enqueued_at or job.t0)
+        await asyncio.to_thread(observe_job, job.job_id, job.timings, job.usage, status,
+                                filename=job.filename, lane=job.lane)
+
+    # ---------- stages ----------
+    async def _fetch(self, job: _Job) -> Optional[str]:
+        await asyncio.to_thread(set_status, job.job_id, "running", "decoding")
+        data = await asyncio.to_thread(get_job, job.job_id)
+        if not data:
+            log.warning(f"[pipeline] job_id={job.job_id} hgetall miss")
+            await self._close_job(job, ack=True)
+            return None
+        job.filename = data["filename"] or "unknown.pdf"
+        job.debug = bool(data.get("debug", False))
+        job.jurisdiction = _jurisdiction(data)
+        job.blob_pathname = data.get("blob_pathname")
+        job.enqueued_at = float(data.get("enqueued_at") or data.get("created_at") or job.t0)
+        job.timings["queue_wait"] = max(0.0, job.t0 - job.enqueued_at)
+        job.lane = data.get("lane")
+        log.info(f"[pipeline] job_id={job.job_id} file={job.filename!r} debug={job.debug} lane={job.lane}")
+
+        if job.blob_pathname:
+            await asyncio.to_thread(set_status, job.job_id, "running", "downloading")
+            t0 = time.perf_counter()
+            bf = await job.stack.enter_async_context(
+                adownload_to_tempfile(job.blob_pathname, base_url=self.base_url, http=self.http)
+            )
+            job.path, job.sha256 = bf.path, bf.sha256
+            job.timings["download"] = time.perf_counter() - t0
+
+        # debug 需要 extract_debug / llm_input_debug，直接走完整流程
+        if job.debug or not result_cache.CACHE_ENABLED:
+            return "extract"
+        job.cache_key = result_cache.cache_key(_source_sha256(None, job.path, job.sha256), job.jurisdiction)
+        hit = await asyncio.to_thread(result_cache.get, job.cache_key)
+        if hit is not None:
+            job.resp = _from_cache(job.filename, hit)
+            return "save"
+        if job.stack.enter_context(result_cache.inflight(job.cache_key)):
+            return "extract"
+        # 同一份合同正在被别的任务分析：单独等它的结果，不占任何阶段的并发
+        t = asyncio.create_task(self._follow(job))
+        self._followers.add(t)
+        t.add_done_callback(self._followers.discard)
+        return None
+
+    async def _follow(self, job: _Job) -> None:
+        # 截止时间从现在算，在 _follow_pool 里排队的时间也算在内
+        deadline = time.time() + result_cache.INFLIGHT_WAIT
+        stop = threading.Event()
+        try:
+            hit = await asyncio.get_running_loop().run_in_executor(
+                _follow_pool, lambda: result_cache.wait_for(job.cache_key, timeout=deadline - time.time(), stop=stop))
+            if hit is not None:
+                job.resp = _from_cache(job.filename, hit)
+                await self._stages["save"].queue.put(job)
+                return
+            log.info(f"[cache] no result from leader for {job.cache_key}, analyzing ourselves")
+            await self._stages["extract"].queue.put(job)
+        except asyncio.CancelledError:
+            stop.set()   # 线程里的轮询跟着停，不白占 _follow_pool
+            raise
+        except Exception as e:
+            await self._fail(job, e)
+
+    async def _extract(self, job: _Job) -> Optional[str]:
+        await asyncio.to_thread(set_status, job.job_id, "running", "analyzing")
+        extract, llm_inputs, prep, plan = await asyncio.to_thread(
+            extract_stage, job.filename, None, debug=job.debug, path=job.path, sha256=job.sha256, timings=job.timings,
+            jurisdiction=job.jurisdiction
+        )
+        if not extract.ok:
+            job.resp = AnalyzeResponse(ok=False, meta={"filename": job.filename}, error=extract.error,
+                                       error_code=extract.error_code, llm=None)
+            return "save"
+        job.extract, job.llm_inputs, job.prep, job.plan = extract, llm_inputs, prep, plan
+        return "llm"
+
+    async def _llm(self, job: _Job) -> Optional[str]:
+        t0 = time.perf_counter()
+        # 流式：findings 边生成边写进任务的 partial 列表（/jobs/{id} 和 SSE 能先看到）
+        pub = FindingPublisher(job.job_id, since=job.enqueued_at)
+        await asyncio.to_thread(publish_cached, job.plan, pub)
+        with track_usage() as usage:
+            try:
+                job.llm_out = await allm_stage(job.llm_inputs, jurisdiction=job.jurisdiction, on_findings=pub)
+            finally:
+                job.usage = usage.as_dict()
+                job.timings["llm"] = time.perf_counter() - t0
+                if pub.first_after is not None:
+                    job.timings["first_finding"] = pub.first_after
+        return "save"
+
+    async def _save(self, job: _Job) -> Optional[str]:
+        t0 = time.perf_counter()
+        resp = job.resp
+        if resp is None:
+            # 分页缓存的合并 / 写回是同步 Redis + 去重，放线程里（engine 模式下这是 API 的事件循环）
+            resp = await asyncio.to_thread(assemble_stage, job.extract, job.llm_inputs, job.llm_out,
+                                           prep=job.prep, debug=job.debug, plan=job.plan)
+            job.extract = None
+            if job.cache_key and resp.llm is not None:
+                await asyncio.to_thread(result_cache.put, job.cache_key, {"meta": resp.meta, "llm": resp.llm.model_dump()})
+        ok = await asyncio.to_thread(_finish, job.job_id, resp)
+        job.timings["persist"] = time.perf_counter() - t0
+        await self._observe(job, "done" if ok else "error")
+        if ok and job.blob_pathname:
+            await adelete_blob(job.blob_pathname, base_url=self.base_url, http=self.http)
+        await self._close_job(job, ack=True)
+        return None
+
+async def run_jobs_staged(job_ids: List[str], base_url: str) -> None:
+    """/worker/tick 一次取到多个任务时用：跑一个临时流水线直到全部完成"""
+    async with httpx.AsyncClient() as http:
+        p = StagedPipeline(base_url=base_url, http=http)
+        p.start()
+        try:
+            for job_id in job_ids:
+                await p.submit(job_id)
+            await p.drain()
+        finally:
+            await p.close()
+            # 这个循环随 asyncio.run 一起结束，LLM 客户端的连接池也在这里关掉
+            await aclose_async_client()
@@ -0,0 +1,108 @@
+# app/services/preflight.py
+"""
+Pre-flight triage on the open fitz document, before any extraction / LLM spend.
+
+pdf_extract 打开 PDF 之后先跑一遍（抽样几页 get_text，毫秒级），不合格的直接拒绝，
+错误码随 ExtractResult.error_code 一路传到 job_store.save_error（任务 hash 的 error_code 字段，
+/jobs/{id} 返回里也有）：
+
+  encrypted       需要密码才能打开
+  empty           0 页
+  too_many_pages  超过 PREFLIGHT_MAX_PAGES（附录 / 扫描合集一类）
+  no_text         抽样页几乎没有文字层（纯扫描件；目前没有 OCR）
+  not_a_lease     租约关键词命中太少（关键词是英文的：默认只对美国的任务做这项检查，
+                  PREFLIGHT_LEASE_CHECK=all 对所有地区做，off 关掉；见 wants_lease_check）
+
+通过的任务在 meta.preflight 里记下抽样统计（文字密度、关键词得分、低文字页数），便于调阈值。
+"""
+import os, re, time, logging
+from typing import Optional, Dict, Any, List
+
+log = logging.getLogger("lease")
+
+PREFLIGHT_ENABLED        = os.environ.get("PREFLIGHT", "1") not in ("0", "false", "False", "")
+PREFLIGHT_MAX_PAGES      = int(os.environ.get("PREFLIGHT_MAX_PAGES", "300"))
+PREFLIGHT_SAMPLE_PAGES   = int(os.environ.get("PREFLIGHT_SAMPLE_PAGES", "8"))
+# 每页少于这么多字符算“低文字页”；抽样页全是低文字页则判为扫描件
+PREFLIGHT_MIN_PAGE_CHARS = int(os.environ.get("PREFLIGHT_MIN_PAGE_CHARS", "200"))
+# 关键词得分 = 命中的不同关键词数 / 关键词总数
+PREFLIGHT_MIN_LEASE_SCORE = float(os.environ.get("PREFLIGHT_MIN_LEASE_SCORE", "0.2"))
+# not_a_lease 检查范围：us（默认，jurisdiction.country 为美国或未填）/ all / off
+PREFLIGHT_LEASE_CHECK    = os.environ.get("PREFLIGHT_LEASE_CHECK", "us").strip().lower()
+
+ENCRYPTED, EMPTY, TOO_MANY_PAGES, NO_TEXT, NOT_A_LEASE = "encrypted", "empty", "too_many_pages", "no_text", "not_a_lease"
+
+_LEASE_TERMS = (
+    "lease", "tenant", "landlord", "rent", "premises", "security deposit", "lessee", "lessor",
+    "occupan", "sublet", "utilities", "term of", "notice", "eviction", "late fee",
+)
+# 词边界：开头必须是词首（"please" / "release" / "current" 不算），结尾允许短后缀（leases / occupancy / rental）
+_TERMS_RE = re.compile(r"\b(" + "|".join(re.escape(t) for t in _LEASE_TERMS) + r")\w{0,3}\b")
+_US_NAMES = {"united states", "united states of america", "us", "u.s.", "usa", "u.s.a."}
+
+class Rejected(Exception):
+    def __init__(self, code: str, message: str):
+        super().__init__(f"{code}: {message}")
+        self.code = code
+
+def _sample(n_pages: int, k: int) -> List[int]:
+    """前 3 页（标题 / 当事人 / 租金通常在这里）+ 其余均匀抽样"""
+    head = list(range(min(3, n_pages)))
+    rest = max(0, k - len(head))
+    if n_pages <= len(head) or rest == 0:
+        return head
+    step = max(1, (n_pages - len(head)) // rest)
+    return sorted(set(head + list(range(len(head), n_pages, step))[:rest]))
+
+def lease_score(text: str) -> float:
+    hits = {m.group(1) for m in _TERMS_RE.finditer(text.lower())}
+    return len(hits) / len(_LEASE_TERMS)
+
+def wants_lease_check(jurisdiction: Optional[Dict[str, Any]]) -> bool:
+    """英文关键词打分只对英文合同有意义；country 没填按美国（和 build_rules_section 的默认一致）"""
+    if PREFLIGHT_LEASE_CHECK in ("all", "1", "true"):
+        return True
+    if PREFLIGHT_LEASE_CHECK != "us":
+        return False
+    country = str((jurisdiction or {}).get("country") or "United States").strip().lower()
+    return country in _US_NAMES
+
+def triage(doc: Any, filename: str, *, lease_check: bool = True) -> Dict[str, Any]:
+    """检查打开的 fitz 文档；不合格抛 Rejected，合格返回统计（写进 meta.preflight）"""
+    t0 = time.perf_counter()
+    if doc.needs_pass:
+        raise Rejected(ENCRYPTED, "PDF is password-protected; upload an unlocked copy")
+    n_pages = len(doc)
+    if n_pages == 0:
+        raise Rejected(EMPTY, "PDF has no pages")
+    if n_pages > PREFLIGHT_MAX_PAGES:
+        raise Rejected(TOO_MANY_PAGES, f"{n_pages} pages (max {PREFLIGHT_MAX_PAGES}); upload the lease without appendices")
+
+    idx = _sample(n_pages, PREFLIGHT_SAMPLE_PAGES)
+    texts = [doc[i].get_text("text") for i in idx]
+    chars = [len(t.strip()) for t in texts]
+    low = sum(1 for c in chars if c < PREFLIGHT_MIN_PAGE_CHARS)
+    score = lease_score(" ".join(texts))
+    stats: Dict[str, Any] = {
+        "sampled_pages": len(idx), "avg_chars_per_page": round(sum(chars) / len(idx)),
+        "low_text_pages": low, "lease_score": round(score, 2),
+    }
+    if low == len(idx):
+        raise Rejected(NO_TEXT, f"no text layer on sampled pages (avg {stats['avg_chars_per_page']} chars/page); "
+                                "looks like a scanned image-only PDF")
+    if lease_check and score < PREFLIGHT_MIN_LEASE_SCORE:
+        raise Rejected(NOT_A_LEASE, f"document does not look like a lease (score {score:.2f} < {PREFLIGHT_MIN_LEASE_SCORE})")
+    stats["ms"] = round((time.perf_counter() - t0) * 1000, 1)
+    log.info(f"[preflight] {filename!r} pages={n_pages} ok {stats}")
+    return stats
+
+def check(doc: Any, filename: str, *, lease_check: bool = True) -> tuple[Optional[Dict[str, Any]], Optional[Rejected]]:
+    """triage 的包装：返回 (stats, None) 或 (None, Rejected)；关闭时返回 (None, None)"""
+    if not PREFLIGHT_ENABLED:
+        return None, None
+    t0 = time.perf_counter()
+    try:
+        return triage(doc, filename, lease_check=lease_check), None
+    except Rejected as r:
+        log.warning(f"[preflight] {filename!r} rejected in {(time.perf_counter() - t0) * 1000:.1f}ms: {r}")
+        return None, r
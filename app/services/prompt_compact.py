@@ -0,0 +1,150 @@
+# app/services/prompt_compact.py
+"""
+Prompt compaction between extraction and the LLM.
+
+  * 去掉跨页重复的页眉/页脚（数字归一后，出现在足够多页的首尾行）
+  * 去掉页首/页尾的页码行（正文里单独一行的数字是租金 / 天数 / 编号，保留），签名/首字母缩写（initials）行、纯下划线行
+  * 行尾连字符接回下一行："month-to-\\nmonth" -> "month-to-month"（保留连字符，模型引用的原文要和 PDF 一致）；
+    只有软连字符（U+00AD）断开的词才去掉连字符拼成一个词；压缩空白
+  * count_tokens(): 有 tiktoken 就用真实分词，否则按 4 字符/token 估算
+
+输入 token 决定 LLM 延迟和费用；compact_extract 返回节省的 token 数，随结果 meta 一起保存。
+"""
+import os, re, logging
+from collections import Counter
+from typing import List, Dict, Any, Tuple
+
+from app.models.extract_models import ExtractResult
+
+log = logging.getLogger("lease")
+
+COMPACT_ENABLED = os.environ.get("PROMPT_COMPACT", "1") not in ("0", "false", "False", "")
+# 页首/页尾各看几行来找重复的页眉页脚
+EDGE_LINES = int(os.environ.get("PROMPT_COMPACT_EDGE_LINES", "3"))
+# 至少出现在这么多比例的页上才算页眉页脚
+REPEAT_RATIO = float(os.environ.get("PROMPT_COMPACT_REPEAT_RATIO", "0.5"))
+
+_PAGE_NO_RE = re.compile(
+    r"^(?:page\s*)?[-–—(\[]?\s*\d{1,4}\s*[-–—)\]]?(?:\s*(?:of|/)\s*\d{1,4})?$", re.I
+)
+# 签名 / 日期栏：带角色前缀（"Tenant's Initials"），或带冒号 / 下划线填空（"Date: ____"）；
+# 光一个 "date." 是断行后的正文结尾，不能删
+_ROLE = r"(?:tenant|resident|landlord|lessee|lessor|manager|owner|agent)(?:'s)?\s*"
+_SIGNATURE_RE = re.compile(
+    rf"^(?:{_ROLE}(?:initials?|signature|sign here|date)\s*[:.]?"
+    r"|(?:initials?|signature|sign here|date)\s*(?::|\.?\s*_))\s*[_\s.]*$",
+    re.I,
+)
+_RULE_RE = re.compile(r"^[\s_.\-=*]{3,}$")
+_HYPHEN_RE = re.compile(r"(\w)-[ \t]*\n[ \t]*(?=\w)")
+_SOFT_HYPHEN_RE = re.compile(r"(\w)\u00ad[ \t]*\n[ \t]*(?=\w)")
+_SPACES_RE = re.compile(r"[ \t ]+")
+_BLANKS_RE = re.compile(r"\n{3,}")
+_DIGITS_RE = re.compile(r"\d+")
+# 页眉页脚都是短行；长行即使重复也当正文保留
+MAX_EDGE_CHARS = 100
+
+_encoder: Any = None
+_encoder_ready = False
+
+def _get_encoder() -> Any:
+    global _encoder, _encoder_ready
+    if not _encoder_ready:
+        _encoder_ready = True
+        try:
+            import tiktoken
+            from app.services.llm_client_existing import LLM_MODEL
+            try:
+                _encoder = tiktoken.encoding_for_model(LLM_MODEL)
+            except KeyError:
+                _encoder = tiktoken.get_encoding("o200k_base")
+        except Exception as e:
+            # 没装 tiktoken / 取不到编码文件（离线）时退回估算
+            log.warning(f"[compact] tokenizer unavailable, estimating tokens: {type(e).__name__}: {e}")
+            _encoder = None
+    return _encoder
+
+def count_tokens(text: str) -> int:
+    enc = _get_encoder()
+    if enc is not None:
+        return len(enc.encode(text, disallowed_special=()))
+    # 英文合同大约 4 字符 / token
+    return (len(text) + 3) // 4
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    enc = _get_encoder()
+    if enc is not None:
+        ids = enc.encode(text, disallowed_special=())
+        return text if len(ids) <= max_tokens else enc.decode(ids[:max_tokens])
+    return text[:max_tokens * 4]
+
+def _edge_key(line: str) -> str:
+    return _DIGITS_RE.sub("#", _SPACES_RE.sub(" ", line.strip().lower()))
+
+def _normalize(text: str) -> str:
+    text = text.replace("\r\n", "\n").replace("\r", "\n")
+    text = _SOFT_HYPHEN_RE.sub(r"\1", text).replace("\u00ad", "")
+    text = _HYPHEN_RE.sub(r"\1-", text)
+    lines = [_SPACES_RE.sub(" ", ln).strip() for ln in text.split("\n")]
+    return "\n".join(lines)
+
+def _edge_indexes(lines: List[str]) -> set:
+    """页首/页尾候选行的下标；页面很短时窗口跟着缩小，避免把正文当页眉页脚"""
+    nonempty = [i for i, ln in enumerate(lines) if ln]
+    k = min(EDGE_LINES, len(nonempty) // 3)
+    if k <= 0:
+        return set()
+    return {i for i in nonempty[:k] + nonempty[-k:] if len(lines[i]) <= MAX_EDGE_CHARS}
+
+def _repeated_edges(pages: List[List[str]]) -> set:
+    if len(pages) < 3:
+        return set()
+    counts: Counter = Counter()
+    for lines in pages:
+        counts.update({_edge_key(lines[i]) for i in _edge_indexes(lines)})
+    need = max(3, int(len(pages) * REPEAT_RATIO))
+    return {k for k, n in counts.items() if n >= need and k}
+
+def compact_pages(texts: List[str]) -> Tuple[List[str], Dict[str, int]]:
+    norm = [_normalize(t or "").split("\n") for t in texts]
+    boiler = _repeated_edges(norm)
+    removed = {"boilerplate": 0, "page_numbers": 0, "signature_lines": 0}
+
+    out: List[str] = []
+    for lines in norm:
+        edge_idx = _edge_indexes(lines)
+        kept: List[str] = []
+        for i, ln in enumerate(lines):
+            if ln and i in edge_idx and _edge_key(ln) in boiler:
+                removed["boilerplate"] += 1
+                continue
+            if ln and i in edge_idx and _PAGE_NO_RE.match(ln):
+                removed["page_numbers"] += 1
+                continue
+            if ln and (_SIGNATURE_RE.match(ln) or _RULE_RE.match(ln)):
+                removed["signature_lines"] += 1
+                continue
+            kept.append(ln)
+        out.append(_BLANKS_RE.sub("\n\n", "\n".join(kept)).strip())
+    return out, removed
+
+def compact_extract(extract: ExtractResult) -> Tuple[ExtractResult, Dict[str, Any]]:
+    """
+    返回（页面文本已压缩的 ExtractResult 副本, 统计）。原 extract 不变（debug 输出用原文）。
+    """
+    before = count_tokens("\n".join(p.text or "" for p in extract.pages))
+    if not COMPACT_ENABLED:
+        return extract, {"tokens_before": before, "tokens_after": before, "tokens_saved": 0}
+
+    texts, removed = compact_pages([p.text or "" for p in extract.pages])
+    pages = [p.model_copy(update={"text": t}) for p, t in zip(extract.pages, texts)]
+    compacted = extract.model_copy(update={"pages": pages})
+    after = count_tokens("\n".join(texts))
+    stats: Dict[str, Any] = {
+        "tokens_before": before,
+        "tokens_after": after,
+        "tokens_saved": before - after,
+        "lines_removed": removed,
+    }
+    log.info(f"[compact] {extract.meta.filename!r} tokens {before} -> {after} (saved {before - after}) removed={removed}")
+    return compacted, stats
@@ -0,0 +1,115 @@
+# app/services/rate_limit.py
+"""
+Cluster-wide LLM rate limiter: requests/min + tokens/min token buckets in Redis.
+
+多个容器同时消费队列时各自打 OpenAI，没有协调，容易 429 连锁（重试又加重）。
+这里在 Redis 里放一对令牌桶（每个模型一个 hash：lease:ratelimit:<model>），所有 worker 共用：
+
+  LLM_RPM_LIMIT / LLM_TPM_LIMIT   每分钟请求数 / token 数；0 = 不限（都为 0 时整个限流关闭）
+  LLM_RATELIMIT_BURST_SECONDS     桶容量 = 多少秒的额度（默认 60，即一分钟的量可以一次用完）
+  LLM_RATELIMIT_MAX_WAIT_SECONDS  单次最多等多久；超过就不再等、直接发（429 交给 llm_resilience）
+
+acquire(tokens)：Lua 里按 Redis TIME 补充两个桶，然后直接扣（可以扣成负数 = 预约），
+返回余额回到 0 需要的秒数，调用方睡这么久再发请求。先到先扣，大请求不会被小请求饿死，
+也不用轮询；比桶容量还大的请求照样按全额扣（欠的额度按速率补上）。
+token 估算 = prompt token + max_tokens（和 OpenAI 计 TPM 的方式一致：按 max_tokens 预扣）。
+对冲请求只扣不等（见 llm_resilience）。Redis 出错时不限流（只记日志）。
+
+当前余量：fill()，/metrics 里的 lease_llm_ratelimit_fill{bucket}（0..1）；
+等待次数 / 秒数：lease_llm_ratelimit_waits_total / lease_llm_ratelimit_wait_seconds_total。
+"""
+import os, time, asyncio, logging
+from typing import Optional, Dict, Tuple
+
+log = logging.getLogger("lease")
+
+RPM_LIMIT      = float(os.environ.get("LLM_RPM_LIMIT", "0"))
+TPM_LIMIT      = float(os.environ.get("LLM_TPM_LIMIT", "0"))
+BURST_SECONDS  = float(os.environ.get("LLM_RATELIMIT_BURST_SECONDS", "60"))
+MAX_WAIT       = float(os.environ.get("LLM_RATELIMIT_MAX_WAIT_SECONDS", "300"))
+RATELIMIT_ENABLED = RPM_LIMIT > 0 or TPM_LIMIT > 0
+
+RPFX = "lease:ratelimit:"
+
+# KEYS: bucket hash   ARGV: rpm, tpm, burst_seconds, cost_requests, cost_tokens
+# 返回 {wait 秒, 请求桶余量, token 桶余量}（字符串：Lua 数字回给 Redis 会被截成整数）
+_ACQUIRE_LUA = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local rpm, tpm, burst = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local cap_r, cap_t = rpm * burst / 60, tpm * burst / 60
+local h = redis.call('HMGET', KEYS[1], 'r', 't', 'ts')
+local r = tonumber(h[1]) or cap_r
+local tk = tonumber(h[2]) or cap_t
+local ts = tonumber(h[3]) or now
+local dt = math.max(0, now - ts)
+r = math.min(cap_r, r + dt * rpm / 60) - tonumber(ARGV[4])
+tk = math.min(cap_t, tk + dt * tpm / 60) - tonumber(ARGV[5])
+local wait = 0
+if rpm > 0 and r < 0 then wait = math.max(wait, -r * 60 / rpm) end
+if tpm > 0 and tk < 0 then wait = math.max(wait, -tk * 60 / tpm) end
+redis.call('HSET', KEYS[1], 'r', r, 't', tk, 'ts', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(burst) + 3600)
+return {tostring(wait), tostring(r), tostring(tk)}
+"""
+
+def _key() -> str:
+    from app.services.llm_client_existing import LLM_MODEL  # llm_client 依赖本模块，延迟导入
+    return f"{RPFX}{LLM_MODEL}"
+
+def _args(requests: int, tokens: int) -> Tuple[float, ...]:
+    return (RPM_LIMIT, TPM_LIMIT, BURST_SECONDS, requests, tokens)
+
+def _record_wait(seconds: float) -> None:
+    from app.services import metrics
+    metrics.inc("lease_llm_ratelimit_waits_total")
+    metrics.inc("lease_llm_ratelimit_wait_seconds_total", seconds)
+
+def _reserve(tokens: int) -> float:
+    """扣额度，返回需要等待的秒数；Redis 出错返回 0（不限流）"""
+    from app.services import job_store
+    try:
+        return float(job_store._r.eval(_ACQUIRE_LUA, 1, _key(), *_args(1, tokens))[0])
+    except Exception as e:
+        log.warning(f"[ratelimit] acquire failed, not limiting: {e}")
+        return 0.0
+
+def acquire(tokens: int, *, wait: bool = True) -> float:
+    """扣 1 个请求 + tokens 个 token；wait=True 时睡到额度够为止。返回等待秒数"""
+    if not RATELIMIT_ENABLED:
+        return 0.0
+    w = _reserve(tokens)
+    if not wait or w <= 0:
+        return 0.0
+    w = min(w, MAX_WAIT)
+    log.info(f"[ratelimit] waiting {w:.2f}s for budget (tokens={tokens})")
+    time.sleep(w)
+    _record_wait(w)
+    return w
+
+async def aacquire(tokens: int, *, wait: bool = True) -> float:
+    if not RATELIMIT_ENABLED:
+        return 0.0
+    # 同步客户端放线程里跑：/worker/tick 的 run_jobs 每次 asyncio.run 都是新 loop，
+    # 模块级的 redis.asyncio 客户端绑在第一个 loop 上，换 loop 后会报 "Event loop is closed"
+    w = await asyncio.to_thread(_reserve, tokens)
+    if not wait or w <= 0:
+        return 0.0
+    w = min(w, MAX_WAIT)
+    log.info(f"[ratelimit] waiting {w:.2f}s for budget (tokens={tokens})")
+    await asyncio.sleep(w)
+    await asyncio.to_thread(_record_wait, w)
+    return w
+
+def fill() -> Optional[Dict[str, float]]:
+    """两个桶当前的余量比例（0..1，预约出去的部分算 0）；限流关闭时返回 None"""
+    if not RATELIMIT_ENABLED:
+        return None
+    from app.services import job_store
+    _, r, tk = job_store._r.eval(_ACQUIRE_LUA, 1, _key(), *_args(0, 0))
+    out: Dict[str, float] = {}
+    if RPM_LIMIT > 0:
+        out["requests"] = min(1.0, max(0.0, float(r)) / (RPM_LIMIT * BURST_SECONDS / 60))
+    if TPM_LIMIT > 0:
+        out["tokens"] = min(1.0, max(0.0, float(tk)) / (TPM_LIMIT * BURST_SECONDS / 60))
+    return out
@@ -0,0 +1,158 @@
+# app/services/result_cache.py
+"""
+Content-addressed cache of finished analyses.
+
+Key = (PDF sha256, normalized jurisdiction, analysis version). The version is
+derived from the model name + SYSTEM_PROMPT + LEASE_SCHEMA, so changing any of
+them invalidates old entries automatically. Entries live in the same Redis as
+job_store, with their own TTL and an LRU index (ZSET) capped at CACHE_MAX_ENTRIES.
+
+In-flight coalescing: the first job for a key takes a short Redis lock and runs
+the analysis; concurrent jobs for the same key wait for the cached result
+instead of starting their own LLM call.
+"""
+import os, json, time, uuid, hashlib, logging, threading
+from contextlib import contextmanager
+from typing import Optional, Dict, Any, Iterator
+
+from app.services import job_store
+from app.services.llm_client_existing import LLM_MODEL, SYSTEM_PROMPT, LEASE_SCHEMA
+from app.services.clause_screen import SCREEN_ENABLED, SCREEN_MIN_PAGES, SCREEN_MIN_SCORE
+
+log = logging.getLogger("lease")
+
+CACHE_ENABLED     = os.environ.get("ANALYSIS_CACHE", "1") not in ("0", "false", "False", "")
+CACHE_TTL         = int(os.environ.get("ANALYSIS_CACHE_TTL_SECONDS", str(7 * 86400)))
+CACHE_MAX_ENTRIES = int(os.environ.get("ANALYSIS_CACHE_MAX_ENTRIES", "5000"))
+INFLIGHT_TTL      = int(os.environ.get("ANALYSIS_INFLIGHT_TTL_SECONDS", "300"))
+INFLIGHT_WAIT     = float(os.environ.get("ANALYSIS_INFLIGHT_WAIT_SECONDS", "240"))
+# 手动改 prompt 组装方式（llm_prep_adapter 等）时递增
+CACHE_VERSION     = "5"
+
+CPFX = "lease:cache:"          # 结果缓存 string 前缀
+LRU_KEY = "lease:cache:lru"    # zset: key -> last access ts
+LPFX = "lease:inflight:"       # 进行中的分析锁前缀
+
+# compare-and-delete，避免误删别人续上的锁
+_RELEASE_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+def _analysis_version() -> str:
+    h = hashlib.sha256()
+    h.update(CACHE_VERSION.encode())
+    h.update(LLM_MODEL.encode())
+    h.update(SYSTEM_PROMPT.encode("utf-8"))
+    h.update(json.dumps(LEASE_SCHEMA, sort_keys=True).encode("utf-8"))
+    # 预筛改变了送给模型的内容
+    h.update(f"screen={int(SCREEN_ENABLED)}:{SCREEN_MIN_PAGES}:{SCREEN_MIN_SCORE}".encode())
+    return h.hexdigest()[:12]
+
+ANALYSIS_VERSION = _analysis_version()
+
+def normalize_jurisdiction(jurisdiction: Optional[dict]) -> str:
+    j = jurisdiction or {}
+    norm = {
+        k: str(j.get(k) or "").strip().lower()
+        for k in ("country", "state", "city")
+    }
+    return json.dumps(norm, sort_keys=True, separators=(",", ":"))
+
+def cache_key(sha256: str, jurisdiction: Optional[dict]) -> str:
+    jhash = hashlib.sha1(normalize_jurisdiction(jurisdiction).encode()).hexdigest()[:12]
+    return f"{CPFX}{ANALYSIS_VERSION}:{sha256}:{jhash}"
+
+def get(key: str) -> Optional[Dict[str, Any]]:
+    try:
+        raw = job_store._r.get(key)
+        if raw is None:
+            log.info(f"[cache] GET {key} -> miss")
+            return None
+        # 命中：刷新 LRU 时间戳 + 滑动 TTL
+        p = job_store._r.pipeline()
+        p.zadd(LRU_KEY, {key: time.time()})
+        p.expire(key, CACHE_TTL)
+        p.execute()
+        log.info(f"[cache] GET {key} -> hit")
+        return json.loads(raw)
+    except Exception as e:
+        log.warning(f"[cache] get failed (ignored): {e}")
+        return None
+
+def put(key: str, value: Dict[str, Any]) -> None:
+    try:
+        payload = json.dumps(value, ensure_ascii=False)
+        p = job_store._r.pipeline()
+        p.set(key, payload, ex=CACHE_TTL)
+        p.zadd(LRU_KEY, {key: time.time()})
+        p.zcard(LRU_KEY)
+        _, _, n = p.execute()
+        log.info(f"[cache] SET {key} len={len(payload)} entries={n}")
+        if n > CACHE_MAX_ENTRIES:
+            _evict(n - CACHE_MAX_ENTRIES)
+    except Exception as e:
+        log.warning(f"[cache] put failed (ignored): {e}")
+
+def _evict(n: int) -> None:
+    """按最近访问时间淘汰最旧的 n 个条目（TTL 过期的也会在这里被清掉索引）"""
+    oldest = job_store._r.zpopmin(LRU_KEY, n)
+    keys = [k for k, _ in oldest]
+    if keys:
+        job_store._r.delete(*keys)
+    log.info(f"[cache] evicted {len(keys)} entries")
+
+@contextmanager
+def inflight(key: str) -> Iterator[bool]:
+    """
+    Yields True if this caller owns the analysis for `key` (leader),
+    False if another job is already running it (follower -> call wait_for).
+    """
+    lkey = f"{LPFX}{key[len(CPFX):]}"
+    token = uuid.uuid4().hex
+    try:
+        leader = bool(job_store._r.set(lkey, token, nx=True, ex=INFLIGHT_TTL))
+    except Exception as e:
+        log.warning(f"[cache] inflight lock failed (ignored): {e}")
+        yield True
+        return
+    log.info(f"[cache] inflight {lkey} -> {'leader' if leader else 'follower'}")
+    try:
+        yield leader
+    finally:
+        if leader:
+            try:
+                job_store._r.eval(_RELEASE_LUA, 1, lkey, token)
+            except Exception as e:
+                log.warning(f"[cache] inflight release failed (ignored): {e}")
+
+def wait_for(key: str, *, timeout: float = INFLIGHT_WAIT, interval: float = 0.2,
+             stop: Optional[threading.Event] = None) -> Optional[Dict[str, Any]]:
+    """
+    Follower side of coalescing: poll until the leader stores the result,
+    the leader's lock disappears (it failed or crashed), `timeout` passes
+    or `stop` is set. Blocking; the staged pipeline runs it on its own pool.
+    """
+    lkey = f"{LPFX}{key[len(CPFX):]}"
+    deadline = time.time() + timeout
+    while True:
+        hit = get(key)
+        if hit is not None:
+            return hit
+        try:
+            if not job_store._r.exists(lkey):
+                # leader 结束但没写缓存（失败），最后再看一眼
+                return get(key)
+        except Exception:
+            return None
+        if time.time() >= deadline:
+            break
+        if stop is not None:
+            if stop.wait(interval):
+                return None
+        else:
+            time.sleep(interval)
+    log.warning(f"[cache] wait_for {key} timed out after {timeout}s")
+    return None
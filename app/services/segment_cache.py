@@ -0,0 +1,160 @@
+# app/services/segment_cache.py
+"""
+Per-page findings cache for incremental re-analysis of revised leases.
+
+租客谈判后常上传 v2 / v3，通常只改了一两页。整份结果缓存（result_cache）按 PDF sha256 命中不了，
+这里按页缓存：key = (分析版本, 地域, 压缩后页面文本的哈希) -> 该页的 findings。
+
+  plan(extract, jurisdiction)  一次 MGET 查所有页；复用比例够（SEGMENT_REUSE_MIN_RATIO）时
+                               只把变化的页交给 LLM（plan.changed 是只含这些页的 ExtractResult）
+  combine(plan, llm_out)       缓存页的 findings（页码改成新位置）+ 新分析的 findings，去重后重算 summary；
+                               同时把新分析页的 findings 写回缓存
+  plan.stats()                 {"total", "reused", "analyzed", "reused_findings"}，写进结果 meta["segments"]
+
+页面哈希前先做归一化（小写、合并空白），页眉页脚 / 页码已经被 prompt_compact 去掉，
+前面插一页导致后面页码整体后移也能命中。findings 按 evidence[0].page（LEASE_SCHEMA 里页码只在 evidence 上）
+归页，没有的按 original_text 在页面文本里查找；仍然有归不了页的，本次分析的页一律不写缓存
+（不能把它当成某一页的结果，也不能把别的页当成"没有问题"存下来），findings 照常返回。
+"""
+import os, re, json, hashlib, logging
+from typing import Optional, Dict, Any, List, Tuple
+
+from app.models.extract_models import ExtractResult
+from app.models.llm_models import LlmOutput, Finding
+from app.services import job_store, result_cache
+from app.services.chunked_analysis import dedupe_findings, recompute_summary
+
+log = logging.getLogger("lease")
+
+SEGMENT_CACHE_ENABLED = os.environ.get("SEGMENT_CACHE", "1") not in ("0", "false", "False", "")
+# 复用的页少于这个比例就整份重跑（只剩零星几页时，上下文完整更重要）
+SEGMENT_REUSE_MIN_RATIO = float(os.environ.get("SEGMENT_REUSE_MIN_RATIO", "0.3"))
+SEGMENT_TTL = int(os.environ.get("SEGMENT_CACHE_TTL_SECONDS", str(result_cache.CACHE_TTL)))
+
+SPFX = "lease:seg:"            # 每页 findings（string，JSON list）
+
+_WS_RE = re.compile(r"\s+")
+
+def _norm(text: str) -> str:
+    return _WS_RE.sub(" ", (text or "").lower()).strip()
+
+def page_hash(text: str) -> str:
+    return hashlib.sha256(_norm(text).encode("utf-8")).hexdigest()[:32]
+
+def _key(jhash: str, h: str) -> str:
+    return f"{SPFX}{result_cache.ANALYSIS_VERSION}:{jhash}:{h}"
+
+class SegmentPlan:
+    """一次分析的分页计划：哪些页复用缓存、哪些页要送 LLM"""
+    __slots__ = ("jhash", "pages", "hashes", "cached", "changed", "jurisdiction")
+
+    def __init__(self, jhash: str, pages: List[Any], hashes: List[str], cached: Dict[int, List[Dict[str, Any]]],
+                 changed: Optional[ExtractResult], jurisdiction: Optional[dict]):
+        self.jhash = jhash
+        self.pages = pages                # 压缩后的 ExtractPage（全部）
+        self.hashes = hashes              # 与 pages 一一对应
+        self.cached = cached              # 复用的页：page 号 -> findings（dict）
+        self.changed = changed            # 只含要分析的页；None = 整份分析
+        self.jurisdiction = jurisdiction
+
+    @property
+    def reused(self) -> int:
+        return len(self.cached)
+
+    def cached_findings(self) -> List[Finding]:
+        """复用页的 findings，页码填成新位置（流式模式下 LLM 调用前就可以先发布）"""
+        return [Finding(**{**f, "page": page, "evidence": [{**e, "page": page} for e in f.get("evidence") or []]})
+                for page, fs in sorted(self.cached.items()) for f in fs]
+
+    def stats(self) -> Dict[str, int]:
+        return {"total": len(self.pages), "reused": self.reused, "analyzed": len(self.pages) - self.reused,
+                "reused_findings": sum(len(v) for v in self.cached.values())}
+
+def plan(extract: ExtractResult, jurisdiction: Optional[dict]) -> Optional[SegmentPlan]:
+    """
+    extract 是压缩后的结果。返回 None 表示不启用分页缓存（关闭 / 没有页）。
+    plan.changed 为 None 时照常整份分析，combine 只负责写回缓存。
+    """
+    if not SEGMENT_CACHE_ENABLED or not extract.pages:
+        return None
+    jhash = hashlib.sha1(result_cache.normalize_jurisdiction(jurisdiction).encode()).hexdigest()[:12]
+    hashes = [page_hash(p.text or "") for p in extract.pages]
+    try:
+        raw = job_store._r.mget([_key(jhash, h) for h in hashes])
+    except Exception as e:
+        log.warning(f"[segments] lookup failed (ignored): {e}")
+        raw = [None] * len(hashes)
+
+    cached: Dict[int, List[Dict[str, Any]]] = {}
+    for p, r in zip(extract.pages, raw):
+        if r is not None and (p.text or "").strip():
+            cached[p.page] = json.loads(r)
+    sp = SegmentPlan(jhash, list(extract.pages), hashes, {}, None, jurisdiction)
+    if cached and len(cached) / len(extract.pages) >= SEGMENT_REUSE_MIN_RATIO:
+        sp.cached = cached
+        sp.changed = extract.model_copy(update={"pages": [p for p in extract.pages if p.page not in cached]})
+    log.info(f"[segments] {extract.meta.filename!r} pages={len(hashes)} cached={len(cached)} "
+             f"reuse={'yes' if sp.changed is not None else 'no'}")
+    return sp
+
+def _finding_page(f: Finding, by_page: Dict[int, Any], texts: List[Any]) -> Optional[int]:
+    for page in [f.page] + [e.page for e in f.evidence[:1]]:
+        if page in by_page:
+            return page
+    probe = _norm(f.original_text)[:80]
+    return next((n for n, t in texts if probe and probe in t), None)
+
+def _attribute(findings: List[Finding], pages: List[Any]) -> Tuple[Dict[int, List[Finding]], List[Finding]]:
+    """把 findings 归到页：page 字段、evidence[0].page、original_text 开头在页面文本里找；返回 (按页, 归不了页的)"""
+    by_page: Dict[int, List[Finding]] = {p.page: [] for p in pages}
+    lost: List[Finding] = []
+    texts = [(p.page, _norm(p.text or "")) for p in pages]
+    for f in findings:
+        page = _finding_page(f, by_page, texts)
+        if page is None:
+            lost.append(f)
+        else:
+            by_page[page].append(f)
+    return by_page, lost
+
+def _store(sp: SegmentPlan, analyzed: Dict[int, List[Finding]]) -> None:
+    hashes = dict(zip((p.page for p in sp.pages), sp.hashes))
+    try:
+        p = job_store._r.pipeline(transaction=False)
+        for page, fs in analyzed.items():
+            # 不存 page（复用时按新位置填）和 id（合并后重新编号）
+            p.set(_key(sp.jhash, hashes[page]),
+                  json.dumps([f.model_dump(exclude={"id", "page"}) for f in fs], ensure_ascii=False), ex=SEGMENT_TTL)
+        p.execute()
+    except Exception as e:
+        log.warning(f"[segments] store failed (ignored): {e}")
+
+def combine(sp: SegmentPlan, llm_out: LlmOutput) -> LlmOutput:
+    """llm_out 是本次分析（整份或只有变化页）的结果；返回合并后的完整结果"""
+    analyzed_pages = sp.changed.pages if sp.changed is not None else sp.pages
+    by_page, lost = _attribute(llm_out.findings, analyzed_pages)
+    if lost:
+        log.warning(f"[segments] {len(lost)} findings without a page, not caching pages of this analysis")
+    else:
+        # 空白页（图片页 / 扫描页没 OCR 出文字）不缓存：内容哈希都一样，没有意义
+        _store(sp, {n: fs for n, fs in by_page.items()
+                    if any(p.page == n and (p.text or "").strip() for p in analyzed_pages)})
+    if sp.changed is None:
+        return llm_out
+
+    for page, fs in by_page.items():
+        for f in fs:
+            if f.page is None:
+                f.page = page
+
+    findings = dedupe_findings(sp.cached_findings() + list(llm_out.findings))
+    findings.sort(key=lambda f: f.page if f.page is not None else 0)
+    for i, f in enumerate(findings, 1):
+        f.id = str(i)
+    summary = recompute_summary(findings, [llm_out.summary] if sp.changed.pages else [])
+    if summary.jurisdiction is None and sp.jurisdiction:
+        summary.jurisdiction = sp.jurisdiction
+    st = sp.stats()
+    log.info(f"[segments] reused {st['reused']}/{st['total']} pages ({st['reused_findings']} findings), "
+             f"analyzed {st['analyzed']} -> {len(findings)} findings risk={summary.risk_score}")
+    return LlmOutput(schema_version=llm_out.schema_version, summary=summary, findings=findings)
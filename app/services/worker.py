@@ -0,0 +1,214 @@
+# app/services/worker.py
+"""
+Job execution: download -> analyze -> save.
+
+Two ways to drive it:
+  * run_job(job_id, base_url)        同步，/worker/tick 单个任务用（保留原有触发方式）
+  * run_jobs(job_ids, base_url)      一次多个任务：走分阶段流水线（app.services.pipeline）
+  * WorkerEngine                     常驻 asyncio 引擎：BLPOP 阻塞等就绪令牌、按通道公平取任务，交给常驻的
+                                     StagedPipeline（下载 / 解析 / LLM / 保存 各阶段独立并发）
+
+Run the engine standalone with `python -m app.services.worker`, or inside the
+API process by setting WORKER_ENGINE=1 (see app.main lifespan).
+"""
+import os, time, signal, asyncio, logging, traceback
+from contextlib import nullcontext
+from typing import Optional, List, Dict
+
+import httpx
+
+from app.services.orchestrator import analyze_pipeline
+from app.services.pipeline import StagedPipeline, run_jobs_staged, _jurisdiction, _finish
+from app.services.pdf_extract import shutdown_pool
+from app.services.llm_client_existing import close_clients, aclose_async_client, track_usage
+from app.services.llm_stream import FindingPublisher
+from app.services.metrics import observe_job
+from app.services.blob_store import BLOB_BACKEND, download_to_tempfile, delete_blob
+from app.services.job_store import (
+    bpop_job, ack_job, extend_leases, reap_expired,
+    set_status, save_error, get_job, VISIBILITY_TIMEOUT
+)
+
+log = logging.getLogger("lease")
+
+# === Blob helper endpoints (Node routes in the same Vercel project) ===
+# Only used with BLOB_BACKEND=node (see blob_store); gcs/local read the bucket directly.
+#   POST   /api/blob/fetch    -> returns raw bytes of a private blob (server-to-server)
+#   POST   /api/blob/delete   -> deletes a blob by pathname
+BLOB_HELPER_BASE = os.environ.get("BLOB_HELPER_BASE") or ""  # e.g. "https://<your-app>.vercel.app"
+
+WORKER_CONCURRENCY   = int(os.environ.get("WORKER_CONCURRENCY", "4"))
+WORKER_POLL_TIMEOUT  = int(os.environ.get("WORKER_POLL_TIMEOUT_SECONDS", "5"))
+WORKER_SHUTDOWN_GRACE = float(os.environ.get("WORKER_SHUTDOWN_GRACE_SECONDS", "60"))
+REAPER_INTERVAL      = float(os.environ.get("WORKER_REAPER_INTERVAL_SECONDS", "30"))
+
+# ========= 同步路径：/worker/tick =========
+def run_job(job_id: str, base_url: str) -> None:
+    t_start = time.time()
+    timings: Dict[str, float] = {}
+    usage: Optional[Dict[str, int]] = None
+    status, filename, lane = "error", None, None
+    try:
+        set_status(job_id, "running", "decoding")
+        data = get_job(job_id)
+        if not data:
+            log.warning(f"[worker] job_id={job_id} hgetall miss")
+            return
+        filename = data["filename"]
+        debug = data.get("debug", False)
+        enqueued_at = float(data.get("enqueued_at") or data.get("created_at") or t_start)
+        timings["queue_wait"] = max(0.0, t_start - enqueued_at)
+        lane = data.get("lane")
+        log.info(f"[worker] job_id={job_id} file={filename!r} debug={debug} lane={lane}")
+
+        # Acquire PDF: stream the private Blob into a temp file, PyMuPDF opens it by path
+        blob_pathname = data.get("blob_pathname")
+        log.info(f"[worker] fetching blob_pathname={blob_pathname!r}")
+        if blob_pathname:
+            set_status(job_id, "running", "downloading")
+        t0 = time.perf_counter()
+        with (download_to_tempfile(blob_pathname, base_url=base_url) if blob_pathname else nullcontext()) as bf:
+            if blob_pathname:
+                timings["download"] = time.perf_counter() - t0
+            set_status(job_id, "running", "analyzing")
+            pub = FindingPublisher(job_id, since=enqueued_at)
+            with track_usage() as u:
+                try:
+                    result = analyze_pipeline(filename or "unknown.pdf", None, debug=bool(debug), jurisdiction=_jurisdiction(data),
+                                              path=bf.path if bf else None, sha256=bf.sha256 if bf else None, timings=timings,
+                                              on_findings=pub)
+                finally:
+                    usage = u.as_dict()
+                    if pub.first_after is not None:
+                        timings["first_finding"] = pub.first_after
+
+        t0 = time.perf_counter()
+        ok = _finish(job_id, result)
+        timings["persist"] = time.perf_counter() - t0
+        status = "done" if ok else "error"
+        if ok and blob_pathname:
+            # Best-effort delete the private blob after success
+            delete_blob(blob_pathname, base_url=base_url)
+    except Exception as e:
+        log.error(f"[worker] job_id={job_id} crashed: {type(e).__name__}: {e}\n{traceback.format_exc()}")
+        save_error(job_id, f"{type(e).__name__}: {e}", code=getattr(e, "code", None))
+    finally:
+        if "queue_wait" in timings:
+            timings["total"] = timings["queue_wait"] + time.time() - t_start
+            observe_job(job_id, timings, usage, status, filename=filename, lane=lane)
+        ack_job(job_id)
+
+def run_jobs(job_ids: List[str], base_url: str) -> None:
+    """多个任务：跑一个临时的分阶段流水线，让下载/解析和 LLM 等待在任务之间重叠"""
+    if len(job_ids) == 1:
+        run_job(job_ids[0], base_url)
+        return
+    asyncio.run(run_jobs_staged(job_ids, base_url))
+
+# ========= 异步路径：WorkerEngine =========
+class WorkerEngine:
+    """
+    常驻 worker：阻塞在 Redis 队列上，取到的任务交给 StagedPipeline；
+    流水线入口队列满了就先不取（背压）。stop() 后不再取新任务，
+    并等待在途任务最多 WORKER_SHUTDOWN_GRACE 秒。
+    """
+
+    def __init__(self, *, concurrency: int = WORKER_CONCURRENCY, base_url: str = BLOB_HELPER_BASE):
+        # concurrency = LLM 阶段并发；其它阶段见 PIPELINE_*_CONCURRENCY
+        self.concurrency = max(1, concurrency)
+        self.base_url = base_url.rstrip("/")
+        self._stop = asyncio.Event()
+        self.pipeline: Optional[StagedPipeline] = None
+        self.handled = 0
+
+    @property
+    def running(self) -> bool:
+        return not self._stop.is_set()
+
+    @property
+    def in_flight(self) -> int:
+        return self.pipeline.in_flight if self.pipeline else 0
+
+    def stats(self) -> dict:
+        out = {"running": self.running, "handled": self.handled, "in_flight": self.in_flight}
+        if self.pipeline:
+            out.update(self.pipeline.stats())
+        return out
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    async def _housekeeping(self) -> None:
+        """续租在途任务 + 定期回收别的 worker 崩溃遗留的过期租约 + 打印各阶段队列深度"""
+        heartbeat = max(1.0, min(REAPER_INTERVAL, VISIBILITY_TIMEOUT / 3))
+        last_reap = 0.0
+        while not self._stop.is_set():
+            try:
+                if self.pipeline and self.pipeline.in_flight:
+                    await asyncio.to_thread(extend_leases, self.pipeline.job_ids)
+                    st = self.pipeline.stats()["stages"]
+                    log.info("[engine] stages " + " ".join(f"{n}={s['queued']}q/{s['active']}a" for n, s in st.items()))
+                if time.time() - last_reap >= REAPER_INTERVAL:
+                    last_reap = time.time()
+                    await asyncio.to_thread(reap_expired)
+            except Exception as e:
+                log.warning(f"[engine] housekeeping failed: {type(e).__name__}: {e}")
+            try:
+                await asyncio.wait_for(self._stop.wait(), timeout=heartbeat)
+            except asyncio.TimeoutError:
+                pass
+
+    async def run(self) -> None:
+        if not self.base_url and BLOB_BACKEND == "node":
+            log.warning("[engine] BLOB_HELPER_BASE is empty; blob downloads will fail")
+        log.info(f"[engine] started llm_concurrency={self.concurrency}")
+        housekeeping = asyncio.create_task(self._housekeeping())
+        async with httpx.AsyncClient() as http:
+            self.pipeline = StagedPipeline(base_url=self.base_url, http=http, concurrency={"llm": self.concurrency})
+            self.pipeline.start()
+            while not self._stop.is_set():
+                try:
+                    job_id = await bpop_job(timeout=WORKER_POLL_TIMEOUT)
+                except Exception as e:
+                    log.error(f"[engine] dequeue failed: {type(e).__name__}: {e}")
+                    await asyncio.sleep(1.0)
+                    continue
+                if not job_id:
+                    continue
+                self.handled += 1
+                # 入口队列满时在这里等：已取到的任务有租约，续租会覆盖它
+                await self.pipeline.submit(job_id)
+
+            if self.pipeline.in_flight:
+                log.info(f"[engine] stopping, waiting for {self.pipeline.in_flight} in-flight jobs")
+                await self.pipeline.drain(timeout=WORKER_SHUTDOWN_GRACE)
+            await self.pipeline.close()
+        await housekeeping
+        log.info(f"[engine] stopped handled={self.handled}")
+
+# 当前进程内运行的引擎（WORKER_ENGINE=1 时由 app.main 启动）
+engine: Optional[WorkerEngine] = None
+
+def main() -> None:
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+    for name in ("httpx", "httpcore"):
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    async def _run() -> None:
+        eng = WorkerEngine()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, eng.stop)
+        try:
+            await eng.run()
+        finally:
+            await aclose_async_client()
+
+    try:
+        asyncio.run(_run())
+    finally:
+        shutdown_pool()
+        close_clients()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+# bench/bench_extract.py
+"""
+Micro-benchmark: PDF extraction pages/sec and peak RSS, two-pass vs single-pass.
+
+    python -m bench.bench_extract --pages 150 --repeat 3
+
+Each mode runs in its own subprocess so peak RSS (ru_maxrss) is not shared.
+"""
+import argparse, json, os, resource, subprocess, sys, tempfile, time
+
+import fitz
+
+FILLER = (
+    "The Resident agrees to pay monthly Rent on or before the first day of each month. "
+    "The Manager may enter upon the Premises at reasonable times with notice. "
+)
+
+def make_pdf(n_pages: int, blocks_per_page: int = 12) -> bytes:
+    doc = fitz.open()
+    for i in range(n_pages):
+        page = doc.new_page()
+        y = 60
+        for k in range(blocks_per_page):
+            page.insert_textbox(fitz.Rect(60, y, 550, y + 52), f"{i + 1}.{k + 1} " + FILLER, fontsize=8)
+            y += 56
+    return doc.tobytes()
+
+def _child(path: str, single_pass: bool, repeat: int) -> None:
+    # 放到子进程里 import，保证 RSS 只反映本模式
+    from app.services.pdf_extract import extract_from_pdf_bytes
+    data = open(path, "rb").read()
+    extract_from_pdf_bytes("bench.pdf", data, parallel=False, single_pass=single_pass)  # warm-up
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        r = extract_from_pdf_bytes("bench.pdf", data, parallel=False, single_pass=single_pass)
+    dt = time.perf_counter() - t0
+    rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({
+        "single_pass": single_pass,
+        "pages": r.meta.page_count,
+        "pages_per_sec": round(r.meta.page_count * repeat / dt, 1),
+        "peak_rss_mb": round(rss_kb / 1024, 1),
+    }))
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--pages", type=int, default=150)
+    ap.add_argument("--repeat", type=int, default=3)
+    ap.add_argument("--child", choices=["two_pass", "single_pass"])
+    ap.add_argument("--pdf")
+    a = ap.parse_args()
+
+    if a.child:
+        _child(a.pdf, a.child == "single_pass", a.repeat)
+        return
+
+    with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as f:
+        f.write(make_pdf(a.pages))
+        path = f.name
+    try:
+        for mode in ("two_pass", "single_pass"):
+            out = subprocess.run(
+                [sys.executable, "-m", "bench.bench_extract", "--child", mode, "--pdf", path, "--repeat", str(a.repeat)],
+                check=True, capture_output=True, text=True,
+            )
+            print(f"{mode:12s} {out.stdout.strip().splitlines()[-1]}")
+    finally:
+        os.unlink(path)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+# bench/bench_queue.py
+"""
+Queue-scheduling benchmark: interactive wait behind a bulk burst, FIFO vs priority lanes.
+
+    python -m bench.bench_queue
+    python -m bench.bench_queue --bulk-jobs 300 --workers 8 --interactive-every 2 --json
+
+虚拟时钟离散事件模拟，真的走 job_store 的入队 / 取任务（fakeredis 或 --redis），不跑分析：
+t=0 一个租户批量上传 --bulk-jobs 份 --bulk-pages 页的合同，另一个租户批量上传一些小合同；
+之后每 --interactive-every 秒来一份 3 页的单份上传（几个不同租户轮流）。
+--workers 个 worker 空闲就 pop_jobs(1)，处理耗时 = --base-seconds + --seconds-per-page × 页数。
+
+  fifo   全部 RPUSH 到旧版单一队列 QKEY（升级前的行为）
+  lanes  按 main 的方式选通道（pick_lane）+ 租户入队
+
+报告 interactive 任务的排队时间（p50 / p95 / max），以及模拟结束时各租户完成的批量任务数。
+"""
+import argparse, json, os, sys
+from typing import Dict, List, Any, Tuple
+
+from bench.redis_standin import install
+
+def percentile(xs: List[float], p: float) -> float:
+    if not xs:
+        return 0.0
+    xs = sorted(xs)
+    return xs[min(len(xs) - 1, max(0, int(round(p / 100 * len(xs) + 0.5)) - 1))]
+
+def _simulate(a: argparse.Namespace, mode: str) -> Dict[str, Any]:
+    from app.services import job_store
+    job_store._r.flushdb()
+
+    # (到达时间, 租户, 页数, priority)
+    arrivals: List[Tuple[float, str, int, str]] = []
+    arrivals += [(0.0, "bulkco", a.bulk_pages, "bulk")] * a.bulk_jobs
+    arrivals += [(0.0, "smallco", 8, "bulk")] * a.small_bulk_jobs
+    t = 1.0
+    k = 0
+    while t < a.duration:
+        arrivals.append((t, f"user{k % 5}", 3, "interactive"))
+        t += a.interactive_every
+        k += 1
+
+    meta: Dict[str, Tuple[float, str, int, str]] = {}
+    pending = list(arrivals)
+    busy: List[float] = []          # 各 worker 的完成时间
+    waits: List[float] = []
+    done: Dict[str, int] = {}
+    now = 0.0
+    while now <= a.duration:
+        # 到达
+        batch: Dict[Tuple[str, str], List[Tuple[float, str, int, str]]] = {}
+        while pending and pending[0][0] <= now:
+            arr = pending.pop(0)
+            batch.setdefault((arr[1], arr[3]), []).append(arr)
+        for (tenant, priority), arrs in batch.items():
+            if mode == "fifo":
+                ids = [job_store.new_job_id() for _ in arrs]
+                job_store._r.rpush(job_store.QKEY, *ids)
+            elif priority == "interactive":
+                ids = [job_store.enqueue_job("lease.pdf", "", False, tenant=tenant,
+                                             lane=job_store.pick_lane(priority, pages=arr[2])) for arr in arrs]
+            else:
+                ids = job_store.enqueue_jobs([{"filename": "lease.pdf", "lane": job_store.pick_lane(priority, pages=arr[2])}
+                                              for arr in arrs], tenant=tenant)
+            meta.update(zip(ids, arrs))
+        # 完成
+        for fin in [f for f in busy if f <= now]:
+            busy.remove(fin)
+        # 空闲 worker 取任务
+        while len(busy) < a.workers:
+            ids = job_store.pop_jobs(1)
+            if not ids:
+                break
+            arrived, tenant, pages, priority = meta[ids[0]]
+            job_store.ack_job(ids[0])
+            if priority == "interactive":
+                waits.append(now - arrived)
+            else:
+                done[tenant] = done.get(tenant, 0) + 1
+            busy.append(now + a.base_seconds + a.seconds_per_page * pages)
+        nxt = [x for x in (pending[0][0] if pending else None, min(busy) if busy else None) if x is not None]
+        if not nxt:
+            break
+        now = max(now, min(nxt))
+    return {
+        "mode": mode,
+        "interactive_jobs": len(waits),
+        # 一个都没开始时为 None（不是 0 等待）
+        "interactive_wait_p50": round(percentile(waits, 50), 2) if waits else None,
+        "interactive_wait_p95": round(percentile(waits, 95), 2) if waits else None,
+        "interactive_wait_max": round(max(waits), 2) if waits else None,
+        "interactive_started": f"{len(waits)}/{sum(1 for x in arrivals if x[3] == 'interactive')}",
+        "bulk_done": dict(sorted(done.items())),
+    }
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--bulk-jobs", type=int, default=150)
+    ap.add_argument("--bulk-pages", type=int, default=150)
+    ap.add_argument("--small-bulk-jobs", type=int, default=30)
+    ap.add_argument("--interactive-every", type=float, default=5.0, help="seconds between interactive uploads")
+    ap.add_argument("--workers", type=int, default=4)
+    ap.add_argument("--base-seconds", type=float, default=2.0)
+    ap.add_argument("--seconds-per-page", type=float, default=0.25)
+    ap.add_argument("--duration", type=float, default=600.0, help="virtual seconds to simulate")
+    ap.add_argument("--redis", default=None, help="real Redis URL (default: fakeredis)")
+    ap.add_argument("--json", action="store_true")
+    a = ap.parse_args()
+
+    os.environ.setdefault("REDIS_URL", a.redis or "redis://localhost:6379/15")  # job_store 在 import 时读
+    install(a.redis)
+    rows = [_simulate(a, mode) for mode in ("fifo", "lanes")]
+    if a.json:
+        print(json.dumps(rows))
+        return
+    cols = ("interactive_wait_p50", "interactive_wait_p95", "interactive_wait_max", "interactive_started")
+    print(f"{'mode':<8}" + "".join(f"{c.replace('interactive_', ''):>12}" for c in cols) + "  bulk_done")
+    for r in rows:
+        print(f"{r['mode']:<8}" + "".join(f"{'n/a' if r[c] is None else str(r[c]):>12}" for c in cols) + f"  {r['bulk_done']}")
+
+if __name__ == "__main__":
+    sys.exit(main())
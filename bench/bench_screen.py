@@ -0,0 +1,129 @@
+# bench/bench_screen.py
+"""
+Recall / prompt-size benchmark for the local clause pre-screen (app.services.clause_screen).
+
+    python -m bench.bench_screen --docs 30 --pages 10 --appendix-pages 0,4,12
+    python -m bench.bench_screen --docs 60 --min-score 1.5 --json
+
+合成语料（bench.lease_gen）里每个条款段落的原文就是标注：条款原文完整出现在预筛后的
+LLM 输入里算召回，出现在摘要里不算。召回按生成器埋进 PDF 的全部条款计算（分母不剔除任何条款）；
+其中不预筛时 LLM 输入里就已经没有的（解析 / prompt_compact 丢的）另计 missing_before_screen，方便分辨是谁漏的。
+同时报告预筛前后 LLM 输入的 token 数和预筛耗时。
+不调 LLM、不需要 Redis。
+"""
+import argparse, json, os, re, sys, time
+from typing import Dict, List, Any
+
+from bench.lease_gen import generate
+
+_NON_ALNUM = re.compile(r"[^a-z0-9]+")
+
+def _norm(text: str) -> str:
+    return _NON_ALNUM.sub("", text.lower())
+
+def percentile(xs: List[float], p: float) -> float:
+    if not xs:
+        return 0.0
+    xs = sorted(xs)
+    return xs[min(len(xs) - 1, max(0, int(round(p / 100 * len(xs) + 0.5)) - 1))]
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--docs", type=int, default=30)
+    ap.add_argument("--pages", type=int, default=10, help="clause pages per lease")
+    ap.add_argument("--appendix-pages", default="0,4,12", help="comma list, cycled over the corpus")
+    ap.add_argument("--layouts", default="single,two_column,dense")
+    ap.add_argument("--risky-ratio", type=float, default=0.25)
+    ap.add_argument("--seed", type=int, default=5000)
+    ap.add_argument("--min-score", type=float, default=None, help="override CLAUSE_SCREEN_MIN_SCORE")
+    ap.add_argument("--json", action="store_true")
+    a = ap.parse_args()
+
+    os.environ.setdefault("REDIS_URL", "redis://localhost:6379/15")  # job_store 在 import 时读
+    if a.min_score is not None:
+        os.environ["CLAUSE_SCREEN_MIN_SCORE"] = str(a.min_score)
+    import logging
+    logging.getLogger("lease").setLevel(logging.ERROR)
+    from app.services.pdf_extract import extract_from_pdf_bytes
+    from app.services.prompt_compact import compact_extract, count_tokens
+    from app.services.llm_prep_adapter import build_llm_inputs
+    from app.services import clause_screen
+
+    layouts = [x for x in a.layouts.split(",") if x]
+    appendix = [int(x) for x in a.appendix_pages.split(",") if x]
+    tot: Dict[str, Any] = {"clauses": 0, "recalled": 0, "risky": 0, "risky_recalled": 0,
+                           "tokens_before": 0, "tokens_after": 0, "pages": 0, "pages_sent": 0, "missing_before_screen": 0}
+    by_cat: Dict[str, List[int]] = {}
+    by_appendix: Dict[int, List[int]] = {}
+    screen_ms: List[float] = []
+    misses: List[Dict[str, Any]] = []
+
+    for i in range(a.docs):
+        app_pages = appendix[i % len(appendix)]
+        data, info = generate(a.pages, layout=layouts[i % len(layouts)], seed=a.seed + i,
+                              risky_ratio=a.risky_ratio, appendix_pages=app_pages)
+        extract = extract_from_pdf_bytes(f"bench-{i}.pdf", data)
+        compacted, _ = compact_extract(extract)
+        t0 = time.perf_counter()
+        screened, stats = clause_screen.screen(compacted)
+        screen_ms.append((time.perf_counter() - t0) * 1000)
+        full = "\n".join(build_llm_inputs(compacted))
+        before, seen = count_tokens(full), _norm(full)
+        sent = _norm("\n".join(build_llm_inputs(screened)))
+        after = count_tokens("\n".join(build_llm_inputs(screened)))
+        tot["tokens_before"] += before
+        tot["tokens_after"] += after
+        tot["pages"] += len(compacted.pages)
+        tot["pages_sent"] += stats.get("pages_sent", len(compacted.pages))
+        ba = by_appendix.setdefault(app_pages, [0, 0])
+        ba[0] += before
+        ba[1] += after
+        for c in info["clauses"]:
+            # 去掉段落编号（"12. RENT. ..."），只比条款正文
+            body = _norm(c["text"].split(". ", 2)[-1])
+            if body not in seen:
+                tot["missing_before_screen"] += 1
+            hit = body in sent
+            tot["clauses"] += 1
+            tot["recalled"] += hit
+            if c["risky"]:
+                tot["risky"] += 1
+                tot["risky_recalled"] += hit
+                bc = by_cat.setdefault(c["category"], [0, 0])
+                bc[0] += 1
+                bc[1] += hit
+            if not hit and len(misses) < 5:
+                misses.append({"doc": i, "page": c["page"], "category": c["category"], "text": c["text"][:80]})
+
+    report = {
+        "docs": a.docs, "clause_pages": a.pages, "appendix_pages": appendix, "layouts": a.layouts,
+        "min_score": clause_screen.SCREEN_MIN_SCORE,
+        "recall_all": round(tot["recalled"] / max(1, tot["clauses"]), 4),
+        "recall_risky": round(tot["risky_recalled"] / max(1, tot["risky"]), 4),
+        "recall_risky_by_category": {k: round(v[1] / v[0], 4) for k, v in sorted(by_cat.items())},
+        "missing_before_screen": tot["missing_before_screen"],
+        "pages_sent": f"{tot['pages_sent']}/{tot['pages']}",
+        "tokens_before": tot["tokens_before"], "tokens_after": tot["tokens_after"],
+        "token_reduction": round(1 - tot["tokens_after"] / max(1, tot["tokens_before"]), 4),
+        "token_reduction_by_appendix": {k: round(1 - v[1] / max(1, v[0]), 4) for k, v in sorted(by_appendix.items())},
+        "screen_ms": {"p50": round(percentile(screen_ms, 50), 2), "p95": round(percentile(screen_ms, 95), 2)},
+        "misses": misses,
+    }
+    if a.json:
+        print(json.dumps(report))
+        return
+    print(f"docs={a.docs} clause_pages={a.pages} appendix={appendix} layouts={a.layouts} min_score={report['min_score']}")
+    print(f"recall: all clauses {report['recall_all']:.2%}  risky clauses {report['recall_risky']:.2%}  "
+          f"({tot['risky_recalled']}/{tot['risky']}; {tot['missing_before_screen']} already missing before the screen)")
+    for k, v in report["recall_risky_by_category"].items():
+        print(f"  {k:18s} {v:.2%}")
+    print(f"pages sent {report['pages_sent']}  tokens {tot['tokens_before']} -> {tot['tokens_after']} "
+          f"({-report['token_reduction']:+.1%})")
+    for k, v in report["token_reduction_by_appendix"].items():
+        print(f"  appendix_pages={k:<3d} {-v:+.1%}")
+    print(f"screen p50={report['screen_ms']['p50']}ms p95={report['screen_ms']['p95']}ms")
+    for m in misses:
+        print(f"  miss: {m}")
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,319 @@
+# bench/fake_openai.py
+"""
+Local OpenAI-compatible stand-in for benchmarks (no API spend).
+
+    python -m bench.fake_openai --port 8089 --ttft-ms 400 --tps 80
+    OPENAI_BASE_URL=http://127.0.0.1:8089/v1 OPENAI_API_KEY=bench ...
+
+POST /v1/chat/completions 返回符合 LEASE_SCHEMA 的 JSON，延迟按
+  ttft + prompt_tokens / prefill_tps + completion_tokens / tps（再加 ±jitter）
+模拟；usage 按 4 字符/token 估算。也可以 serve_in_thread() 在进程内起一个。
+stream=true 时按 SSE 逐块返回（首块在 ttft + prefill 之后，之后按 tps 出字；
+stream_options.include_usage 时最后补一个只带 usage 的 chunk）。
+故障注入：--error-rate 返回 500；--rate-limit-rate 返回 429（带 retry-after-ms）；
+--slow-rate 比例的请求慢 --slow-factor 倍（长尾，测对冲）。
+Prompt caching 也按 OpenAI 的规则模拟：前缀 ≥1024 token、以 128 token 为步长逐字节匹配之前见过的请求，
+命中部分记在 usage.prompt_tokens_details.cached_tokens，且不计 prefill 时间。
+
+Batch API（离线批量模式 app.services.batch_mode 用）：
+  POST /v1/files                 上传 JSONL（purpose=batch）
+  GET  /v1/files/{id}/content    下载输入 / 输出文件
+  POST /v1/batches               创建批次，--batch-delay 秒后完成
+  GET  /v1/batches/{id}          查询状态
+"""
+import argparse, asyncio, hashlib, json, random, re, socket, threading, time
+from typing import Dict, Any, Optional, Tuple
+
+import uvicorn
+from fastapi import FastAPI, Body, File, Form, UploadFile, HTTPException
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+
+_CATEGORY_RE = re.compile(r"\b\d+\.\s+([A-Z][A-Z ]{2,30})\.")
+_PAGE_RE = re.compile(r"\[Page (\d+)")
+_NEXT_CLAUSE_RE = re.compile(r"\s(?:R-)?\d+\.\s+[A-Z]")
+# lease_gen 的条款标题 -> LEASE_SCHEMA 的 category 枚举
+_SCHEMA_CATEGORY = {
+    "rent": "money_dates", "late_fee": "money_dates", "security_deposit": "deposit_return",
+    "entry": "repairs_entry", "repairs": "repairs_entry", "termination": "termination",
+    "subletting": "rights_limits", "pets": "rights_limits", "utilities": "utilities",
+    "attorney_fees": "dispute", "waiver": "dispute", "insurance": "insurance_indemnity",
+}
+
+class LatencyModel:
+    def __init__(self, *, ttft_ms: float = 400.0, tps: float = 80.0, prefill_tps: float = 20000.0,
+                 jitter: float = 0.1, error_rate: float = 0.0, batch_delay: float = 2.0,
+                 rate_limit_rate: float = 0.0, retry_after_ms: float = 500.0,
+                 slow_rate: float = 0.0, slow_factor: float = 10.0):
+        self.ttft_ms = ttft_ms
+        self.tps = tps
+        self.prefill_tps = prefill_tps
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.batch_delay = batch_delay
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after_ms = retry_after_ms
+        self.slow_rate = slow_rate
+        self.slow_factor = slow_factor
+
+    def seconds(self, prompt_tokens: int, completion_tokens: int) -> float:
+        s = self.ttft_ms / 1000 + prompt_tokens / max(1.0, self.prefill_tps) + completion_tokens / max(1.0, self.tps)
+        if self.slow_rate and random.random() < self.slow_rate:
+            s *= self.slow_factor
+        return max(0.0, s * (1 + random.uniform(-self.jitter, self.jitter)))
+
+    def first_token(self, prompt_tokens: int) -> float:
+        return self.seconds(prompt_tokens, 0)
+
+    def per_token(self) -> float:
+        return max(0.0, (1 + random.uniform(-self.jitter, self.jitter)) / max(1.0, self.tps))
+
+def _excerpt(prompt: str, m: "re.Match[str]") -> str:
+    """标题后面的条款原文（到下一条为止），折叠空白；不足 40 字符（schema 的 minLength）就往后多带一些"""
+    tail = " ".join(prompt[m.start():m.end() + 600].split())
+    nxt = _NEXT_CLAUSE_RE.search(tail, len(m.group(0)))
+    text = tail[:nxt.start()] if nxt and nxt.start() >= 40 else tail
+    return text[:400].ljust(40, ".")
+
+def _answer(prompt: str) -> Dict[str, Any]:
+    """
+    从合同文本里挑几个条款生成 findings，结构和真实模型一致（满足 LEASE_SCHEMA）：
+    category 映射到 schema 的枚举，original_text / evidence.quote 是合同原文摘录。
+    """
+    findings = []
+    seen = set()
+    for m in _CATEGORY_RE.finditer(prompt):
+        title = m.group(1).strip().lower().replace(" ", "_")
+        if title in seen:
+            continue
+        seen.add(title)
+        cat = _SCHEMA_CATEGORY.get(title, "other")
+        text = _excerpt(prompt, m)
+        pages = _PAGE_RE.findall(prompt, 0, m.start())
+        page = int(pages[-1]) if pages else 1
+        findings.append({
+            "id": str(len(findings) + 1), "status": "borderline", "severity": "medium", "category": cat,
+            "statutes": [], "explanation": f"Synthetic finding for {title}.", "recommendation": "Review this clause.",
+            "evidence": [{"page": page, "quote": text[:200]}],
+            "original_text": text, "low_confidence": True, "tags": ["bench", title],
+        })
+        if len(findings) >= 6:
+            break
+    return {
+        "schema_version": "1.0",
+        "summary": {"verdict": "conditional_ok" if findings else "ok", "risk_score": 10 * len(findings),
+                    "jurisdiction": {"country": "", "state": "", "city": ""}, "notes": "fake_openai"},
+        "findings": findings,
+    }
+
+class PromptCache:
+    """按 128 token（这里 = 512 字符）块记前缀哈希；返回最长已见前缀的 token 数（不足 1024 记 0）"""
+    MIN_TOKENS, STEP = 1024, 128
+
+    def __init__(self):
+        self._seen: set = set()
+
+    def lookup(self, text: str) -> int:
+        step = self.STEP * 4
+        hit, h = 0, hashlib.sha1()
+        for end in range(step, len(text) + 1, step):
+            h.update(text[end - step:end].encode("utf-8"))
+            d = h.hexdigest()
+            if d in self._seen and hit == end - step:
+                hit = end
+            self._seen.add(d)
+        tokens = hit // 4
+        return tokens if tokens >= self.MIN_TOKENS else 0
+
+def _prefix_text(body: Dict[str, Any]) -> str:
+    # 缓存的是整个请求前缀：response_format 的 schema 和 messages 依次拼接
+    fmt = json.dumps(body.get("response_format") or {}, sort_keys=False)
+    return fmt + "".join(f"<{m.get('role')}>{m.get('content', '')}" for m in body.get("messages", []))
+
+def _completion(body: Dict[str, Any], n: int, cache: Optional[PromptCache] = None) -> Tuple[Dict[str, Any], int, int]:
+    prompt = "\n".join(str(m.get("content", "")) for m in body.get("messages", []))
+    content = json.dumps(_answer(prompt))
+    prefix = _prefix_text(body)
+    # schema 也算 prompt token（和真实 API 一样）
+    prompt_tokens, completion_tokens = len(prefix) // 4, len(content) // 4
+    cached = min(prompt_tokens, cache.lookup(prefix)) if cache else 0
+    return {
+        "id": f"chatcmpl-bench-{n}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model", "fake"),
+        "choices": [{"index": 0, "finish_reason": "stop",
+                     "message": {"role": "assistant", "content": content}}],
+        "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                  "total_tokens": prompt_tokens + completion_tokens,
+                  "prompt_tokens_details": {"cached_tokens": cached}},
+    }, prompt_tokens - cached, completion_tokens
+
+STREAM_PIECE_CHARS = 16   # 每个 chunk 约 4 token
+
+def _stream_chunks(resp: Dict[str, Any], include_usage: bool):
+    """把完整响应拆成 chat.completion.chunk 序列"""
+    base = {"id": resp["id"], "object": "chat.completion.chunk", "created": resp["created"], "model": resp["model"]}
+    content = resp["choices"][0]["message"]["content"]
+    for i in range(0, len(content), STREAM_PIECE_CHARS):
+        delta = {"content": content[i:i + STREAM_PIECE_CHARS]}
+        if i == 0:
+            delta["role"] = "assistant"
+        yield {**base, "choices": [{"index": 0, "delta": delta, "finish_reason": None}]}
+    yield {**base, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}
+    if include_usage:
+        yield {**base, "choices": [], "usage": resp["usage"]}
+
+def create_app(model: LatencyModel) -> FastAPI:
+    app = FastAPI(title="fake-openai")
+    stats = {"requests": 0, "prompt_tokens": 0, "completion_tokens": 0, "cached_tokens": 0,
+             "in_flight": 0, "max_in_flight": 0, "batches": 0, "batch_requests": 0, "rate_limited": 0}
+    cache = PromptCache()
+    files: Dict[str, bytes] = {}
+    batches: Dict[str, Dict[str, Any]] = {}
+
+    @app.get("/stats")
+    def get_stats() -> dict:
+        return stats
+
+    @app.post("/v1/chat/completions")
+    async def chat(body: dict = Body(...)):
+        stats["requests"] += 1
+        if model.rate_limit_rate and random.random() < model.rate_limit_rate:
+            stats["rate_limited"] += 1
+            return JSONResponse(status_code=429, headers={"retry-after-ms": str(int(model.retry_after_ms))},
+                                content={"error": {"message": "fake rate limit", "type": "requests", "code": "rate_limit_exceeded"}})
+        resp, uncached, completion_tokens = _completion(body, stats["requests"], cache)
+        if body.get("stream"):
+            return StreamingResponse(_stream(resp, uncached, bool((body.get("stream_options") or {}).get("include_usage"))),
+                                     media_type="text/event-stream")
+        stats["in_flight"] += 1
+        stats["max_in_flight"] = max(stats["max_in_flight"], stats["in_flight"])
+        try:
+            await asyncio.sleep(model.seconds(uncached, completion_tokens))
+        finally:
+            stats["in_flight"] -= 1
+        stats["prompt_tokens"] += resp["usage"]["prompt_tokens"]
+        stats["cached_tokens"] += resp["usage"]["prompt_tokens_details"]["cached_tokens"]
+        stats["completion_tokens"] += completion_tokens
+        if model.error_rate and random.random() < model.error_rate:
+            return JSONResponse(status_code=500, content={"error": {"message": "fake upstream error", "type": "server_error"}})
+        return resp
+
+    async def _stream(resp: Dict[str, Any], uncached: int, include_usage: bool):
+        stats["in_flight"] += 1
+        stats["max_in_flight"] = max(stats["max_in_flight"], stats["in_flight"])
+        try:
+            await asyncio.sleep(model.first_token(uncached))
+            for chunk in _stream_chunks(resp, include_usage):
+                if chunk["choices"] and chunk["choices"][0]["delta"].get("content"):
+                    await asyncio.sleep(model.per_token() * STREAM_PIECE_CHARS / 4)
+                yield f"data: {json.dumps(chunk)}\n\n"
+            yield "data: [DONE]\n\n"
+        finally:
+            stats["in_flight"] -= 1
+        stats["prompt_tokens"] += resp["usage"]["prompt_tokens"]
+        stats["cached_tokens"] += resp["usage"]["prompt_tokens_details"]["cached_tokens"]
+        stats["completion_tokens"] += resp["usage"]["completion_tokens"]
+
+    # ---------- Batch API ----------
+    def _file_obj(fid: str, filename: str, purpose: str) -> Dict[str, Any]:
+        return {"id": fid, "object": "file", "bytes": len(files[fid]), "created_at": int(time.time()),
+                "filename": filename, "purpose": purpose, "status": "processed"}
+
+    @app.post("/v1/files")
+    async def upload_file(file: UploadFile = File(...), purpose: str = Form(...)):
+        fid = f"file-{len(files) + 1}"
+        files[fid] = await file.read()
+        return _file_obj(fid, file.filename or "upload.jsonl", purpose)
+
+    @app.get("/v1/files/{file_id}/content")
+    def file_content(file_id: str):
+        if file_id not in files:
+            raise HTTPException(status_code=404, detail="no such file")
+        return Response(content=files[file_id], media_type="application/jsonl")
+
+    async def _run_batch(b: Dict[str, Any]) -> None:
+        await asyncio.sleep(model.batch_delay)
+        out, failed = [], 0
+        for line in files[b["input_file_id"]].decode("utf-8").splitlines():
+            if not line.strip():
+                continue
+            req = json.loads(line)
+            stats["batch_requests"] += 1
+            if model.error_rate and random.random() < model.error_rate:
+                failed += 1
+                row = {"id": f"batch_req_{stats['batch_requests']}", "custom_id": req["custom_id"],
+                       "response": {"status_code": 500, "request_id": "fake", "body": {"error": {"message": "fake upstream error"}}},
+                       "error": None}
+            else:
+                body, _, ct = _completion(req["body"], stats["batch_requests"], cache)
+                stats["prompt_tokens"] += body["usage"]["prompt_tokens"]
+                stats["cached_tokens"] += body["usage"]["prompt_tokens_details"]["cached_tokens"]
+                stats["completion_tokens"] += ct
+                row = {"id": f"batch_req_{stats['batch_requests']}", "custom_id": req["custom_id"],
+                       "response": {"status_code": 200, "request_id": "fake", "body": body}, "error": None}
+            out.append(json.dumps(row))
+        fid = f"file-{len(files) + 1}"
+        files[fid] = ("\n".join(out) + "\n").encode("utf-8")
+        b.update(status="completed", output_file_id=fid, completed_at=int(time.time()),
+                 request_counts={"total": len(out), "completed": len(out) - failed, "failed": failed})
+
+    @app.post("/v1/batches")
+    async def create_batch(body: dict = Body(...)):
+        if body.get("input_file_id") not in files:
+            raise HTTPException(status_code=400, detail="unknown input_file_id")
+        stats["batches"] += 1
+        bid = f"batch_{stats['batches']}"
+        b = {"id": bid, "object": "batch", "endpoint": body.get("endpoint", "/v1/chat/completions"),
+             "errors": None, "input_file_id": body["input_file_id"],
+             "completion_window": body.get("completion_window", "24h"), "status": "in_progress",
+             "output_file_id": None, "error_file_id": None, "created_at": int(time.time()),
+             "in_progress_at": int(time.time()), "metadata": body.get("metadata"),
+             "request_counts": {"total": 0, "completed": 0, "failed": 0}}
+        batches[bid] = b
+        asyncio.get_running_loop().create_task(_run_batch(b))
+        return b
+
+    @app.get("/v1/batches/{batch_id}")
+    def get_batch(batch_id: str):
+        if batch_id not in batches:
+            raise HTTPException(status_code=404, detail="no such batch")
+        return batches[batch_id]
+
+    return app
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def serve_in_thread(model: LatencyModel, port: Optional[int] = None) -> str:
+    """后台线程里起服务，返回 base_url（…/v1）"""
+    port = port or _free_port()
+    server = uvicorn.Server(uvicorn.Config(create_app(model), host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.02)
+    return f"http://127.0.0.1:{port}/v1"
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--port", type=int, default=8089)
+    ap.add_argument("--ttft-ms", type=float, default=400.0)
+    ap.add_argument("--tps", type=float, default=80.0, help="completion tokens/sec")
+    ap.add_argument("--prefill-tps", type=float, default=20000.0, help="prompt tokens/sec")
+    ap.add_argument("--jitter", type=float, default=0.1)
+    ap.add_argument("--error-rate", type=float, default=0.0)
+    ap.add_argument("--batch-delay", type=float, default=2.0, help="seconds until a batch completes")
+    ap.add_argument("--rate-limit-rate", type=float, default=0.0, help="fraction of requests answered with 429")
+    ap.add_argument("--retry-after-ms", type=float, default=500.0)
+    ap.add_argument("--slow-rate", type=float, default=0.0, help="fraction of requests that are slow_factor x slower")
+    ap.add_argument("--slow-factor", type=float, default=10.0)
+    a = ap.parse_args()
+    model = LatencyModel(ttft_ms=a.ttft_ms, tps=a.tps, prefill_tps=a.prefill_tps, jitter=a.jitter,
+                         error_rate=a.error_rate, batch_delay=a.batch_delay, rate_limit_rate=a.rate_limit_rate,
+                         retry_after_ms=a.retry_after_ms, slow_rate=a.slow_rate, slow_factor=a.slow_factor)
+    uvicorn.run(create_app(model), host="127.0.0.1", port=a.port, log_level="warning")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+# bench/lease_gen.py
+"""
+Synthetic residential lease PDFs for benchmarks.
+
+    python -m bench.lease_gen --pages 12 --layout two_column --out /tmp/lease.pdf
+
+Layouts:
+  single      单栏编号条款（最常见的模板）
+  two_column  双栏小字号（州政府表格类）
+  dense       单栏 8pt、每页块很多（长合同 / 附录）
+  scanned     每页只有一张图片、没有文本层（扫描件）
+
+每页都带页眉、"Page i of n" 页脚和 Tenant's Initials 行，用来覆盖 prompt 压缩。
+generate() 同时返回埋进去的高风险条款类别和所有条款原文（info["clauses"]），召回率基准可以拿它当标注。
+appendix_pages=N 在末尾追加 N 页楼规 / 定义类附录（没有任何条款，长合同里常见的大段无关内容）。
+"""
+import argparse, random
+from typing import List, Tuple, Dict, Any, Optional
+
+import fitz
+
+# (category, risky, text)
+CLAUSES: List[Tuple[str, bool, str]] = [
+    ("rent", False, "Tenant shall pay monthly Rent of ${rent} on or before the first day of each month at the office of the Landlord or through the online portal."),
+    ("late_fee", False, "If Rent is not received by the fifth day of the month, Tenant shall pay a late charge of ${late} as liquidated damages."),
+    ("late_fee", True, "Tenant shall pay a late fee of ${late} per day, without limit, for every day Rent remains unpaid after the due date."),
+    ("security_deposit", False, "Tenant has deposited ${deposit} as a security deposit, which Landlord shall return within twenty-one days after Tenant vacates, less lawful deductions itemized in writing."),
+    ("security_deposit", True, "The security deposit of ${deposit} is non-refundable and may be applied by Landlord to any purpose, including normal wear and tear."),
+    ("entry", False, "Landlord may enter the Premises at reasonable times to make repairs after giving Tenant at least twenty-four hours written notice, except in an emergency."),
+    ("entry", True, "Landlord and its agents may enter the Premises at any time, with or without notice, for any reason Landlord deems appropriate."),
+    ("repairs", False, "Landlord shall keep the Premises in a habitable condition and shall make necessary repairs to plumbing, heating and electrical systems within a reasonable time."),
+    ("repairs", True, "Tenant accepts the Premises as-is and waives any right to require Landlord to make repairs, including repairs affecting habitability."),
+    ("termination", False, "Either party may terminate a month-to-month tenancy by giving the other party at least thirty days written notice."),
+    ("termination", True, "Landlord may terminate this Lease immediately and retain all prepaid Rent if Tenant receives more than one noise complaint."),
+    ("subletting", False, "Tenant shall not assign this Lease or sublet any part of the Premises without the prior written consent of Landlord, which shall not be unreasonably withheld."),
+    ("pets", False, "No animals shall be kept on the Premises without Landlord's written consent, except service or assistance animals as required by law."),
+    ("utilities", False, "Tenant shall pay for electricity, gas and internet service. Landlord shall pay for water, sewer and trash collection."),
+    ("attorney_fees", True, "Tenant shall pay all of Landlord's attorney fees and costs in any dispute, regardless of which party prevails."),
+    ("waiver", True, "Tenant waives the right to a jury trial and any right to withhold Rent or to sue Landlord for any reason."),
+    ("parking", False, "One parking space is assigned to Tenant. Vehicles that are inoperable or unregistered may be towed at the owner's expense."),
+    ("insurance", False, "Tenant is encouraged to obtain renter's insurance. Landlord's insurance does not cover Tenant's personal property."),
+]
+
+FILLER = [
+    "The parties agree that this paragraph shall be interpreted in accordance with the laws of the state in which the Premises are located.",
+    "Tenant shall keep the Premises clean and sanitary and shall dispose of all garbage in the containers provided.",
+    "Any notice required under this Lease shall be in writing and delivered personally or by first-class mail to the addresses listed below.",
+    "The failure of Landlord to enforce any provision of this Lease shall not be deemed a waiver of that provision.",
+    "Tenant shall comply with all rules and regulations of the building, as amended from time to time with reasonable notice.",
+]
+
+# 附录：楼规 / 定义，不属于任何风险类别
+APPENDIX = [
+    "Quiet hours are from ten in the evening until eight in the morning on weekdays and until nine on weekends.",
+    "Balconies and patios shall be kept neat and shall not be used for the storage of furniture, boxes or bicycles.",
+    "Residents shall not place signs, flags or other objects in windows or on the exterior of the building.",
+    "Common areas, including hallways, stairwells and lobbies, shall be kept free of personal belongings at all times of day.",
+    "\"Building\" means the structure in which the Premises are located, together with its grounds and common facilities.",
+    "\"Resident\" includes each person who signs this Agreement and each occupant listed in the attached schedule.",
+    "The laundry room is available to residents between seven in the morning and ten in the evening. Please remove clothing promptly.",
+    "Grills and open flames are permitted only in the designated picnic area shown on the site plan.",
+    "Packages delivered to the office will be held for seven days and may be collected during posted office hours.",
+    "Holiday decorations may be displayed on the front door of the unit between November and January.",
+]
+
+def _fill(text: str, rng: random.Random) -> str:
+    return (text.replace("{rent}", f"{rng.randint(9, 45) * 100:,}")
+                .replace("{deposit}", f"{rng.randint(9, 60) * 100:,}")
+                .replace("{late}", str(rng.choice([25, 50, 75, 100]))))
+
+Para = Tuple[str, Optional[str], bool]   # (段落文本, 条款类别或 None, 是否高风险)
+
+def _paragraphs(n: int, rng: random.Random, risky_ratio: float) -> List[Para]:
+    paras: List[Para] = []
+    safe = [c for c in CLAUSES if not c[1]]
+    risky = [c for c in CLAUSES if c[1]]
+    for i in range(n):
+        if rng.random() < 0.35:
+            paras.append((f"{i + 1}. {rng.choice(FILLER)} {rng.choice(FILLER)}", None, False))
+            continue
+        cat, is_risky, text = rng.choice(risky if rng.random() < risky_ratio else safe)
+        paras.append((f"{i + 1}. {cat.replace('_', ' ').upper()}. {_fill(text, rng)}", cat, is_risky))
+    return paras
+
+def _appendix(n: int, rng: random.Random) -> List[Para]:
+    return [(f"R-{i + 1}. {rng.choice(APPENDIX)} {rng.choice(APPENDIX)}", None, False) for i in range(n)]
+
+def _decorate(page: fitz.Page, i: int, n: int) -> None:
+    w, h = page.rect.width, page.rect.height
+    page.insert_text((60, 36), "RESIDENTIAL LEASE AGREEMENT  Form RL-2024 (rev. 3)", fontsize=8)
+    page.insert_text((60, h - 40), "Tenant's Initials: ______    Landlord's Initials: ______", fontsize=8)
+    page.insert_text((w / 2 - 30, h - 24), f"Page {i + 1} of {n}", fontsize=8)
+
+def _layout_columns(page: fitz.Page, paras: List[Para], columns: int, fontsize: float, planted: List[str],
+                    placed: Optional[List[Dict[str, Any]]] = None) -> List[Para]:
+    """往页面里排段落，排不下的返回给下一页；实际排进去的高风险类别记到 planted，条款原文记到 placed"""
+    w, h = page.rect.width, page.rect.height
+    gap = 18
+    col_w = (w - 120 - gap * (columns - 1)) / columns
+    rest = list(paras)
+    for c in range(columns):
+        x0 = 60 + c * (col_w + gap)
+        y = 56.0
+        while rest:
+            text, cat, risky = rest[0]
+            lines = max(1, int(len(text) * fontsize * 0.5 / col_w) + 1)
+            height = lines * fontsize * 1.25 + 6
+            # 估算偏小时 insert_textbox 返回负数（差多少高度）且什么都不写：按差值加高重排，
+            # 这一栏放不下就留给下一栏 / 下一页，保证记进 placed 的条款都真的在 PDF 里
+            rc = -1.0
+            while y + height <= h - 60:
+                rc = page.insert_textbox(fitz.Rect(x0, y, x0 + col_w, y + height), text, fontsize=fontsize)
+                if rc >= 0:
+                    break
+                height += -rc + 1
+            if rc < 0:
+                break
+            height -= rc   # 去掉多留的空白
+            rest.pop(0)
+            if cat and risky:
+                planted.append(cat)
+            if cat and placed is not None:
+                placed.append({"category": cat, "risky": risky, "text": text, "page": page.number + 1})
+            y += height + 4
+    return rest
+
+def generate(pages: int = 8, *, layout: str = "single", seed: int = 0, risky_ratio: float = 0.25,
+             appendix_pages: int = 0) -> Tuple[bytes, Dict[str, Any]]:
+    """返回 (PDF 字节, {"layout", "pages", "planted": [高风险条款类别], "clauses": [{category, risky, text, page}]})"""
+    rng = random.Random(seed)
+    columns, fontsize, per_page = {"single": (1, 10, 9), "two_column": (2, 8, 16), "dense": (1, 8, 16), "scanned": (1, 10, 9)}[layout]
+    paras = _paragraphs(pages * per_page, rng, risky_ratio)
+    planted: List[str] = []
+    placed: List[Dict[str, Any]] = []
+
+    total = pages + appendix_pages
+    doc = fitz.open()
+    for i in range(pages):
+        page = doc.new_page()
+        _decorate(page, i, total)
+        paras = _layout_columns(page, paras, columns, fontsize, planted, placed)
+    rules = _appendix(appendix_pages * per_page, rng)
+    for i in range(pages, total):
+        page = doc.new_page()
+        _decorate(page, i, total)
+        rules = _layout_columns(page, rules, columns, fontsize, planted, placed)
+    if layout == "scanned":
+        # 把每页栅格化成图片，再放进一个只有图片的新文档
+        scanned = fitz.open()
+        for page in doc:
+            pix = page.get_pixmap(dpi=72)
+            sp = scanned.new_page(width=page.rect.width, height=page.rect.height)
+            sp.insert_image(sp.rect, pixmap=pix)
+        doc, planted, placed = scanned, [], []
+    data = doc.tobytes(garbage=3, deflate=True)
+    return data, {"layout": layout, "pages": total, "seed": seed, "planted": planted, "clauses": placed}
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--pages", type=int, default=8)
+    ap.add_argument("--layout", choices=["single", "two_column", "dense", "scanned"], default="single")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--risky-ratio", type=float, default=0.25)
+    ap.add_argument("--appendix-pages", type=int, default=0)
+    ap.add_argument("--out", required=True)
+    a = ap.parse_args()
+    data, info = generate(a.pages, layout=a.layout, seed=a.seed, risky_ratio=a.risky_ratio, appendix_pages=a.appendix_pages)
+    with open(a.out, "wb") as f:
+        f.write(data)
+    print(f"{a.out}: {len(data)} bytes " + str({**{k: v for k, v in info.items() if k != "clauses"}, "clauses": len(info["clauses"])}))
+
+if __name__ == "__main__":
+    main()
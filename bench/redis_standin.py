@@ -0,0 +1,26 @@
+# bench/redis_standin.py
+"""
+Point job_store at a benchmark Redis.
+
+  install("redis://localhost:6379/15")  用真实 Redis（建议单独的 db，会 FLUSHDB）
+  install(None)                         进程内 fakeredis（pip install fakeredis lupa；Lua 脚本需要 lupa）
+
+job_store 在 import 时就按 REDIS_URL 建好了客户端，这里直接替换模块里的 _r / _ar，
+result_cache 等其它模块都通过 job_store._r 访问，会一起生效。
+"""
+from typing import Optional
+
+def install(url: Optional[str] = None) -> str:
+    from app.services import job_store
+    if url:
+        import redis
+        import redis.asyncio as aredis
+        job_store._r = redis.Redis.from_url(url, decode_responses=True)
+        job_store._ar = aredis.Redis.from_url(url, decode_responses=True)
+        job_store._r.flushdb()
+        return url
+    import fakeredis
+    server = fakeredis.FakeServer()
+    job_store._r = fakeredis.FakeRedis(server=server, decode_responses=True)
+    job_store._ar = fakeredis.FakeAsyncRedis(server=server, decode_responses=True)
+    return "fakeredis"
@@ -0,0 +1,167 @@
+# bench/run_bench.py
+"""
+End-to-end benchmark: enqueue -> worker -> poll, with no API spend.
+
+    python -m bench.run_bench --jobs 40 --pages 8 --layouts single,two_column,dense --rate 0
+    python -m bench.run_bench --redis redis://localhost:6379/15 --ttft-ms 800 --tps 60 --json
+
+组成：
+  bench.lease_gen       合成租约 PDF（页数 / 版式可配）
+  bench.fake_openai     本地 OpenAI 兼容服务（首 token 延迟 / token 速率可配）
+  bench.redis_standin   fakeredis 或指定的真实 Redis
+  本文件                 用 ASGI transport 调 /analyzeLeaseByUrl 入队、/jobs/{id} 轮询，
+                         进程内跑 WorkerEngine（BLOB_BACKEND=local 读生成的 PDF）
+
+报告 jobs/s、各阶段（enqueue、worker 记录的 queue_wait / download / extract / prompt_build /
+llm / first_finding（流式模式下第一条 partial finding）/ persist / total，以及客户端看到的 end_to_end）p50/p95/p99 和峰值内存（本进程 + 子进程的 ru_maxrss）。
+"""
+import argparse, asyncio, json, os, resource, sys, tempfile, time, logging
+from typing import Dict, List, Any
+
+from bench.lease_gen import generate
+from bench.fake_openai import LatencyModel, serve_in_thread
+
+STAGES = ("enqueue", "queue_wait", "download", "extract", "prompt_build", "llm", "first_finding", "persist", "total", "end_to_end")
+
+def percentile(xs: List[float], p: float) -> float:
+    if not xs:
+        return 0.0
+    xs = sorted(xs)
+    k = min(len(xs) - 1, max(0, int(round(p / 100 * len(xs) + 0.5)) - 1))
+    return xs[k]
+
+def _peak_rss_mb() -> float:
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    kids = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return round(max(own, kids) / 1024, 1)
+
+async def _run(a: argparse.Namespace, blob_dir: str) -> Dict[str, Any]:
+    import httpx
+    from app.main import app
+    from app.services import worker as worker_svc
+    from app.services.worker import WorkerEngine
+
+    # 生成合同：轮流使用各版式，种子不同保证内容不同（不命中结果缓存）
+    layouts = [x for x in a.layouts.split(",") if x]
+    paths = []
+    for i in range(a.jobs):
+        data, _ = generate(a.pages, layout=layouts[i % len(layouts)], seed=a.seed + i)
+        name = f"bench/{i}.pdf"
+        os.makedirs(os.path.join(blob_dir, "bench"), exist_ok=True)
+        with open(os.path.join(blob_dir, name), "wb") as f:
+            f.write(data)
+        paths.append(name)
+
+    samples: Dict[str, List[float]] = {s: [] for s in STAGES}
+    stage_times: Dict[str, Dict[str, float]] = {}
+    statuses: Dict[str, int] = {}
+
+    # 等同 WORKER_ENGINE=1：入队端点看到常驻引擎就不再发 tick
+    eng = worker_svc.engine = WorkerEngine(concurrency=a.concurrency, base_url="")
+    engine_task = asyncio.create_task(eng.run())
+    while eng.pipeline is None:
+        await asyncio.sleep(0.01)
+    eng.pipeline.on_finish = lambda job_id, timings: stage_times.__setitem__(job_id, dict(timings))
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+
+        async def one(i: int) -> None:
+            t0 = time.perf_counter()
+            r = await client.post("/analyzeLeaseByUrl", json={
+                "pathname": paths[i], "name": f"lease-{i}.pdf", "jurisdiction": {"country": "US", "state": "CA"},
+            })
+            r.raise_for_status()
+            job_id = r.json()["job_id"]
+            samples["enqueue"].append(time.perf_counter() - t0)
+            etag = None
+            while True:
+                await asyncio.sleep(a.poll_interval)
+                r = await client.get(f"/jobs/{job_id}", headers={"If-None-Match": etag} if etag else {})
+                if r.status_code == 304:
+                    continue
+                etag = r.headers.get("etag")
+                status = r.json()["status"]
+                if status in ("done", "error"):
+                    break
+            e2e = time.perf_counter() - t0
+            samples["end_to_end"].append(e2e)
+            statuses[status] = statuses.get(status, 0) + 1
+            # on_finish 在 ack 之后回调，轮询看到 done 时可能还差一点
+            for _ in range(50):
+                if job_id in stage_times:
+                    break
+                await asyncio.sleep(0.01)
+            for s, v in stage_times.get(job_id, {}).items():
+                if s in samples:
+                    samples[s].append(v)
+
+        t_start = time.perf_counter()
+        tasks = []
+        for i in range(a.jobs):
+            tasks.append(asyncio.create_task(one(i)))
+            if a.rate > 0:
+                await asyncio.sleep(1.0 / a.rate)
+        await asyncio.gather(*tasks)
+        wall = time.perf_counter() - t_start
+
+    eng.stop()
+    await engine_task
+    return {"wall": wall, "samples": samples, "statuses": statuses}
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--jobs", type=int, default=40)
+    ap.add_argument("--pages", type=int, default=8)
+    ap.add_argument("--layouts", default="single,two_column,dense")
+    ap.add_argument("--seed", type=int, default=1000)
+    ap.add_argument("--rate", type=float, default=0.0, help="arrivals per second (0 = all at once)")
+    ap.add_argument("--concurrency", type=int, default=4, help="LLM stage concurrency")
+    ap.add_argument("--poll-interval", type=float, default=0.25)
+    ap.add_argument("--ttft-ms", type=float, default=400.0)
+    ap.add_argument("--tps", type=float, default=80.0)
+    ap.add_argument("--prefill-tps", type=float, default=20000.0)
+    ap.add_argument("--redis", default=None, help="real Redis URL (default: fakeredis)")
+    ap.add_argument("--json", action="store_true", help="print one JSON line instead of a table")
+    ap.add_argument("--verbose", action="store_true")
+    a = ap.parse_args()
+
+    # app 模块在 import 时读配置，必须先设好环境变量
+    blob_dir = tempfile.mkdtemp(prefix="lease-bench-")
+    llm_url = serve_in_thread(LatencyModel(ttft_ms=a.ttft_ms, tps=a.tps, prefill_tps=a.prefill_tps))
+    os.environ.update({
+        "OPENAI_BASE_URL": llm_url, "OPENAI_API_KEY": "bench",
+        "BLOB_BACKEND": "local", "BLOB_LOCAL_DIR": blob_dir,
+        "REDIS_URL": a.redis or os.environ.get("REDIS_URL", "redis://localhost:6379/15"),
+        "CORS_ALLOW_ORIGIN": os.environ.get("CORS_ALLOW_ORIGIN", "*"),
+        "WORKER_ENGINE": "0",
+    })
+    from bench.redis_standin import install
+    redis_desc = install(a.redis)
+    if not a.verbose:
+        import app.main  # noqa: F401  (basicConfig 在这里执行，之后再调级别)
+        logging.getLogger("lease").setLevel(logging.ERROR)
+
+    res = asyncio.run(_run(a, blob_dir))
+    samples, wall = res["samples"], res["wall"]
+    report = {
+        "jobs": a.jobs, "pages": a.pages, "layouts": a.layouts, "redis": redis_desc,
+        "llm": {"ttft_ms": a.ttft_ms, "tps": a.tps}, "concurrency": a.concurrency,
+        "wall_s": round(wall, 2), "jobs_per_sec": round(a.jobs / wall, 2), "statuses": res["statuses"],
+        "stages_ms": {
+            s: {f"p{p}": round(percentile(v, p) * 1000, 1) for p in (50, 95, 99)}
+            for s, v in samples.items() if v
+        },
+        "peak_rss_mb": _peak_rss_mb(),
+    }
+    if a.json:
+        print(json.dumps(report))
+        return
+    print(f"jobs={a.jobs} pages={a.pages} layouts={a.layouts} redis={redis_desc} llm_concurrency={a.concurrency}")
+    print(f"wall={report['wall_s']}s  throughput={report['jobs_per_sec']} jobs/s  statuses={res['statuses']}  peak_rss={report['peak_rss_mb']}MB")
+    print(f"{'stage':12s} {'p50 ms':>10s} {'p95 ms':>10s} {'p99 ms':>10s}")
+    for s, v in report["stages_ms"].items():
+        print(f"{s:12s} {v['p50']:>10.1f} {v['p95']:>10.1f} {v['p99']:>10.1f}")
+
+if __name__ == "__main__":
+    sys.exit(main())